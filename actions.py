@@ -0,0 +1,497 @@
+"""デスクトップ入力操作のプリミティブ
+
+Flaskのルート・バッチ実行・サーバー側実行エンジンから共通で使う。
+各操作は「検証」と「実行」に分かれており、検証はパラメータを正規化して
+返し、実行は検証済みのパラメータを受け取ってログ用のメッセージを返す。
+"""
+import platform
+import threading
+import time
+import webbrowser
+
+import pyautogui
+
+import metrics
+import timing
+from textfile import split_text
+
+ACTION_SECONDS = metrics.histogram(
+    'autonex_action_seconds', '入力操作1件の所要時間（ディスパッチャの待ち行列での待ち時間を含む）', ('action', 'status'))
+TEXT_CHARS = metrics.counter('autonex_typed_chars_total', '入力した文字数（入力方法別）', ('method',))
+ACTION_ERRORS = metrics.counter('autonex_action_errors_total', '失敗した入力操作の数（例外の種類別）', ('action', 'error'))
+
+# 長いテキストをクリップボード経由で入力するときの1回分の文字数
+BULK_CHUNK_CHARS = 4096
+# 分割入力の途中経過を通知する間隔（秒）
+PROGRESS_INTERVAL = 0.25
+
+
+class ActionError(ValueError):
+    """操作のパラメータが不正な場合の例外"""
+
+
+class StopRequested(Exception):
+    """実行の停止が要求された場合の例外"""
+
+
+class ActionContext:
+    """操作の実行コンテキスト
+
+    停止イベントを保持し、停止要求で即座に中断できる待機を提供する。
+    画面サイズは最初に必要になった時点で一度だけ取得してキャッシュする。
+    listener を渡した場合、emit() で操作の途中経過（画像の検出結果など）を通知する。
+    session（dispatcher.InputSession）を渡した場合、入力操作はそのセッションの設定で
+    ディスパッチャのスレッドに渡して実行する。
+    待機は timing.TimingReport（report）に要求した秒数と実際に待った秒数を記録する。
+    last_step_end は直前の操作が終わった時刻で、待機ブロックはこの時刻から数える。
+    """
+
+    def __init__(self, stop_event=None, listener=None, session=None, report=None):
+        self.stop_event = stop_event or threading.Event()
+        self.listener = listener
+        self.session = session
+        self.report = report or timing.TimingReport(session.profile if session is not None else None)
+        self.last_step_end = time.perf_counter()
+        self._screen_size = None
+
+    def emit(self, event_type, **data):
+        if self.listener is not None:
+            self.listener(event_type, data)
+
+    def check(self):
+        if self.stop_event.is_set():
+            raise StopRequested('実行が停止されました')
+
+    def sleep(self, seconds):
+        if self.stop_event.wait(max(0.0, float(seconds))):
+            raise StopRequested('実行が停止されました')
+
+    def sleep_until(self, deadline, kind, requested):
+        """deadline（time.perf_counter() の値）まで待ち、要求した秒数と実際の待ち時間を記録する"""
+        start = time.perf_counter()
+        if not timing.sleep_until(deadline, self.stop_event):
+            raise StopRequested('実行が停止されました')
+        self.report.record(kind, requested, time.perf_counter() - start)
+
+    def settle(self, action):
+        """操作 action の落ち着き時間（秒）"""
+        profile = self.session.profile if self.session is not None else timing.get_profile(timing.DEFAULT_SPEED)
+        return profile.settle(action)
+
+    def step_done(self):
+        self.last_step_end = time.perf_counter()
+
+    def screen_size(self):
+        if self._screen_size is None:
+            self._screen_size = tuple(pyautogui.size())
+        return self._screen_size
+
+    @property
+    def failsafe(self):
+        return self.session.failsafe if self.session is not None else pyautogui.FAILSAFE
+
+    def run_input(self, fn, *args, action=None, cancellable=True):
+        """入力操作 fn(*args) を実行する（セッションがあればディスパッチャのスレッドで）
+
+        action を渡した場合、その操作の落ち着き時間を次の入力操作の締め切りにする。
+        cancellable が偽の場合は、停止が要求されても取り消さない（押したボタンを離すなど）。
+        """
+        if self.session is None:
+            return fn(*args)
+        return self.session.call(fn, *args, stop_event=self.stop_event if cancellable else None,
+                                 action=action, report=self.report)
+
+    def start_settle(self, action):
+        """今から操作 action の落ち着き時間が終わるまでを、次の入力操作の締め切りにする"""
+        if self.session is not None:
+            self.session.start_settle(action)
+
+
+def check_screen_point(x, y, screen_size=None, failsafe=None):
+    """座標が画面内にあり、フェイルセーフ領域に入っていないか確認する"""
+    screen_width, screen_height = screen_size or pyautogui.size()
+    failsafe = pyautogui.FAILSAFE if failsafe is None else failsafe
+    try:
+        x, y = int(x), int(y)
+    except (TypeError, ValueError):
+        raise ActionError('座標は数値で指定してください')
+
+    if x < 0 or x >= screen_width or y < 0 or y >= screen_height:
+        raise ActionError(f'座標が画面範囲外です。画面サイズ: {screen_width}x{screen_height}')
+
+    # フェイルセーフが有効な場合のみ画面の角をチェック
+    if failsafe:
+        corner_margin = 10
+        if ((x < corner_margin and y < corner_margin) or
+            (x > screen_width - corner_margin and y < corner_margin) or
+            (x < corner_margin and y > screen_height - corner_margin) or
+            (x > screen_width - corner_margin and y > screen_height - corner_margin)):
+            raise ActionError(f'画面の角から{corner_margin}px以内はフェイルセーフのため使用できません')
+
+    return x, y
+
+
+def _int_param(params, name, default):
+    try:
+        return int(float(params.get(name, default)))
+    except (TypeError, ValueError):
+        raise ActionError(f'{name} は数値で指定してください')
+
+
+def _float_param(params, name, default):
+    try:
+        value = float(params.get(name, default))
+    except (TypeError, ValueError):
+        raise ActionError(f'{name} は数値で指定してください')
+    if value < 0:
+        raise ActionError(f'{name} に負の値は指定できません')
+    return value
+
+
+def _button_param(params, default='left'):
+    button = params.get('button', default)
+    if button not in ('left', 'right', 'middle'):
+        raise ActionError(f'不明なボタンです: {button}')
+    return button
+
+
+# 検証
+def validate_point(params, ctx):
+    x = params.get('x')
+    y = params.get('y')
+    if x is None or y is None:
+        raise ActionError('座標が指定されていません')
+    x, y = check_screen_point(x, y, ctx.screen_size(), ctx.failsafe)
+    return {'x': x, 'y': y}
+
+
+def validate_offset(params, ctx):
+    return {'x': _int_param(params, 'x', 0), 'y': _int_param(params, 'y', 0)}
+
+
+def validate_scroll(params, ctx):
+    direction = params.get('direction', 'down')
+    if direction not in ('down', 'up'):
+        raise ActionError(f'不明なスクロール方向です: {direction}')
+    return {'amount': _int_param(params, 'amount', 3), 'direction': direction}
+
+
+def validate_button(params, ctx):
+    return {'button': _button_param(params)}
+
+
+def validate_long_press(params, ctx):
+    return {'button': _button_param(params), 'duration': _float_param(params, 'duration', 1)}
+
+
+def validate_key(params, ctx):
+    key = params.get('key')
+    if not key:
+        raise ActionError('キーが指定されていません')
+    return {'key': str(key)}
+
+
+def validate_text(params, ctx):
+    text = params.get('text')
+    if text is None or text == '':
+        raise ActionError('テキストが指定されていません')
+    return {'text': text if isinstance(text, str) else str(text)}
+
+
+def validate_wait(params, ctx):
+    return {'seconds': _float_param(params, 'seconds', 1)}
+
+
+def validate_url(params, ctx):
+    url = params.get('url')
+    if not url:
+        raise ActionError('URLが指定されていません')
+
+    # プロトコルが指定されていない場合はhttpsを追加
+    if not (url.startswith('http://') or url.startswith('https://') or url.startswith('file://')):
+        url = 'https://' + url
+    return {
+        'url': url,
+        'waitForLoad': bool(params.get('waitForLoad', False)),
+        'waitTime': _float_param(params, 'waitTime', 3),
+    }
+
+
+def validate_none(params, ctx):
+    return {}
+
+
+# 実行
+def mouse_click(params, ctx):
+    x, y = params['x'], params['y']
+    pyautogui.click(x=x, y=y)
+    return f'座標 ({x}, {y}) をクリックしました'
+
+
+def mouse_move(params, ctx):
+    x, y = params['x'], params['y']
+    pyautogui.moveTo(x, y)
+    return f'座標 ({x}, {y}) に移動しました'
+
+
+def mouse_move_absolute(params, ctx):
+    x, y = params['x'], params['y']
+    pyautogui.moveTo(x, y)
+    return f'絶対座標 ({x}, {y}) に移動しました'
+
+
+def mouse_move_relative(params, ctx):
+    x, y = params['x'], params['y']
+    pyautogui.move(x, y)
+    return f'相対座標 ({x}, {y}) だけ移動しました'
+
+
+def mouse_scroll(params, ctx):
+    amount = params['amount']
+    direction = params['direction']
+    pyautogui.scroll(amount if direction == 'down' else -amount)
+    return f'{direction}方向に{amount}スクロールしました'
+
+
+def mouse_single_click(params, ctx):
+    button = params['button']
+    pyautogui.click(button=button)
+    return f'{button}ボタンでシングルクリックしました'
+
+
+def mouse_double_click(params, ctx):
+    button = params['button']
+    pyautogui.doubleClick(button=button)
+    return f'{button}ボタンでダブルクリックしました'
+
+
+def mouse_triple_click(params, ctx):
+    button = params['button']
+    pyautogui.tripleClick(button=button)
+    return f'{button}ボタンでトリプルクリックしました'
+
+
+def mouse_long_press(params, ctx):
+    button = params['button']
+    duration = params['duration']
+
+    def press():
+        pyautogui.mouseDown(button=button)
+        return time.perf_counter()
+
+    # 押す・離すだけをディスパッチャに渡し、押している間は呼び出し元のスレッドで待つ
+    pressed = ctx.run_input(press)
+    try:
+        # 押した時刻からの締め切りで待つ（押す操作自体にかかった時間の分だけ短くなる）
+        ctx.sleep_until(pressed + duration, 'long_press', duration)
+    finally:
+        # 停止が要求されてもボタンは必ず離す
+        ctx.run_input(lambda: pyautogui.mouseUp(button=button), action='mouse_long_press', cancellable=False)
+    return f'{button}ボタンを{duration}秒長押ししました'
+
+
+def mouse_release(params, ctx):
+    button = params['button']
+    pyautogui.mouseUp(button=button)
+    return f'{button}ボタンをリリースしました'
+
+
+def mouse_middle_click(params, ctx):
+    pyautogui.click(button='middle')
+    return '中クリックしました'
+
+
+def key_press(params, ctx):
+    key = params['key']
+    keys = key.split('+') if len(key) > 1 and '+' in key.strip('+') else [key]
+    if len(keys) > 1:
+        # ctrl+c のような組み合わせは順に押して逆順に離す
+        pyautogui.hotkey(*keys)
+    else:
+        pyautogui.press(key)
+    return f'キー「{key}」を押しました'
+
+
+def _paste_hotkey():
+    return ('command', 'v') if platform.system() == 'Darwin' else ('ctrl', 'v')
+
+
+def stream_text(chunks, ctx, method='paste'):
+    """テキストの断片を順に入力し、文字数・断片数・所要時間・1秒あたりの文字数を返す
+
+    method が paste の場合はクリップボード経由で貼り付ける。クリップボードの保存と
+    復元は全体で1回だけ行い、断片ごとに貼り付けの落ち着き時間だけ待ってから次を
+    コピーする。断片ごとに停止要求を確認し、ctx.emit('type_progress') で途中経過を通知する。
+    ディスパッチャには断片1つ分の入力ずつ渡し、落ち着き時間は呼び出し元のスレッドで待つ。
+    """
+    clipboard = None
+    saved = False
+    if method == 'paste':
+        import pyperclip
+        clipboard = pyperclip
+        try:
+            original_clipboard = clipboard.paste()
+            saved = True
+        except Exception:
+            pass
+
+    def paste(chunk):
+        # コピーと貼り付けの間に他の入力が入らないよう、1回の入力として実行する
+        clipboard.copy(chunk)
+        pyautogui.hotkey(*_paste_hotkey())
+
+    start = time.perf_counter()
+    last_progress = start
+    chars = 0
+    count = 0
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            ctx.check()
+            if clipboard is not None:
+                ctx.run_input(paste, chunk)
+                # 貼り付けが終わる前に次の断片をコピーしない
+                settle = ctx.settle('clipboard_paste')
+                ctx.sleep_until(time.perf_counter() + settle, 'clipboard_paste', settle)
+            else:
+                ctx.run_input(pyautogui.typewrite, chunk)
+            chars += len(chunk)
+            count += 1
+            now = time.perf_counter()
+            if now - last_progress >= PROGRESS_INTERVAL:
+                last_progress = now
+                ctx.emit('type_progress', chars=chars, chunks=count,
+                         charsPerSecond=round(chars / (now - start), 1))
+    finally:
+        if saved:
+            try:
+                ctx.run_input(clipboard.copy, original_clipboard, cancellable=False)
+            except Exception:
+                pass
+        ctx.start_settle('type_text')
+        TEXT_CHARS.inc(chars, method=method)
+
+    elapsed = time.perf_counter() - start
+    return {
+        'method': method,
+        'chars': chars,
+        'chunks': count,
+        'seconds': round(elapsed, 4),
+        'charsPerSecond': round(chars / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+def type_text(params, ctx):
+    text = params['text']
+
+    # 日本語などのマルチバイト文字または改行が含まれる場合、クリップボード経由で入力
+    has_multibyte = any(ord(char) > 127 for char in text)
+    has_newline = '\n' in text or '\r' in text
+    if not (has_multibyte or has_newline):
+        ctx.run_input(pyautogui.typewrite, text, action='type_text')
+        TEXT_CHARS.inc(len(text), method='type')
+        return f'テキスト「{text}」を入力しました'
+
+    # 長いテキストは分割して貼り付ける（クリップボードの保存・復元は1回だけ）
+    stats = stream_text(split_text(text, BULK_CHUNK_CHARS), ctx)
+
+    display_text = text[:60].replace('\n', '\\n').replace('\r', '\\r')
+    if len(display_text) > 50:
+        display_text = display_text[:50] + '...'
+    if stats['chunks'] > 1:
+        return (f'テキスト「{display_text}」を入力しました（クリップボード経由、{stats["chars"]}文字を'
+                f'{stats["chunks"]}回に分けて{stats["seconds"]:.2f}秒）')
+    return f'テキスト「{display_text}」を入力しました（クリップボード経由）'
+
+
+def wait(params, ctx):
+    seconds = params['seconds']
+    # 直前の操作の終了時刻から数える（操作の合間の処理にかかった時間は待たない）
+    ctx.sleep_until(ctx.last_step_end + seconds, 'wait', seconds)
+    return f'{seconds}秒待機しました'
+
+
+def browser_open_url(params, ctx):
+    url = params['url']
+    wait_for_load = params['waitForLoad']
+    wait_time = params['waitTime']
+
+    opened = time.perf_counter()
+    webbrowser.open(url)
+
+    if wait_for_load:
+        ctx.sleep_until(opened + wait_time, 'wait', wait_time)
+
+    return f'URL「{url}」を開きました{"（" + f"{wait_time:g}" + "秒待機）" if wait_for_load else ""}'
+
+
+def browser_refresh(params, ctx):
+    # F5キーを押してページを更新
+    pyautogui.press('f5')
+    return 'ページを更新しました'
+
+
+# 操作名（Blocklyのブロック名と同じ）→ (検証, 実行)
+ACTIONS = {
+    'mouse_click': (validate_point, mouse_click),
+    'mouse_move': (validate_point, mouse_move),
+    'mouse_move_absolute': (validate_point, mouse_move_absolute),
+    'mouse_move_relative': (validate_offset, mouse_move_relative),
+    'mouse_scroll': (validate_scroll, mouse_scroll),
+    'mouse_single_click': (validate_button, mouse_single_click),
+    'mouse_double_click': (validate_button, mouse_double_click),
+    'mouse_triple_click': (validate_button, mouse_triple_click),
+    'mouse_long_press': (validate_long_press, mouse_long_press),
+    'mouse_release': (validate_button, mouse_release),
+    'mouse_middle_click': (validate_none, mouse_middle_click),
+    'key_press': (validate_key, key_press),
+    'type_text': (validate_text, type_text),
+    'wait': (validate_wait, wait),
+    'browser_open_url': (validate_url, browser_open_url),
+    'browser_refresh': (validate_none, browser_refresh),
+}
+
+# マウス・キーボードを使わない操作（待機中に他の入力操作を止めないようディスパッチャを通さない）
+INPUT_FREE_ACTIONS = {'wait', 'browser_open_url'}
+# 途中に待機を含む操作。押す・離す、断片1つ分の貼り付けなど入力ごとに自分でディスパッチャに渡し、
+# 待機は呼び出し元のスレッドで行う（最後の入力の落ち着き時間も自分で設定する）
+STAGED_ACTIONS = {'mouse_long_press', 'type_text'}
+
+
+def validate(name, params, ctx):
+    """操作のパラメータを検証し、正規化したパラメータを返す"""
+    if name not in ACTIONS:
+        raise ActionError(f'不明な操作です: {name}')
+    return ACTIONS[name][0](params or {}, ctx)
+
+
+def execute(name, params, ctx):
+    """検証済みのパラメータで操作を実行し、メッセージを返す"""
+    fn = ACTIONS[name][1]
+    start = time.perf_counter()
+    status = 'ok'
+    try:
+        if name in INPUT_FREE_ACTIONS or name in STAGED_ACTIONS:
+            return fn(params, ctx)
+        return ctx.run_input(fn, params, ctx, action=name)
+    except StopRequested:
+        status = 'stopped'
+        raise
+    except Exception as e:
+        status = 'error'
+        ACTION_ERRORS.inc(action=name, error=type(e).__name__)
+        raise
+    finally:
+        ctx.step_done()
+        ACTION_SECONDS.observe(time.perf_counter() - start, action=name, status=status)
+
+
+def perform(name, params, ctx):
+    """操作を検証してから実行し、メッセージを返す"""
+    return execute(name, validate(name, params, ctx), ctx)
+
+
+def handlers():
+    """実行エンジン用の操作名 → ハンドラ関数の辞書を返す"""
+    return {name: (lambda params, ctx, name=name: perform(name, params, ctx)) for name in ACTIONS}
@@ -1,24 +1,110 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, g, render_template, jsonify, request, send_file
 from flask_cors import CORS
 import pyautogui
+import codecs
 import json
 import os
+import re
 import time
-import webbrowser
-import subprocess
 import cv2
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
+import actions
+import metrics
+from batch import ON_ERROR, BatchManager
+from capture import FrameCache, create_frame_source
+from catalog import SORT_KEYS, ProgramCatalog
+from dispatcher import InputDispatcher, InputQueueFull, SessionRegistry
+from engine import CompileError, CompiledStore, RunManager, compile_program, find_problems, fold_constants
+from events import EventBus, PositionSampler, format_sse
+from jobs import JobError, JobManager, JobQueueFull
+from recorder import RECORD_BACKENDS, Recorder, build_steps, create_event_source, to_workspace
+from textfile import TextFileReader, detect_encoding, iter_text, split_text
+from timing import DEFAULT_SPEED, SPEED_PROFILES, get_profile, uniform_profile
+from library import DuplicateImageError, ImageLibrary
+from matching import (COLOR_MODES, DEFAULT_COLOR_MODE, MATCH_MODES, READING_ORDERS, ChangeDetector, LocationHints,
+                      TemplateCache, affected_window, downscale, find_all, hint_window, match, normalize_region,
+                      pyramid_scale)
+
 app = Flask(__name__)
 CORS(app)
 
+# 入力操作の既定の設定（クライアントごとの設定はセッションに持たせ、ディスパッチャが操作の直前に適用する）
 pyautogui.FAILSAFE = False  # フェイルセーフを無効化（本番環境では慎重に使用）
-pyautogui.PAUSE = 0.1  # 各操作間に0.1秒の待機時間を設定
+pyautogui.PAUSE = 0  # 操作間の待機は速度プロファイルの落ち着き時間で行う（timing.py）
 SAVE_DIR = 'save'
 PROGRAM_DIR = os.path.join(SAVE_DIR, 'program')
+PROGRAM_CATALOG_JSON = os.path.join(SAVE_DIR, 'programs.json')
+# 保存時にコンパイルした命令列の保存先
+COMPILED_DIR = os.path.join(SAVE_DIR, 'compiled')
+# CSV/TSV のバッチ実行の状態と行ごとの記録の保存先
+BATCH_DIR = os.path.join(SAVE_DIR, 'batches')
 IMG_DIR = os.path.join(SAVE_DIR, 'img')
 IMG_JSON = os.path.join(IMG_DIR, 'images.json')
+# デコード済みテンプレート画像のキャッシュ上限（MB）
+TEMPLATE_CACHE_MB = int(os.environ.get('AUTONEX_TEMPLATE_CACHE_MB', '128'))
+# 画像マッチングの既定方式（exhaustive: 全画素探索 / pyramid: 縮小画像で候補を絞ってから精密探索）
+MATCH_MODE = os.environ.get('AUTONEX_MATCH_MODE', 'exhaustive')
+# 画像ごとの設定もリクエストでの指定もない場合の信頼度
+DEFAULT_CONFIDENCE = 0.8
+# 前回検出位置の周辺を先に探すときの余白（px）
+HINT_MARGIN = 32
+# 要素の出現を待つときのポーリング間隔（秒）。画面が変化しない間は最大値まで伸ばす
+POLL_INTERVAL_MIN = 0.05
+POLL_INTERVAL_MAX = 0.5
+# 複数画像の同時検索で使うスレッド数と、一度に探せる画像の数
+MATCH_WORKERS = int(os.environ.get('AUTONEX_MATCH_WORKERS', str(min(8, os.cpu_count() or 1))))
+MAX_FIND_MANY = 50
+# マウス位置を調べる間隔（回/秒）と、イベントストリームで送る既定の上限（回/秒）
+POSITION_SAMPLE_HZ = float(os.environ.get('AUTONEX_POSITION_SAMPLE_HZ', '20'))
+POSITION_STREAM_HZ = 10
+# イベントストリームで何も送るものがないときに接続確認を送る間隔（秒）
+EVENT_HEARTBEAT_SECONDS = 15
+# 画像ライブラリのサムネイルの既定サイズ（短辺px。表示サイズ40pxの2倍）
+THUMBNAIL_SIZE = 80
+# プログラム一覧の1ページの既定件数と上限
+PROGRAM_PAGE_SIZE = 100
+MAX_PROGRAM_PAGE_SIZE = 1000
+# 読み込んだテキストファイルのキャッシュ上限（MB）と、行単位の読み込みで一度に返す最大行数
+TEXT_CACHE_MB = int(os.environ.get('AUTONEX_TEXT_CACHE_MB', '64'))
+MAX_READ_LINES = 10000
+# 大量のテキスト入力で1回に貼り付ける文字数の上限
+MAX_TYPE_CHUNK_CHARS = 1000000
+# 全出現位置の検索で返す最大件数
+MAX_FIND_ALL = 500
+# 時間のかかる操作（要素の出現待ち・長押しなど）を並行して実行するジョブの数と、
+# 取り消し要求のあとジョブの終了を確認するまで待つ上限（秒）
+JOB_WORKERS = int(os.environ.get('AUTONEX_JOB_WORKERS', '4'))
+# 実行を待てるジョブの数の上限。あふれたジョブは 503 で断る
+JOB_QUEUE_SIZE = int(os.environ.get('AUTONEX_JOB_QUEUE_SIZE', '64'))
+JOB_CANCEL_WAIT_SECONDS = 1.0
+# 入力操作の待ち行列の上限。あふれた操作は 503 で断る
+INPUT_QUEUE_SIZE = int(os.environ.get('AUTONEX_INPUT_QUEUE_SIZE', '64'))
+# 入力設定のセッションIDを受け取るCookieとヘッダー（APIクライアントはヘッダーで指定できる）
+SESSION_COOKIE = 'autonex_session'
+SESSION_HEADER = 'X-Autonex-Session'
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+# 操作のあとの落ち着き時間の既定の速度プロファイル（safe / normal / fast / max / compat）
+SPEED = os.environ.get('AUTONEX_SPEED', DEFAULT_SPEED)
+# 本番用WSGIサーバー（waitress）のスレッド数。イベントストリームの接続ごとに1スレッド使う
+SERVER_THREADS = int(os.environ.get('AUTONEX_SERVER_THREADS', '16'))
+# 画面キャプチャ方式（auto / pyautogui / x11shm / synthetic）
+CAPTURE_BACKEND = os.environ.get('AUTONEX_CAPTURE_BACKEND', 'auto')
+# 取得した画面を使い回してよい既定の古さ（ミリ秒）。0なら要求ごとに取得する（同時の要求とは共有する）
+FRAME_MAX_AGE_MS = float(os.environ.get('AUTONEX_FRAME_MAX_AGE_MS', '0'))
+# バックグラウンドでの画面取得（要求がある間だけ CAPTURE_HZ 回/秒で取得し、
+# CAPTURE_IDLE_SECONDS 秒要求がなければ止まる）と、保持するフレームの数
+CAPTURE_THREAD = os.environ.get('AUTONEX_CAPTURE_THREAD', '0').lower() in ('1', 'true', 'yes', 'on')
+CAPTURE_HZ = float(os.environ.get('AUTONEX_CAPTURE_HZ', '10'))
+CAPTURE_IDLE_SECONDS = 2.0
+FRAME_BUFFER_SIZE = 4
+# リクエストで指定できる古さの上限（ミリ秒）
+MAX_FRAME_AGE_MS = 10000
+# 入力の記録に使うフック（auto / pynput / synthetic）と、記録中に保持するイベント数の上限
+RECORD_BACKEND = os.environ.get('AUTONEX_RECORD_BACKEND', 'auto')
+RECORD_BUFFER_SIZE = int(os.environ.get('AUTONEX_RECORD_BUFFER_SIZE', '200000'))
 
 # ディレクトリの作成
 if not os.path.exists(SAVE_DIR):
@@ -28,163 +114,236 @@ if not os.path.exists(PROGRAM_DIR):
 if not os.path.exists(IMG_DIR):
     os.makedirs(IMG_DIR)
 
-# 画像管理JSONファイルの初期化
-if not os.path.exists(IMG_JSON):
-    with open(IMG_JSON, 'w', encoding='utf-8') as f:
-        json.dump({'images': []}, f, ensure_ascii=False, indent=2)
+# 画像ライブラリ（images.json は起動時に一度だけ読み込む。存在しない場合は作成）
+image_library = ImageLibrary(IMG_DIR, IMG_JSON)
+# 保存済みプログラムの目録（起動時に目録とファイルの食い違いだけ読み直す）
+program_catalog = ProgramCatalog(PROGRAM_DIR, PROGRAM_CATALOG_JSON)
+compiled_store = CompiledStore(COMPILED_DIR)
+
+text_reader = TextFileReader(TEXT_CACHE_MB * 1024 * 1024)
+template_cache = TemplateCache(image_library.path, TEMPLATE_CACHE_MB * 1024 * 1024)
+location_hints = LocationHints()
+frame_source = create_frame_source(CAPTURE_BACKEND)
+match_executor = ThreadPoolExecutor(max_workers=MATCH_WORKERS, thread_name_prefix='match')
+event_bus = EventBus()
+position_sampler = PositionSampler(event_bus, pyautogui.position, POSITION_SAMPLE_HZ)
+
+def publish_job_event(job, event_type, data):
+    event_bus.publish('job', dict(data, jobId=job.id, type=event_type))
+
+job_manager = JobManager(JOB_WORKERS, listener=publish_job_event, max_pending=JOB_QUEUE_SIZE)
+input_dispatcher = InputDispatcher(INPUT_QUEUE_SIZE)
+input_sessions = SessionRegistry(input_dispatcher, failsafe=pyautogui.FAILSAFE, profile=get_profile(SPEED))
+input_recorder = Recorder(RECORD_BUFFER_SIZE)
+
+def current_session():
+    """リクエスト元の入力設定セッション（ヘッダーまたはCookieのID。なければ新しく作る）"""
+    if 'input_session' not in g:
+        session_id = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+        if session_id and not SESSION_ID_PATTERN.match(session_id):
+            session_id = None
+        g.input_session = input_sessions.get(session_id)
+    return g.input_session
+
+# 計測（GET /api/metrics で Prometheus のテキスト形式で出力する）
+HTTP_SECONDS = metrics.histogram('autonex_http_request_seconds', 'APIリクエストの処理時間', ('endpoint', 'method'))
+HTTP_REQUESTS = metrics.counter('autonex_http_requests_total', 'APIリクエストの数（ステータス別）',
+                                ('endpoint', 'method', 'status'))
+CAPTURE_SECONDS = metrics.histogram('autonex_capture_seconds', 'スクリーンショット1枚の取得時間', ('backend', 'scope'))
+FILE_READ_SECONDS = metrics.histogram('autonex_file_read_seconds', 'テキストファイルの読み込み（文字コード判定を含む）の時間')
+
+def grab_screen(region=None):
+    with CAPTURE_SECONDS.time(backend=frame_source.name, scope='region' if region else 'screen'):
+        return frame_source.grab(region)
+
+# 取得した画面の共有（同時の要求は1回の取得にまとめ、maxFrameAgeMs 以内の画面は使い回す）
+frame_cache = FrameCache(grab_screen, FRAME_BUFFER_SIZE, 1.0 / CAPTURE_HZ, CAPTURE_IDLE_SECONDS, CAPTURE_THREAD)
+
+def collect_runtime_metrics():
+    """入力ディスパッチャ・テンプレートキャッシュなど、その時点の値を計測値として返す"""
+    stats = input_dispatcher.stats()
+    cache = template_cache.stats()
+    text_stats = text_reader.stats()
+    frames = frame_cache.stats()
+    wait_buckets = [('_bucket', [('le', str(bucket['le']))], bucket['count']) for bucket in stats['waitBuckets']]
+    return [
+        ('autonex_input_queue_depth', 'gauge', '入力操作の待ち行列の現在の深さ', [('', [], stats['depth'])]),
+        ('autonex_input_queue_max_depth', 'gauge', '入力操作の待ち行列の最大の深さ', [('', [], stats['maxDepth'])]),
+        ('autonex_input_queue_wait_seconds', 'histogram', '入力操作が実行されるまでの待ち時間',
+         wait_buckets + [('_sum', [], stats['waitSeconds']),
+                         ('_count', [], stats['completed'] + stats['failed'])]),
+        ('autonex_input_actions_total', 'counter', 'ディスパッチャが受け付けた入力操作の数（結果別）',
+         [('', [('result', result)], stats[result])
+          for result in ('completed', 'failed', 'rejected', 'cancelled')]),
+        ('autonex_template_cache_bytes', 'gauge', 'テンプレートキャッシュの使用量', [('', [], cache['bytes'])]),
+        ('autonex_template_cache_requests_total', 'counter', 'テンプレートキャッシュの参照数',
+         [('', [('result', 'hit')], cache['hits']), ('', [('result', 'miss')], cache['misses'])]),
+        ('autonex_text_cache_bytes', 'gauge', '読み込んだテキストファイルのキャッシュの使用量',
+         [('', [], text_stats['bytes'])]),
+        ('autonex_text_cache_requests_total', 'counter', 'テキストファイルのキャッシュの参照数',
+         [('', [('result', 'hit')], text_stats['hits']), ('', [('result', 'miss')], text_stats['misses'])]),
+        ('autonex_frame_cache_requests_total', 'counter', '画面取得の要求数（hit: 保持中のフレーム / shared: 同時の取得を共有 / '
+         'miss: 取得した / direct: 範囲だけを直接取得した）',
+         [('', [('result', result)], frames[key])
+          for result, key in (('hit', 'hits'), ('shared', 'shared'), ('miss', 'misses'), ('direct', 'direct'))]),
+        ('autonex_frame_captures_total', 'counter', '全画面の取得数（取得のきっかけ別）',
+         [('', [('trigger', 'request')], frames['captures']),
+          ('', [('trigger', 'background')], frames['backgroundCaptures'])]),
+        ('autonex_frame_capture_rate', 'gauge', '直近10秒の全画面の取得レート（フレーム/秒）',
+         [('', [], frames['captureRate'])]),
+        ('autonex_frame_cache_hit_ratio', 'gauge', '取得せずに済んだ画面取得の要求の割合',
+         [('', [], frames['hitRatio'])]),
+        ('autonex_event_subscribers', 'gauge', 'イベントストリームの接続数', [('', [], event_bus.subscriber_count())]),
+    ]
+
+metrics.REGISTRY.register_collector(collect_runtime_metrics)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.get('request_start')
+    if start is not None:
+        # パスそのものではなくルートのパターンで集計する（画像名などで系列が増えないように）
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+@app.after_request
+def remember_session(response):
+    session = g.get('input_session')
+    if session is not None and request.cookies.get(SESSION_COOKIE) != session.id:
+        response.set_cookie(SESSION_COOKIE, session.id, httponly=True, samesite='Strict')
+    return response
 
 @app.route('/')
 def index():
+    # 入力設定のセッションを最初に決めておき、以降のAPI呼び出しでCookieを共有する
+    current_session()
     return render_template('index.html')
 
-@app.route('/api/click', methods=['POST'])
-def click():
+def perform_action(name):
+    """リクエストのJSONをパラメータとして入力操作を1つ実行する"""
     try:
-        data = request.get_json()
-        x = data.get('x')
-        y = data.get('y')
-        
-        if x is None or y is None:
-            return jsonify({'error': '座標が指定されていません'}), 400
-        
-        # 座標の妥当性チェック
-        screen_width, screen_height = pyautogui.size()
-        x, y = int(x), int(y)
-        
-        if x < 0 or x >= screen_width or y < 0 or y >= screen_height:
-            return jsonify({'error': f'座標が画面範囲外です。画面サイズ: {screen_width}x{screen_height}'}), 400
-        
-        # フェイルセーフが有効な場合のみ画面の角をチェック
-        if pyautogui.FAILSAFE:
-            corner_margin = 10
-            if ((x < corner_margin and y < corner_margin) or 
-                (x > screen_width - corner_margin and y < corner_margin) or 
-                (x < corner_margin and y > screen_height - corner_margin) or 
-                (x > screen_width - corner_margin and y > screen_height - corner_margin)):
-                return jsonify({'error': f'画面の角から{corner_margin}px以内はフェイルセーフのため使用できません'}), 400
-        
-        pyautogui.click(x=x, y=y)
-        return jsonify({'status': 'success', 'message': f'座標 ({x}, {y}) をクリックしました'})
+        params = request.get_json(silent=True) or {}
+        message = actions.perform(name, params, actions.ActionContext(session=current_session()))
+        return jsonify({'status': 'success', 'message': message})
+    except actions.ActionError as e:
+        return jsonify({'error': str(e)}), 400
+    except InputQueueFull as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/move', methods=['POST'])
-def move():
+def start_job(action, fn):
+    """ジョブを登録してすぐに 202 とジョブIDを返す（実行待ちのジョブが多すぎる場合は 503）"""
     try:
-        data = request.get_json()
-        x = data.get('x')
-        y = data.get('y')
-        
-        if x is None or y is None:
-            return jsonify({'error': '座標が指定されていません'}), 400
-        
-        # 座標の妥当性チェック
-        screen_width, screen_height = pyautogui.size()
-        x, y = int(x), int(y)
-        
-        if x < 0 or x >= screen_width or y < 0 or y >= screen_height:
-            return jsonify({'error': f'座標が画面範囲外です。画面サイズ: {screen_width}x{screen_height}'}), 400
-        
-        # フェイルセーフが有効な場合のみ画面の角をチェック
-        if pyautogui.FAILSAFE:
-            corner_margin = 10
-            if ((x < corner_margin and y < corner_margin) or 
-                (x > screen_width - corner_margin and y < corner_margin) or 
-                (x < corner_margin and y > screen_height - corner_margin) or 
-                (x > screen_width - corner_margin and y > screen_height - corner_margin)):
-                return jsonify({'error': f'画面の角から{corner_margin}px以内はフェイルセーフのため使用できません'}), 400
-        
-        pyautogui.moveTo(x, y)
-        return jsonify({'status': 'success', 'message': f'座標 ({x}, {y}) に移動しました'})
+        job = job_manager.submit(action, fn, current_session())
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    return jsonify({
+        'status': 'accepted',
+        'jobId': job.id,
+        'statusUrl': f'/api/jobs/{job.id}'
+    }), 202
+
+def action_job(name, params):
+    """入力操作を検証し、実行はジョブで行う関数を返す（パラメータが不正な場合は ActionError）"""
+    validated = actions.validate(name, params, actions.ActionContext(session=current_session()))
+    return lambda ctx: {'message': actions.execute(name, validated, ctx)}
+
+def start_action_job(name):
+    """リクエストのJSONをパラメータとして、時間のかかる入力操作をジョブで実行する"""
+    try:
+        params = request.get_json(silent=True) or {}
+        return start_job(name, action_job(name, params))
+    except actions.ActionError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/click', methods=['POST'])
+def click():
+    return perform_action('mouse_click')
+
+@app.route('/api/move', methods=['POST'])
+def move():
+    return perform_action('mouse_move')
+
 @app.route('/api/scroll', methods=['POST'])
 def scroll():
-    try:
-        data = request.get_json()
-        amount = data.get('amount', 3)
-        direction = data.get('direction', 'down')
-        
-        scroll_amount = int(amount) if direction == 'down' else -int(amount)
-        pyautogui.scroll(scroll_amount)
-        
-        return jsonify({'status': 'success', 'message': f'{direction}方向に{amount}スクロールしました'})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    return perform_action('mouse_scroll')
 
 @app.route('/api/keypress', methods=['POST'])
 def keypress():
-    try:
-        data = request.get_json()
-        key = data.get('key')
-        
-        if not key:
-            return jsonify({'error': 'キーが指定されていません'}), 400
-        
-        pyautogui.press(key)
-        return jsonify({'status': 'success', 'message': f'キー「{key}」を押しました'})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    return perform_action('key_press')
 
 @app.route('/api/type', methods=['POST'])
 def type_text():
+    return perform_action('type_text')
+
+@app.route('/api/type-bulk', methods=['POST'])
+def type_text_bulk():
+    """大量のテキスト（またはテキストファイルの内容）を分割して入力する（ジョブで実行）"""
     try:
-        data = request.get_json()
-        text = data.get('text')
-        
-        if not text:
-            return jsonify({'error': 'テキストが指定されていません'}), 400
-        
-        # 日本語を含むかチェック
-        has_multibyte = any(ord(char) > 127 for char in text)
-        
-        # 改行が含まれているかもチェック
-        has_newline = '\n' in text or '\r' in text
-        
-        if has_multibyte or has_newline:
-            # 日本語などのマルチバイト文字または改行が含まれる場合、クリップボード経由で入力
-            import pyperclip
-            
-            # 現在のクリップボードを保存
-            original_clipboard = ''
-            try:
-                original_clipboard = pyperclip.paste()
-            except:
-                pass
-            
-            # テキストをクリップボードにコピー
-            pyperclip.copy(text)
-            
-            # Ctrl+V (Windows/Linux) または Cmd+V (Mac) でペースト
-            import platform
-            if platform.system() == 'Darwin':  # Mac
-                pyautogui.hotkey('command', 'v')
-            else:  # Windows/Linux
-                pyautogui.hotkey('ctrl', 'v')
-            
-            # 少し待機
-            time.sleep(0.1)
-            
-            # クリップボードを元に戻す
-            try:
-                pyperclip.copy(original_clipboard)
-            except:
-                pass
-            
-            # メッセージ用のテキスト（改行を可視化）
-            display_text = text.replace('\n', '\\n').replace('\r', '\\r')
-            if len(display_text) > 50:
-                display_text = display_text[:50] + '...'
-            
-            return jsonify({'status': 'success', 'message': f'テキスト「{display_text}」を入力しました（クリップボード経由）'})
-        else:
-            # ASCII文字のみの場合は通常のtypewriteを使用
-            pyautogui.typewrite(text)
-            return jsonify({'status': 'success', 'message': f'テキスト「{text}」を入力しました'})
+        return start_job('type_text_bulk', type_text_bulk_job(request.get_json(silent=True) or {}))
+    except actions.ActionError as e:
+        return jsonify({'error': str(e)}), 400
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/events', methods=['GET'])
+def event_stream():
+    """マウス位置とプログラム実行の経過を Server-Sent Events で配信する
+
+    マウス位置は変化したときだけ、positionHz 回/秒を上限に最新の位置だけを送る。
+    """
+    position_hz = request.args.get('positionHz', POSITION_STREAM_HZ, type=float)
+    if not position_hz or position_hz <= 0:
+        return jsonify({'error': 'positionHz は正の数で指定してください'}), 400
+    min_interval = 1.0 / min(position_hz, POSITION_SAMPLE_HZ)
+    
+    position_sampler.ensure_started()
+    subscription = event_bus.subscribe()
+    
+    def generate():
+        try:
+            yield 'retry: 2000\n\n'
+            latest = event_bus.latest('position')
+            if latest:
+                yield format_sse(latest)
+            last_sent = time.monotonic()
+            pending = None
+            while True:
+                if pending is None:
+                    timeout = EVENT_HEARTBEAT_SECONDS
+                else:
+                    timeout = max(0.0, last_sent + min_interval - time.monotonic())
+                events = subscription.get(timeout)
+                for event in events:
+                    if event['event'] == 'position':
+                        # 間引き中に届いた位置は最新のものだけを残す
+                        pending = event
+                    else:
+                        yield format_sse(event)
+                if pending is not None and time.monotonic() - last_sent >= min_interval:
+                    yield format_sse(pending)
+                    pending = None
+                    last_sent = time.monotonic()
+                elif not events and pending is None:
+                    # 接続の維持と切断の検出のためのコメント行
+                    yield ': keepalive\n\n'
+        finally:
+            event_bus.unsubscribe(subscription)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/position', methods=['GET'])
 def get_position():
     try:
@@ -196,125 +355,213 @@ def get_position():
 # 新しいマウス操作API
 @app.route('/api/mouse/move-absolute', methods=['POST'])
 def mouse_move_absolute():
-    try:
-        data = request.get_json()
-        x = data.get('x')
-        y = data.get('y')
-        
-        if x is None or y is None:
-            return jsonify({'error': '座標が指定されていません'}), 400
-        
-        # 座標の妥当性チェック
-        screen_width, screen_height = pyautogui.size()
-        x, y = int(x), int(y)
-        
-        if x < 0 or x >= screen_width or y < 0 or y >= screen_height:
-            return jsonify({'error': f'座標が画面範囲外です。画面サイズ: {screen_width}x{screen_height}'}), 400
-        
-        # フェイルセーフが有効な場合のみ画面の角をチェック
-        if pyautogui.FAILSAFE:
-            corner_margin = 10
-            if ((x < corner_margin and y < corner_margin) or 
-                (x > screen_width - corner_margin and y < corner_margin) or 
-                (x < corner_margin and y > screen_height - corner_margin) or 
-                (x > screen_width - corner_margin and y > screen_height - corner_margin)):
-                return jsonify({'error': f'画面の角から{corner_margin}px以内はフェイルセーフのため使用できません'}), 400
-        
-        pyautogui.moveTo(x, y)
-        return jsonify({'status': 'success', 'message': f'絶対座標 ({x}, {y}) に移動しました'})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    return perform_action('mouse_move_absolute')
 
 @app.route('/api/mouse/move-relative', methods=['POST'])
 def mouse_move_relative():
-    try:
-        data = request.get_json()
-        x = data.get('x', 0)
-        y = data.get('y', 0)
-        
-        x, y = int(x), int(y)
-        pyautogui.move(x, y)
-        return jsonify({'status': 'success', 'message': f'相対座標 ({x}, {y}) だけ移動しました'})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    return perform_action('mouse_move_relative')
 
 @app.route('/api/mouse/single-click', methods=['POST'])
 def mouse_single_click():
-    try:
-        data = request.get_json()
-        button = data.get('button', 'left')
-        
-        pyautogui.click(button=button)
-        return jsonify({'status': 'success', 'message': f'{button}ボタンでシングルクリックしました'})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    return perform_action('mouse_single_click')
 
 @app.route('/api/mouse/double-click', methods=['POST'])
 def mouse_double_click():
-    try:
-        data = request.get_json()
-        button = data.get('button', 'left')
-        
-        pyautogui.doubleClick(button=button)
-        return jsonify({'status': 'success', 'message': f'{button}ボタンでダブルクリックしました'})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    return perform_action('mouse_double_click')
 
 @app.route('/api/mouse/triple-click', methods=['POST'])
 def mouse_triple_click():
+    return perform_action('mouse_triple_click')
+
+@app.route('/api/mouse/long-press', methods=['POST'])
+def mouse_long_press():
+    return start_action_job('mouse_long_press')
+
+@app.route('/api/mouse/release', methods=['POST'])
+def mouse_release():
+    return perform_action('mouse_release')
+
+@app.route('/api/mouse/middle-click', methods=['POST'])
+def mouse_middle_click():
+    return perform_action('mouse_middle_click')
+
+# 一括実行API
+MAX_BATCH_ACTIONS = 10000
+
+@app.route('/api/actions/batch', methods=['POST'])
+def run_action_batch():
     try:
-        data = request.get_json()
-        button = data.get('button', 'left')
-        
-        pyautogui.tripleClick(button=button)
-        return jsonify({'status': 'success', 'message': f'{button}ボタンでトリプルクリックしました'})
+        data = request.get_json(silent=True) or {}
+        items = data.get('actions')
+        stop_on_error = data.get('stopOnError', True)
+        
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': '操作の配列が指定されていません'}), 400
+        if len(items) > MAX_BATCH_ACTIONS:
+            return jsonify({'error': f'一度に実行できる操作は{MAX_BATCH_ACTIONS}件までです'}), 400
+        
+        # 画面サイズは1回だけ取得し、全操作を実行前にまとめて検証する
+        ctx = actions.ActionContext(session=current_session())
+        validated = []
+        errors = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                errors.append({'index': index, 'error': '操作はオブジェクトで指定してください'})
+                continue
+            name = item.get('type')
+            try:
+                validated.append((name, actions.validate(name, item, ctx)))
+            except actions.ActionError as e:
+                errors.append({'index': index, 'error': str(e)})
+        
+        if errors:
+            return jsonify({'error': '不正な操作が含まれています', 'errors': errors}), 400
+        
+        # 操作ごとにディスパッチャに渡し、待機や落ち着き時間はこのリクエストのスレッドで待つ
+        # （一連の操作の間もディスパッチャをふさがないので、他のクライアントの操作が間に入ることがある）
+        batch_start = time.perf_counter()
+        results = []
+        failed = False
+        queue_full = None
+        for name, params in validated:
+            if failed and stop_on_error:
+                results.append({'status': 'skipped'})
+                continue
+            
+            action_start = time.perf_counter()
+            try:
+                actions.execute(name, params, ctx)
+                results.append({'status': 'ok', 'ms': round((time.perf_counter() - action_start) * 1000, 3)})
+            except Exception as e:
+                failed = True
+                if isinstance(e, InputQueueFull):
+                    queue_full = e
+                results.append({
+                    'status': 'error',
+                    'error': str(e),
+                    'ms': round((time.perf_counter() - action_start) * 1000, 3)
+                })
+        
+        completed = sum(1 for r in results if r['status'] == 'ok')
+        if queue_full is not None and completed == 0:
+            return jsonify({'error': str(queue_full), 'results': results}), 503
+        
+        # 一部の操作が失敗した場合も、操作ごとの結果を 207 で返す
+        return jsonify({
+            'status': 'error' if failed else 'success',
+            'results': results,
+            'completed': completed,
+            'elapsedMs': round((time.perf_counter() - batch_start) * 1000, 3),
+            'timing': ctx.report.snapshot()
+        }), 207 if failed else 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/mouse/long-press', methods=['POST'])
-def mouse_long_press():
+@app.route('/api/set-failsafe', methods=['POST'])
+def set_failsafe():
     try:
         data = request.get_json()
-        button = data.get('button', 'left')
-        duration = float(data.get('duration', 1))
+        failsafe = bool(data.get('failsafe', True))
         
-        pyautogui.mouseDown(button=button)
-        time.sleep(duration)
-        pyautogui.mouseUp(button=button)
-        return jsonify({'status': 'success', 'message': f'{button}ボタンを{duration}秒長押ししました'})
+        # 他のクライアントには影響しない（このセッションの入力操作にだけ適用）
+        current_session().failsafe = failsafe
+        return jsonify({'status': 'success', 'message': f'フェイルセーフを{"有効" if failsafe else "無効"}にしました'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/mouse/release', methods=['POST'])
-def mouse_release():
+@app.route('/api/session', methods=['GET', 'POST'])
+def input_session_settings():
+    """このセッションの入力設定（failsafe / speed / pause）の取得・変更
+    
+    speed は速度プロファイル名。pause（秒）を指定した場合は、操作によらず一律の待機にする
+    """
     try:
-        data = request.get_json()
-        button = data.get('button', 'left')
+        session = current_session()
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            if data.get('speed') is not None:
+                try:
+                    session.profile = get_profile(data['speed'])
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+            if data.get('pause') is not None:
+                try:
+                    pause = float(data['pause'])
+                except (TypeError, ValueError):
+                    return jsonify({'error': 'pause は数値で指定してください'}), 400
+                if not 0 <= pause <= 5:
+                    return jsonify({'error': 'pause は0～5秒で指定してください'}), 400
+                session.profile = uniform_profile(pause)
+            if 'failsafe' in data:
+                session.failsafe = bool(data['failsafe'])
         
-        pyautogui.mouseUp(button=button)
-        return jsonify({'status': 'success', 'message': f'{button}ボタンをリリースしました'})
+        return jsonify({
+            'status': 'success',
+            'sessionId': session.id,
+            'settings': session.settings(),
+            'speedProfiles': [profile.to_dict() for profile in SPEED_PROFILES.values()]
+        })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/mouse/middle-click', methods=['POST'])
-def mouse_middle_click():
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """計測値を Prometheus のテキスト形式で返す"""
     try:
-        pyautogui.click(button='middle')
-        return jsonify({'status': 'success', 'message': '中クリックしました'})
+        return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/set-failsafe', methods=['POST'])
-def set_failsafe():
+@app.route('/api/input/stats', methods=['GET'])
+def input_stats():
+    """入力ディスパッチャの待ち行列の深さと待ち時間"""
     try:
-        data = request.get_json()
-        failsafe = data.get('failsafe', True)
-        
-        pyautogui.FAILSAFE = failsafe
-        return jsonify({'status': 'success', 'message': f'フェイルセーフを{"有効" if failsafe else "無効"}にしました'})
+        return jsonify({'status': 'success', 'sessions': len(input_sessions), **input_dispatcher.stats()})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def write_program(name, program_data, failsafe_enabled=True, speed=DEFAULT_SPEED):
+    """プログラムを save/program に保存してコンパイルし、(ファイル名, コンパイル結果) を返す
+
+    名前が使えない場合は ValueError を送出する。
+    """
+    # ファイル名の安全性チェック
+    safe_name = "".join(c for c in name if c.isalnum() or c in (' ', '-', '_')).rstrip()
+    if not safe_name:
+        raise ValueError('無効なプログラム名です')
+    
+    file_path = os.path.join(PROGRAM_DIR, f"{safe_name}.json")
+    
+    save_data = {
+        'name': name,
+        'data': program_data,
+        'failsafeEnabled': failsafe_enabled,
+        'speed': speed,
+        'created': datetime.now().isoformat(),
+        'modified': datetime.now().isoformat()
+    }
+    
+    # 既存ファイルの場合は作成日時を保持
+    if os.path.exists(file_path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            old_data = json.load(f)
+            save_data['created'] = old_data.get('created', save_data['created'])
+    
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump(save_data, f, ensure_ascii=False, indent=2)
+    program_catalog.record(safe_name, save_data)
+    
+    # 保存と同時にコンパイルし、存在しない画像や不正な引数をこの時点で知らせる
+    # （保存自体は作りかけのプログラムでも成功させる）
+    try:
+        compiled, _ = compiled_store.get(safe_name, program_data)
+        problems = program_problems(compiled, failsafe_enabled)
+        compile_result = {'instructions': len(compiled['code']), 'sourceHash': compiled['sourceHash'],
+                          'images': compiled['images'], 'problems': problems}
+    except CompileError as e:
+        compile_result = {'error': str(e), 'problems': []}
+    return safe_name, compile_result
+
 @app.route('/api/save', methods=['POST'])
 def save_program():
     try:
@@ -322,35 +569,20 @@ def save_program():
         name = data.get('name')
         program_data = data.get('data')
         failsafe_enabled = data.get('failsafeEnabled', True)
+        speed = data.get('speed') or DEFAULT_SPEED
         
         if not name or not program_data:
             return jsonify({'error': 'プログラム名またはデータが指定されていません'}), 400
+        if speed not in SPEED_PROFILES:
+            return jsonify({'error': f'速度は {", ".join(SPEED_PROFILES)} のいずれかを指定してください'}), 400
         
-        # ファイル名の安全性チェック
-        safe_name = "".join(c for c in name if c.isalnum() or c in (' ', '-', '_')).rstrip()
-        if not safe_name:
-            return jsonify({'error': '無効なプログラム名です'}), 400
-        
-        file_path = os.path.join(PROGRAM_DIR, f"{safe_name}.json")
-        
-        save_data = {
-            'name': name,
-            'data': program_data,
-            'failsafeEnabled': failsafe_enabled,
-            'created': datetime.now().isoformat(),
-            'modified': datetime.now().isoformat()
-        }
-        
-        # 既存ファイルの場合は作成日時を保持
-        if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                old_data = json.load(f)
-                save_data['created'] = old_data.get('created', save_data['created'])
-        
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(save_data, f, ensure_ascii=False, indent=2)
+        try:
+            safe_name, compile_result = write_program(name, program_data, failsafe_enabled, speed)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        return jsonify({'status': 'success', 'message': 'プログラムを保存しました'})
+        return jsonify({'status': 'success', 'message': 'プログラムを保存しました', 'name': safe_name,
+                        'compiled': compile_result})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -369,74 +601,100 @@ def load_program(name):
             'status': 'success',
             'name': data.get('name'),
             'data': data.get('data'),
-            'failsafeEnabled': data.get('failsafeEnabled', True)
+            'failsafeEnabled': data.get('failsafeEnabled', True),
+            'speed': data.get('speed', DEFAULT_SPEED)
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/programs', methods=['GET'])
 def list_programs():
+    """保存済みプログラムの一覧
+    
+    クエリ: q（名前・画像名の部分一致）, image（参照画像で絞り込み）,
+    sort（name / created / modified / blocks / size）, order（asc / desc）, offset, limit
+    programs は名前だけのリスト、items は作成・更新日時やブロック数などを含む目録
+    """
     try:
-        programs = []
-        
-        if os.path.exists(PROGRAM_DIR):
-            for filename in os.listdir(PROGRAM_DIR):
-                if filename.endswith('.json'):
-                    name = filename[:-5]  # .json を除去
-                    programs.append(name)
-        
-        programs.sort()
-        return jsonify({'status': 'success', 'programs': programs})
+        sort = request.args.get('sort', 'name')
+        order = request.args.get('order', 'asc')
+        if sort not in SORT_KEYS:
+            return jsonify({'error': f'sort は {", ".join(SORT_KEYS)} のいずれかを指定してください'}), 400
+        if order not in ('asc', 'desc'):
+            return jsonify({'error': 'order は asc または desc を指定してください'}), 400
+        try:
+            offset = max(0, int(request.args.get('offset', 0)))
+            limit = int(request.args.get('limit', PROGRAM_PAGE_SIZE))
+        except ValueError:
+            return jsonify({'error': 'offset と limit は整数で指定してください'}), 400
+        limit = max(1, min(limit, MAX_PROGRAM_PAGE_SIZE))
+        
+        items, total = program_catalog.query(request.args.get('q', '').strip(), sort, order, offset, limit,
+                                             request.args.get('image') or None)
+        return jsonify({
+            'status': 'success',
+            'programs': [item['name'] for item in items],
+            'items': items,
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+        })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 # ブラウザ制御API
 @app.route('/api/browser/open-url', methods=['POST'])
 def browser_open_url():
-    try:
-        data = request.get_json()
-        url = data.get('url')
-        wait_for_load = data.get('waitForLoad', False)
-        wait_time = data.get('waitTime', 3)  # デフォルト3秒
-        
-        if not url:
-            return jsonify({'error': 'URLが指定されていません'}), 400
-        
-        # URLの妥当性チェック（基本的な形式チェック）
-        if not (url.startswith('http://') or url.startswith('https://') or url.startswith('file://')):
-            # プロトコルが指定されていない場合はhttpsを追加
-            url = 'https://' + url
-        
-        webbrowser.open(url)
-        
-        # ページ読み込み待機が有効な場合
-        if wait_for_load:
-            time.sleep(float(wait_time))
-        
-        return jsonify({'status': 'success', 'message': f'URL「{url}」を開きました{"（" + str(wait_time) + "秒待機）" if wait_for_load else ""}'})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    return start_action_job('browser_open_url')
 
 @app.route('/api/browser/refresh', methods=['POST'])
 def browser_refresh():
+    return perform_action('browser_refresh')
+
+@app.route('/api/browser/wait-for-element', methods=['POST'])
+def wait_for_element():
     try:
-        # F5キーを押してページを更新
-        pyautogui.press('f5')
-        return jsonify({'status': 'success', 'message': 'ページを更新しました'})
+        data = request.get_json(silent=True) or {}
+        return start_job('wait_for_element', wait_for_element_job(data))
+    except actions.ActionError as e:
+        return jsonify({'error': str(e)}), 400
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/browser/wait-for-element', methods=['POST'])
-def wait_for_element():
+def wait_for_element_job(data):
+    """要素の出現待ちのパラメータを検証し、ジョブで実行する関数を返す
+
+    パラメータが不正な場合は ActionError、画像ライブラリに画像がない場合は LookupError を送出する。
+    """
+    image_name = data.get('imageName')  # 画像ライブラリの画像名
+    image_data = data.get('imageData')  # Base64エンコードされた画像データ
+    mode = data.get('mode', MATCH_MODE)
+    use_hint = data.get('useHint', True)
     try:
-        data = request.get_json()
-        image_data = data.get('imageData')  # Base64エンコードされた画像データ
-        timeout = data.get('timeout', 30)  # デフォルト30秒
-        confidence = data.get('confidence', 0.8)  # デフォルト80%
-        
-        if not image_data:
-            return jsonify({'error': '検索する要素の画像データが指定されていません'}), 400
-        
+        timeout = float(data.get('timeout', 30))  # デフォルト30秒
+    except (TypeError, ValueError):
+        raise actions.ActionError('timeout は数値で指定してください')
+    try:
+        region = parse_region(data.get('region'))
+        max_age = parse_max_age(data.get('maxFrameAgeMs'))
+        # 画像ライブラリの画像は画像ごとの色の扱いと信頼度（既定80%）を使う
+        color_mode, confidence = match_settings(image_name, data.get('colorMode'), data.get('confidence'))
+    except ValueError as e:
+        raise actions.ActionError(str(e))
+    
+    if mode not in MATCH_MODES:
+        raise actions.ActionError(f'不明なマッチング方式です: {mode}')
+    
+    entry = None
+    if image_name:
+        # 画像ライブラリの画像はキャッシュ済みのデコード結果を使う
+        entry = load_image_template(image_name)
+        if entry is None:
+            raise LookupError(f'画像「{image_name}」が見つかりません')
+        template_cv, mask = entry.pattern(color_mode)
+    elif image_data:
         # Base64データをデコードして画像に変換
         import base64
         from io import BytesIO
@@ -449,42 +707,162 @@ def wait_for_element():
         image_bytes = base64.b64decode(image_data)
         template_image = Image.open(BytesIO(image_bytes))
         
-        # PILからOpenCV形式に変換
-        template_cv = cv2.cvtColor(np.array(template_image), cv2.COLOR_RGB2BGR)
-        
-        start_time = time.time()
-        
-        while time.time() - start_time < timeout:
-            try:
-                # スクリーンショットを取得
-                screenshot = pyautogui.screenshot()
-                screenshot_cv = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
-                
-                # テンプレートマッチング
-                result = cv2.matchTemplate(screenshot_cv, template_cv, cv2.TM_CCOEFF_NORMED)
-                min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
-                
-                if max_val >= confidence:
-                    # 要素が見つかった
-                    h, w = template_cv.shape[:2]
-                    center_x = max_loc[0] + w // 2
-                    center_y = max_loc[1] + h // 2
-                    
-                    return jsonify({
-                        'status': 'success', 
-                        'message': f'要素が見つかりました（信頼度: {max_val:.2f}）',
-                        'location': {'x': center_x, 'y': center_y},
-                        'confidence': max_val
-                    })
-                
-                time.sleep(0.5)  # 0.5秒間隔でチェック
-                
-            except Exception as e:
-                # スクリーンショットエラーなどは無視して継続
-                continue
-        
-        return jsonify({'error': f'{timeout}秒以内に要素が見つかりませんでした'}), 404
+        # PILからOpenCV形式に変換（masked の場合はアルファチャンネルをマスクにする）
+        mask = None
+        if color_mode == 'masked' and 'A' in template_image.getbands():
+            alpha = np.array(template_image.getchannel('A'))
+            if alpha.min() < 255:
+                mask = alpha.astype(np.float32) / 255.0
+        template_cv = cv2.cvtColor(np.array(template_image.convert('RGB')), cv2.COLOR_RGB2BGR)
+        if color_mode == 'gray':
+            template_cv = cv2.cvtColor(template_cv, cv2.COLOR_BGR2GRAY)
+    else:
+        raise actions.ActionError('検索する要素の画像データが指定されていません')
+    
+    if region is not None:
+        try:
+            region = normalize_region(region, frame_source.size(), template_cv.shape)
+        except ValueError as e:
+            raise actions.ActionError(str(e))
+    
+    hint_key = image_name if entry is not None and use_hint else None
+    
+    def run(ctx):
+        # 画面が変化したときだけテンプレートマッチング（取り消されると ctx で中断される）
+        max_val, location, search, frames = wait_for_template(
+            template_cv, timeout, confidence, mode, entry, region, hint_key, ctx, mask, max_age)
+        ctx.emit('match', imageName=image_name, found=location is not None, confidence=max_val,
+                 location=location, search=search, frames=frames)
+        if location is None:
+            raise JobError(f'{timeout:g}秒以内に要素が見つかりませんでした', {'frames': frames})
+        return {
+            'message': f'要素が見つかりました（信頼度: {max_val:.2f}）',
+            'location': {'x': location['center_x'], 'y': location['center_y']},
+            'confidence': max_val,
+            'colorMode': color_mode,
+            'search': search,
+            'frames': frames
+        }
+    
+    return run
+
+# ジョブAPI
+# 時間のかかる操作はジョブとして実行し、開始・状態・結果・取り消しを別のリクエストで扱う
+def type_text_bulk_job(data):
+    """大量のテキスト入力のパラメータを検証し、ジョブで実行する関数を返す
+
+    text（文字列）か path（テキストファイル）のどちらか一方を指定する。ファイルは chunkSize 文字ずつ
+    読みながら入力するので、内容全体をメモリに読み込まない。ファイルがない場合は LookupError を送出する。
+    """
+    text = data.get('text')
+    file_path = data.get('path')
+    method = data.get('method', 'paste')  # paste: クリップボード経由 / type: キー入力（ASCIIのみ）
+    if (text is None) == (not file_path):
+        raise actions.ActionError('text と path のどちらか一方を指定してください')
+    if method not in ('paste', 'type'):
+        raise actions.ActionError(f'不明な入力方法です: {method}')
+    try:
+        chunk_chars = int(data.get('chunkSize', actions.BULK_CHUNK_CHARS))
+    except (TypeError, ValueError):
+        raise actions.ActionError('chunkSize は整数で指定してください')
+    if not 1 <= chunk_chars <= MAX_TYPE_CHUNK_CHARS:
+        raise actions.ActionError(f'chunkSize は1～{MAX_TYPE_CHUNK_CHARS}で指定してください')
+    
+    if text is not None:
+        text = str(text)
+        if not text:
+            raise actions.ActionError('テキストが指定されていません')
+        
+        def run(ctx):
+            return actions.stream_text(split_text(text, chunk_chars), ctx, method)
+        return run
+    
+    file_path = normalize_file_path(str(file_path))
+    if not os.path.isfile(file_path):
+        raise LookupError(f'ファイルが存在しません: {file_path}')
+    encoding = data.get('encoding')
+    if encoding:
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            raise actions.ActionError(f'不明なエンコーディングです: {encoding}')
+    
+    def run(ctx):
+        # エンコーディングの判定もファイルを少しずつ読んで行う
+        file_encoding = encoding or detect_encoding(file_path)
+        stats = actions.stream_text(iter_text(file_path, file_encoding, chunk_chars), ctx, method)
+        return dict(stats, path=file_path, encoding=file_encoding)
+    return run
+
+JOB_BUILDERS = {
+    'wait_for_element': wait_for_element_job,
+    'type_text_bulk': type_text_bulk_job,
+}
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    try:
+        return jsonify({'status': 'success', 'jobs': job_manager.list()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    try:
+        data = request.get_json(silent=True) or {}
+        action = data.get('action')
+        params = data.get('params') or {}
+        
+        if action in JOB_BUILDERS:
+            return start_job(action, JOB_BUILDERS[action](params))
+        if action in actions.ACTIONS:
+            return start_job(action, action_job(action, params))
+        return jsonify({'error': f'不明な操作です: {action}'}), 400
+    except actions.ActionError as e:
+        return jsonify({'error': str(e)}), 400
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        job = job_manager.get(job_id)
+        if not job:
+            return jsonify({'error': 'ジョブが見つかりません'}), 404
         
+        return jsonify({'status': 'success', 'job': job.snapshot()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    try:
+        job = job_manager.get(job_id)
+        if not job:
+            return jsonify({'error': 'ジョブが見つかりません'}), 404
+        
+        if job.active:
+            # まだ終わっていない（待たずにすぐ返す）
+            return jsonify({'status': job.status, 'jobId': job.id}), 202
+        if job.status != 'completed':
+            return jsonify({'error': job.error, 'status': job.status, 'result': job.result}), 409
+        return jsonify({'status': 'success', 'result': job.result})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    try:
+        job = job_manager.get(job_id)
+        if not job:
+            return jsonify({'error': 'ジョブが見つかりません'}), 404
+        
+        job.cancel()
+        # 待機やマッチングのループは停止イベントですぐに中断されるので、終了を確認してから返す
+        job.wait(JOB_CANCEL_WAIT_SECONDS)
+        return jsonify({'status': 'success', 'job': job.snapshot()})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -504,9 +882,18 @@ def upload_image():
         if not safe_name:
             return jsonify({'error': '無効な名前です'}), 400
         
+        # 同名の画像がある場合は画像をデコードする前に断る
+        if safe_name in image_library:
+            return jsonify({'error': f'名前「{safe_name}」は既に使用されています'}), 400
+        
+        # 照合設定（色の扱い・信頼度）は登録と同時に指定できる
+        try:
+            settings = parse_match_settings(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         # Base64データをデコード
         import base64
-        import uuid
         from io import BytesIO
         from PIL import Image as PILImage
         
@@ -514,38 +901,22 @@ def upload_image():
         if ',' in image_data:
             image_data = image_data.split(',')[1]
         
-        # 一意のファイル名を生成
-        unique_id = str(uuid.uuid4())
-        filename = f"{unique_id}.png"
-        filepath = os.path.join(IMG_DIR, filename)
-        
-        # 画像を保存
+        # PNGに変換（透明度は残す。ファイルへの書き込みは登録と同時に行う）
         image_bytes = base64.b64decode(image_data)
         image = PILImage.open(BytesIO(image_bytes))
-        image.save(filepath, 'PNG')
-        
-        # JSON管理ファイルを更新
-        with open(IMG_JSON, 'r', encoding='utf-8') as f:
-            images_data = json.load(f)
-        
-        # 同名の画像があるかチェック
-        for img in images_data['images']:
-            if img['name'] == safe_name:
-                return jsonify({'error': f'名前「{safe_name}」は既に使用されています'}), 400
-        
-        # 新しい画像を追加
-        new_image = {
-            'id': unique_id,
-            'name': safe_name,
-            'filename': filename,
-            'created': datetime.now().isoformat()
-        }
-        images_data['images'].append(new_image)
+        png = BytesIO()
+        image.save(png, 'PNG')
         
-        with open(IMG_JSON, 'w', encoding='utf-8') as f:
-            json.dump(images_data, f, ensure_ascii=False, indent=2)
+        try:
+            new_image = image_library.add(safe_name, png.getvalue())
+        except DuplicateImageError as e:
+            return jsonify({'error': str(e)}), 400
+        if settings:
+            image_library.update(safe_name, **settings)
         
-        return jsonify({'status': 'success', 'message': f'画像「{safe_name}」を保存しました', 'id': unique_id})
+        template_cache.invalidate(safe_name)
+        location_hints.forget(safe_name)
+        return jsonify({'status': 'success', 'message': f'画像「{safe_name}」を保存しました', 'id': new_image['id']})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -553,10 +924,7 @@ def upload_image():
 @app.route('/api/images/list', methods=['GET'])
 def list_images():
     try:
-        with open(IMG_JSON, 'r', encoding='utf-8') as f:
-            images_data = json.load(f)
-        
-        return jsonify({'status': 'success', 'images': images_data['images']})
+        return jsonify({'status': 'success', 'images': image_library.list()})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -565,129 +933,160 @@ def get_image_by_name(name):
     try:
         import base64
         
-        print(f"[DEBUG] Getting image: {name}")
-        print(f"[DEBUG] IMG_JSON path: {IMG_JSON}")
-        print(f"[DEBUG] IMG_DIR path: {IMG_DIR}")
-        
-        with open(IMG_JSON, 'r', encoding='utf-8') as f:
-            images_data = json.load(f)
-        
-        print(f"[DEBUG] Images data: {images_data}")
-        
-        # 名前で画像を検索
-        for img in images_data['images']:
-            if img['name'] == name:
-                filepath = os.path.join(IMG_DIR, img['filename'])
-                print(f"[DEBUG] Looking for file: {filepath}")
-                print(f"[DEBUG] File exists: {os.path.exists(filepath)}")
-                
-                if os.path.exists(filepath):
-                    # 画像をBase64エンコードして返す
-                    with open(filepath, 'rb') as f:
-                        file_content = f.read()
-                        print(f"[DEBUG] File size: {len(file_content)} bytes")
-                        image_data = base64.b64encode(file_content).decode('utf-8')
-                        print(f"[DEBUG] Base64 length: {len(image_data)}")
-                    
-                    return jsonify({
-                        'status': 'success',
-                        'image': {
-                            'id': img['id'],
-                            'name': img['name'],
-                            'data': f"data:image/png;base64,{image_data}",
-                            'created': img['created']
-                        }
-                    })
-        
-        print(f"[DEBUG] Image not found: {name}")
-        return jsonify({'error': f'画像「{name}」が見つかりません'}), 404
-    except Exception as e:
-        print(f"[DEBUG] Exception in get_image_by_name: {e}")
+        img = image_library.get(name)
+        if img is None:
+            return jsonify({'error': f'画像「{name}」が見つかりません'}), 404
+        
+        filepath = image_library.path(name)
+        if not os.path.exists(filepath):
+            return jsonify({'error': f'画像「{name}」が見つかりません'}), 404
+        
+        # 画像をBase64エンコードして返す（画像の表示には /api/images/file・thumbnail を使う）
+        with open(filepath, 'rb') as f:
+            image_data = base64.b64encode(f.read()).decode('utf-8')
+        
+        return jsonify({
+            'status': 'success',
+            'image': {
+                'id': img['id'],
+                'name': img['name'],
+                'data': f"data:image/png;base64,{image_data}",
+                'created': img['created']
+            }
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def send_image_file(path, record):
+    """PNGファイルをETag・Last-Modified付きで返す（条件付きリクエストには304を返す）"""
+    stat = os.stat(path)
+    etag = f"{record['id']}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    # max_age=0 と no-cache で、ブラウザにはキャッシュを保持したまま毎回再検証させる
+    return send_file(os.path.abspath(path), mimetype='image/png', conditional=True, etag=etag,
+                     last_modified=stat.st_mtime, max_age=0)
+
+@app.route('/api/images/file/<name>', methods=['GET'])
+def get_image_file(name):
+    try:
+        img = image_library.get(name)
+        filepath = image_library.path(name)
+        if img is None or not os.path.exists(filepath):
+            return jsonify({'error': f'画像「{name}」が見つかりません'}), 404
+        return send_image_file(filepath, img)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/images/thumbnail/<name>', methods=['GET'])
+def get_image_thumbnail(name):
+    try:
+        try:
+            size = int(request.args.get('size', THUMBNAIL_SIZE))
+        except ValueError:
+            return jsonify({'error': 'size は数値で指定してください'}), 400
+        if size < 16 or size > 512:
+            return jsonify({'error': 'size は16～512で指定してください'}), 400
+        
+        img = image_library.get(name)
+        try:
+            thumbnail = image_library.thumbnail(name, size)
+        except FileNotFoundError:
+            thumbnail = None
+        if img is None or thumbnail is None:
+            return jsonify({'error': f'画像「{name}」が見つかりません'}), 404
+        return send_image_file(thumbnail, img)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/images/settings/<name>', methods=['POST'])
+def update_image_settings(name):
+    """画像ごとの照合設定（colorMode: color / gray / masked、confidence）を変更する"""
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            settings = parse_match_settings(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if not settings:
+            return jsonify({'error': 'colorMode か confidence を指定してください'}), 400
+        
+        record = image_library.update(name, **settings)
+        if record is None:
+            return jsonify({'error': f'画像「{name}」が見つかりません'}), 404
+        
+        entry = load_image_template(name)
+        has_mask = entry is not None and entry.mask is not None
+        response = {'status': 'success', 'image': record, 'hasMask': has_mask}
+        if record.get('colorMode') == 'masked' and not has_mask:
+            response['warning'] = '画像に透明な部分がないため、color と同じ照合になります'
+        return jsonify(response)
+    except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/images/delete/<name>', methods=['DELETE'])
 def delete_image(name):
     try:
-        with open(IMG_JSON, 'r', encoding='utf-8') as f:
-            images_data = json.load(f)
-        
-        # 名前で画像を検索して削除
-        for i, img in enumerate(images_data['images']):
-            if img['name'] == name:
-                # ファイルを削除
-                filepath = os.path.join(IMG_DIR, img['filename'])
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                
-                # JSONから削除
-                images_data['images'].pop(i)
-                
-                with open(IMG_JSON, 'w', encoding='utf-8') as f:
-                    json.dump(images_data, f, ensure_ascii=False, indent=2)
-                
-                return jsonify({'status': 'success', 'message': f'画像「{name}」を削除しました'})
+        # 索引から削除してから画像ファイルを削除
+        if image_library.remove(name) is None:
+            return jsonify({'error': f'画像「{name}」が見つかりません'}), 404
         
-        return jsonify({'error': f'画像「{name}」が見つかりません'}), 404
+        template_cache.invalidate(name)
+        location_hints.forget(name)
+        return jsonify({'status': 'success', 'message': f'画像「{name}」を削除しました'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def ask_text_file_path():
+    """ファイル選択ダイアログを表示し、選択されたパスを返す（キャンセル時は空文字）"""
+    import tkinter as tk
+    from tkinter import filedialog
+    import platform
+    
+    # tkinterのルートウィンドウを作成（非表示）
+    root = tk.Tk()
+    root.withdraw()
+    
+    # OSに応じた設定
+    if platform.system() == 'Darwin':  # Mac
+        # Macで前面に表示
+        root.lift()
+        root.attributes('-topmost', True)
+        root.update()
+    elif platform.system() == 'Windows':
+        # Windowsで前面に表示
+        root.attributes('-topmost', True)
+        root.update()
+    
+    # ファイルダイアログを表示
+    file_path = filedialog.askopenfilename(
+        title="テキストファイルを選択",
+        filetypes=[
+            ("テキストファイル", "*.txt"),
+            ("CSVファイル", "*.csv"),
+            ("JSONファイル", "*.json"),
+            ("すべてのファイル", "*.*")
+        ],
+        parent=root
+    )
+    
+    # ルートウィンドウを破棄
+    root.destroy()
+    return file_path
+
 @app.route('/api/file/read', methods=['POST'])
 def read_file():
     try:
-        import tkinter as tk
-        from tkinter import filedialog
-        import platform
-        import os
-        
-        # tkinterのルートウィンドウを作成（非表示）
-        root = tk.Tk()
-        root.withdraw()
-        
-        # OSに応じた設定
-        if platform.system() == 'Darwin':  # Mac
-            # Macで前面に表示
-            root.lift()
-            root.attributes('-topmost', True)
-            root.update()
-        elif platform.system() == 'Windows':
-            # Windowsで前面に表示
-            root.attributes('-topmost', True)
-            root.update()
-        
-        # ファイルダイアログを表示
-        file_path = filedialog.askopenfilename(
-            title="テキストファイルを選択",
-            filetypes=[
-                ("テキストファイル", "*.txt"),
-                ("CSVファイル", "*.csv"),
-                ("JSONファイル", "*.json"),
-                ("すべてのファイル", "*.*")
-            ],
-            parent=root
-        )
-        
-        # ルートウィンドウを破棄
-        root.destroy()
+        file_path = ask_text_file_path()
         
         if not file_path:
             return jsonify({'status': 'cancelled', 'message': 'ファイル選択がキャンセルされました'}), 200
         
         # ファイルを読み込む
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-        except UnicodeDecodeError:
-            # UTF-8で読み込めない場合は、システムのデフォルトエンコーディングで試す
-            try:
-                with open(file_path, 'r', encoding='cp932') as f:  # Windows日本語
-                    content = f.read()
-            except:
-                with open(file_path, 'r', encoding='shift_jis') as f:  # 別の日本語エンコーディング
-                    content = f.read()
+        content, encoding = read_text_file(file_path)
         
         return jsonify({
             'status': 'success',
             'content': content,
+            'encoding': encoding,
             'filename': os.path.basename(file_path),
             'path': file_path
         })
@@ -695,6 +1094,30 @@ def read_file():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def normalize_file_path(file_path):
+    """ユーザーホーム・環境変数を展開して絶対パスに変換する"""
+    # ユーザーホームディレクトリの展開
+    if file_path.startswith('~'):
+        file_path = os.path.expanduser(file_path)
+    
+    # 環境変数の展開
+    file_path = os.path.expandvars(file_path)
+    
+    # 絶対パスに変換
+    return os.path.abspath(file_path)
+
+def decode_text_file(file_path):
+    """テキストファイルを読み込む（エンコーディングは自動判定。同じファイルは変更されるまでキャッシュを使う）"""
+    return read_text_file(file_path)[0]
+
+def read_text_file(file_path):
+    """テキストファイルを (内容, エンコーディング) として読み込む"""
+    with FILE_READ_SECONDS.time():
+        try:
+            return text_reader.read(file_path)
+        except OSError:
+            raise ValueError('ファイルを読み込めません')
+
 @app.route('/api/file/read-path', methods=['POST'])
 def read_file_path():
     try:
@@ -704,19 +1127,8 @@ def read_file_path():
         if not file_path:
             return jsonify({'error': 'ファイルパスが指定されていません'}), 400
         
-        import os
-        import platform
-        
         # パスの正規化（OSに応じて）
-        # ユーザーホームディレクトリの展開
-        if file_path.startswith('~'):
-            file_path = os.path.expanduser(file_path)
-        
-        # 環境変数の展開
-        file_path = os.path.expandvars(file_path)
-        
-        # 絶対パスに変換
-        file_path = os.path.abspath(file_path)
+        file_path = normalize_file_path(file_path)
         
         # ファイルの存在確認
         if not os.path.exists(file_path):
@@ -726,38 +1138,15 @@ def read_file_path():
             return jsonify({'error': f'指定されたパスはファイルではありません: {file_path}'}), 400
         
         # ファイルを読み込む
-        content = None
-        encodings = ['utf-8', 'utf-8-sig', 'shift_jis', 'cp932', 'euc-jp', 'iso-2022-jp']
-        
-        # 複数のエンコーディングを試す
-        for encoding in encodings:
-            try:
-                with open(file_path, 'r', encoding=encoding) as f:
-                    content = f.read()
-                break
-            except UnicodeDecodeError:
-                continue
-            except Exception:
-                continue
-        
-        if content is None:
-            # バイナリモードで読み込んでみる
-            try:
-                with open(file_path, 'rb') as f:
-                    raw_content = f.read()
-                    # 自動検出を試みる
-                    import chardet
-                    detected = chardet.detect(raw_content)
-                    if detected['encoding']:
-                        content = raw_content.decode(detected['encoding'])
-                    else:
-                        return jsonify({'error': 'ファイルのエンコーディングを判定できません'}), 500
-            except:
-                return jsonify({'error': 'ファイルを読み込めません'}), 500
+        try:
+            content, encoding = read_text_file(file_path)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 500
         
         return jsonify({
             'status': 'success',
             'content': content,
+            'encoding': encoding,
             'filename': os.path.basename(file_path),
             'path': file_path
         })
@@ -765,62 +1154,357 @@ def read_file_path():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/file/read-lines', methods=['POST'])
+def read_file_lines():
+    """テキストファイルの start 行目（1始まり）から count 行を返す（ファイル全体は読み込まない）"""
+    try:
+        data = request.get_json(silent=True) or {}
+        file_path = data.get('path')
+        if not file_path:
+            return jsonify({'error': 'ファイルパスが指定されていません'}), 400
+        try:
+            start = int(data.get('start', 1))
+            count = int(data.get('count', 100))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'start と count は整数で指定してください'}), 400
+        if start < 1:
+            return jsonify({'error': 'start は1以上で指定してください'}), 400
+        if not 1 <= count <= MAX_READ_LINES:
+            return jsonify({'error': f'count は1～{MAX_READ_LINES}で指定してください'}), 400
+        
+        file_path = normalize_file_path(file_path)
+        if not os.path.isfile(file_path):
+            return jsonify({'error': f'ファイルが存在しません: {file_path}'}), 404
+        
+        with FILE_READ_SECONDS.time():
+            page = text_reader.read_lines(file_path, start, count)
+        return jsonify(dict(page, status='success', filename=os.path.basename(file_path), path=file_path))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def load_image_template(image_name):
+    """画像ライブラリから名前でテンプレート（キャッシュエントリ）を取得する（見つからない場合はNone）"""
+    try:
+        return template_cache.get(image_name)
+    except FileNotFoundError:
+        return None
+
+def match_settings(image_name, color_mode=None, confidence=None):
+    """画像ライブラリの照合設定に、指定された値を優先して (色の扱い, 信頼度) を返す（不正な値は ValueError）"""
+    record = (image_library.get(image_name) if image_name else None) or {}
+    color_mode = color_mode or record.get('colorMode') or DEFAULT_COLOR_MODE
+    if color_mode not in COLOR_MODES:
+        raise ValueError(f'colorMode は {", ".join(COLOR_MODES)} のいずれかを指定してください')
+    if confidence is None:
+        confidence = record.get('confidence')
+    if confidence is None:
+        confidence = DEFAULT_CONFIDENCE
+    try:
+        confidence = float(confidence)
+    except (TypeError, ValueError):
+        raise ValueError('confidence は数値で指定してください')
+    return color_mode, confidence
+
+def parse_match_settings(data):
+    """画像の照合設定（colorMode・confidence）を検証し、画像ライブラリに保存する項目を返す
+
+    confidence に null を指定した場合は画像ごとの設定を消して既定値に戻す。
+    """
+    fields = {}
+    if 'colorMode' in data:
+        if data['colorMode'] not in COLOR_MODES:
+            raise ValueError(f'colorMode は {", ".join(COLOR_MODES)} のいずれかを指定してください')
+        fields['colorMode'] = data['colorMode']
+    if 'confidence' in data:
+        confidence = data['confidence']
+        if confidence is not None:
+            try:
+                confidence = float(confidence)
+            except (TypeError, ValueError):
+                raise ValueError('confidence は数値で指定してください')
+            if not 0 < confidence <= 1:
+                raise ValueError('confidence は0より大きく1以下で指定してください')
+        fields['confidence'] = confidence
+    return fields
+
+def parse_region(value):
+    """リクエストの探索範囲（{x, y, width, height} または [x, y, width, height]）を解釈する"""
+    if value is None:
+        return None
+    try:
+        if isinstance(value, dict):
+            return tuple(int(value[k]) for k in ('x', 'y', 'width', 'height'))
+        if isinstance(value, (list, tuple)) and len(value) == 4:
+            return tuple(int(v) for v in value)
+    except (KeyError, TypeError, ValueError):
+        pass
+    raise ValueError('探索範囲は {x, y, width, height} で指定してください')
+
+def parse_max_age(value):
+    """リクエストの maxFrameAgeMs を秒に変換する（未指定ならNone）"""
+    if value is None:
+        return None
+    try:
+        max_age_ms = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('maxFrameAgeMs は数値で指定してください')
+    if not 0 <= max_age_ms <= MAX_FRAME_AGE_MS:
+        raise ValueError(f'maxFrameAgeMs は0～{MAX_FRAME_AGE_MS}で指定してください')
+    return max_age_ms / 1000
+
+def capture_screen(region=None, max_age=None):
+    """スクリーンショット（範囲指定時はその部分のみ）をOpenCV形式で取得する
+
+    max_age 秒以内に取得した画面があれば取得し直さずに使う（未指定なら FRAME_MAX_AGE_MS）。
+    返す画像は読み取り専用の場合があるため、書き換える場合は copy() すること。
+    """
+    if max_age is None:
+        max_age = FRAME_MAX_AGE_MS / 1000
+    return frame_cache.get(max_age, region)
+
+def locate_template(template, mode=None, entry=None, region=None, confidence=None, hint_key=None, mask=None,
+                    max_age=None):
+    """スクリーンショット上でテンプレートを探し、(最大信頼度, 位置情報, 探索方法) を返す
+
+    hint_key を渡した場合は前回検出位置の周辺だけを先に調べ、信頼度が足りない
+    ときだけ探索範囲（region、未指定なら画面全体）を探す。
+    entry を渡した場合、ピラミッド探索用の縮小テンプレートはキャッシュに保持して再利用する。
+    template と mask は Template.pattern() の戻り値（画像ごとの色の扱いに応じたもの）。
+    max_age は使い回してよい画面の古さ（秒。capture_screen を参照）。
+    """
+    h, w = template.shape[:2]
+    if region is not None:
+        region = normalize_region(region, frame_source.size(), template.shape)
+
+    # 前回検出位置の周辺だけを小さく切り出して確認
+    if hint_key is not None and confidence is not None:
+        hint = location_hints.get(hint_key)
+        window = hint_window(hint, template.shape, frame_source.size(), HINT_MARGIN) if hint else None
+        if window is not None:
+            hint_val, hint_loc = match(capture_screen(window, max_age), template, mask=mask)
+            if hint_val >= confidence:
+                found = (window[0] + hint_loc[0], window[1] + hint_loc[1])
+                location_hints.remember(hint_key, *found)
+                return hint_val, template_location(found, w, h), 'hint'
+
+    screenshot_cv = capture_screen(region, max_age)
+    max_val, max_loc = match_frame(screenshot_cv, template, mode, entry, mask=mask)
+    if region is not None:
+        max_loc = (region[0] + max_loc[0], region[1] + max_loc[1])
+
+    if hint_key is not None and confidence is not None and max_val >= confidence:
+        location_hints.remember(hint_key, *max_loc)
+    return max_val, template_location(max_loc, w, h), 'region' if region else 'screen'
+
+def match_frame(frame, template, mode=None, entry=None, small_screens=None, mask=None):
+    """取得済みの画像上でテンプレートを探し、(最大信頼度, 画像内の左上座標) を返す
+
+    entry を渡した場合、ピラミッド探索用の縮小テンプレート（とマスク）はキャッシュに保持して再利用する。
+    small_screens に (倍率, 次元数) → 縮小済みの画像 の辞書を渡した場合は画像の縮小を省略する
+    （次元数はカラーなら3、グレースケールなら2）。
+    """
+    mode = mode or MATCH_MODE
+    scale = None
+    small_template = None
+    small_mask = None
+    if mode == 'pyramid':
+        scale = pyramid_scale(frame.shape, template.shape)
+        if entry is not None and scale < 1.0:
+            gray = template.ndim == 2
+            small_template = template_cache.derive(
+                entry, ('pyramid', scale, gray), lambda e: downscale(e.gray if gray else e.bgr, scale))
+            if mask is not None:
+                small_mask = template_cache.derive(entry, ('pyramid_mask', scale), lambda e: downscale(e.mask, scale))
+
+    small_screen = small_screens.get((scale, template.ndim)) if small_screens and scale is not None else None
+    return match(frame, template, mode, small_template=small_template, scale=scale, small_screen=small_screen,
+                 mask=mask, small_mask=small_mask)
+
+def locate_in_frame(frame, origin, template, mode=None, entry=None, confidence=None, hint_key=None,
+                    search='screen', small_screens=None, mask=None):
+    """取得済みの画面画像上でテンプレートを探し、(最大信頼度, 位置情報, 探索方法) を返す
+
+    origin は画像の左上の画面座標。hint_key の扱いは locate_template と同じだが、
+    前回検出位置の周辺は新たに取得せず、渡された画像から切り出して調べる。
+    """
+    h, w = template.shape[:2]
+    frame_size = (frame.shape[1], frame.shape[0])
+    if w > frame_size[0] or h > frame_size[1]:
+        raise ValueError('探索範囲が画面外か、画像より小さくなっています')
+
+    if hint_key is not None and confidence is not None:
+        hint = location_hints.get(hint_key)
+        window = hint_window((hint[0] - origin[0], hint[1] - origin[1]), template.shape,
+                             frame_size, HINT_MARGIN) if hint else None
+        if window is not None:
+            x, y, ww, wh = window
+            val, (lx, ly) = match(frame[y:y + wh, x:x + ww], template, mask=mask)
+            if val >= confidence:
+                found = (origin[0] + x + lx, origin[1] + y + ly)
+                location_hints.remember(hint_key, *found)
+                return val, template_location(found, w, h), 'hint'
+
+    val, (lx, ly) = match_frame(frame, template, mode, entry, small_screens, mask)
+    found = (origin[0] + lx, origin[1] + ly)
+    if hint_key is not None and confidence is not None and val >= confidence:
+        location_hints.remember(hint_key, *found)
+    return val, template_location(found, w, h), search
+
+def wait_for_template(template, timeout, confidence, mode=None, entry=None, region=None, hint_key=None, ctx=None,
+                      mask=None, max_age=None):
+    """テンプレートが現れるまで画面を監視し、(最大信頼度, 位置情報, 探索方法, 統計) を返す
+
+    縮小画像で画面の変化を調べ、変化したフレームだけを、変化範囲に重なりうる位置に
+    絞って照合する。変化がない間はポーリング間隔を POLL_INTERVAL_MAX まで徐々に伸ばし、
+    変化を検出したら POLL_INTERVAL_MIN に戻す。見つからなかった場合の位置情報はNone。
+    """
+    ctx = ctx or actions.ActionContext()
+    h, w = template.shape[:2]
+    if region is not None:
+        region = normalize_region(region, frame_source.size(), template.shape)
+    origin = region[:2] if region else (0, 0)
+    search = 'region' if region else 'screen'
+
+    detector = ChangeDetector()
+    stats = {'captured': 0, 'matched': 0, 'partial': 0}
+    start_time = time.monotonic()
+    interval = POLL_INTERVAL_MIN
+    best_val = -1.0
+    hint = location_hints.get(hint_key) if hint_key is not None else None
+
+    def finish(val, top_left, found_by):
+        stats['elapsedMs'] = int((time.monotonic() - start_time) * 1000)
+        if top_left is None:
+            return val, None, found_by, stats
+        found = (origin[0] + top_left[0], origin[1] + top_left[1])
+        if hint_key is not None:
+            location_hints.remember(hint_key, *found)
+        return val, template_location(found, w, h), found_by, stats
+
+    while True:
+        ctx.check()
+        try:
+            frame = capture_screen(region, max_age)
+        except Exception:
+            # スクリーンショットエラーなどは無視して継続
+            frame = None
+
+        if frame is not None:
+            stats['captured'] += 1
+            frame_size = (frame.shape[1], frame.shape[0])
+            changed = detector.update(frame)
+            if changed is None:
+                interval = min(interval * 1.5, POLL_INTERVAL_MAX)
+            else:
+                interval = POLL_INTERVAL_MIN
+
+                # 前回検出位置の周辺を先に確認（初回のみ）
+                if hint is not None:
+                    window = hint_window((hint[0] - origin[0], hint[1] - origin[1]),
+                                         template.shape, frame_size, HINT_MARGIN)
+                    hint = None
+                    if window is not None:
+                        x, y, ww, wh = window
+                        val, (lx, ly) = match(frame[y:y + wh, x:x + ww], template, mask=mask)
+                        if val >= confidence:
+                            stats['matched'] += 1
+                            return finish(val, (x + lx, y + ly), 'hint')
+
+                window = affected_window(changed, template.shape, frame_size)
+                if window is None or window[2:] == frame_size:
+                    window = (0, 0) + frame_size
+                else:
+                    stats['partial'] += 1
+                x, y, ww, wh = window
+                val, (lx, ly) = match_frame(frame[y:y + wh, x:x + ww], template, mode, entry, mask=mask)
+                stats['matched'] += 1
+                best_val = max(best_val, val)
+                if val >= confidence:
+                    return finish(val, (x + lx, y + ly), search)
+
+        remaining = timeout - (time.monotonic() - start_time)
+        if remaining <= 0:
+            return finish(best_val, None, search)
+        ctx.sleep(min(interval, remaining))
+
+def template_location(top_left, w, h):
+    return {
+        'x': top_left[0],
+        'y': top_left[1],
+        'width': w,
+        'height': h,
+        'center_x': top_left[0] + w // 2,
+        'center_y': top_left[1] + h // 2
+    }
+
+def find_all_locations(template, confidence, region=None, order='rows', max_results=MAX_FIND_ALL, overlap=0.3,
+                       mask=None, max_age=None):
+    """1枚のスクリーンショットからテンプレートの出現位置をすべて求め、位置情報のリストを返す"""
+    h, w = template.shape[:2]
+    if region is not None:
+        region = normalize_region(region, frame_source.size(), template.shape)
+    origin = region[:2] if region else (0, 0)
+    
+    found = find_all(capture_screen(region, max_age), template, confidence, max_results, overlap, order, mask)
+    locations = []
+    for score, (x, y) in found:
+        location = template_location((origin[0] + x, origin[1] + y), w, h)
+        location['confidence'] = score
+        locations.append(location)
+    return locations
+
 @app.route('/api/images/find', methods=['POST'])
 def find_image_on_screen():
     try:
         data = request.get_json()
         image_name = data.get('imageName')
-        confidence = data.get('confidence', 0.8)
+        mode = data.get('mode', MATCH_MODE)
+        use_hint = data.get('useHint', True)
         
         if not image_name:
             return jsonify({'error': '画像名が指定されていません'}), 400
         
-        # 画像データを名前で取得
-        with open(IMG_JSON, 'r', encoding='utf-8') as f:
-            images_data = json.load(f)
+        if mode not in MATCH_MODES:
+            return jsonify({'error': f'不明なマッチング方式です: {mode}'}), 400
         
-        # 名前で画像を検索
-        image_info = None
-        for img in images_data['images']:
-            if img['name'] == image_name:
-                image_info = img
-                break
-        
-        if not image_info:
-            return jsonify({'error': f'画像「{image_name}」が見つかりません'}), 404
+        try:
+            region = parse_region(data.get('region'))
+            max_age = parse_max_age(data.get('maxFrameAgeMs'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # 画像ファイルを読み込む
-        filepath = os.path.join(IMG_DIR, image_info['filename'])
-        if not os.path.exists(filepath):
-            return jsonify({'error': f'画像ファイルが存在しません'}), 404
+        # 画像を名前で取得（デコード済みのキャッシュを利用）
+        try:
+            entry = template_cache.get(image_name)
+        except FileNotFoundError:
+            return jsonify({'error': '画像ファイルが存在しません'}), 404
         
-        # OpenCVで画像を読み込む
-        template = cv2.imread(filepath)
+        if entry is None:
+            return jsonify({'error': f'画像「{image_name}」が見つかりません'}), 404
         
-        # スクリーンショットを取得
-        screenshot = pyautogui.screenshot()
-        screenshot_cv = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
+        # 画像ごとの色の扱いと信頼度（リクエストで指定された値を優先）
+        try:
+            color_mode, confidence = match_settings(image_name, data.get('colorMode'), data.get('confidence'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        template, mask = entry.pattern(color_mode)
         
-        # テンプレートマッチング
-        result = cv2.matchTemplate(screenshot_cv, template, cv2.TM_CCOEFF_NORMED)
-        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
+        # スクリーンショット上でテンプレートマッチング（前回位置 → 探索範囲の順）
+        try:
+            max_val, location, search = locate_template(
+                template, mode, entry, region, confidence, image_name if use_hint else None, mask, max_age)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         if max_val >= confidence:
             # 画像が見つかった
-            h, w = template.shape[:2]
-            
             return jsonify({
                 'status': 'success',
                 'message': f'画像「{image_name}」が見つかりました（信頼度: {max_val:.2f}）',
-                'location': {
-                    'x': max_loc[0],
-                    'y': max_loc[1],
-                    'width': w,
-                    'height': h,
-                    'center_x': max_loc[0] + w // 2,
-                    'center_y': max_loc[1] + h // 2
-                },
-                'confidence': max_val
+                'location': location,
+                'confidence': max_val,
+                'colorMode': color_mode,
+                'search': search
             })
         else:
             return jsonify({'error': f'画像「{image_name}」が画面上に見つかりません（最大信頼度: {max_val:.2f}）'}), 404
@@ -828,5 +1512,746 @@ def find_image_on_screen():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/images/find-all', methods=['POST'])
+def find_all_images_on_screen():
+    """画面上のすべての出現位置を、重複を除いて読み順に返す"""
+    try:
+        data = request.get_json()
+        image_name = data.get('imageName')
+        order = data.get('order', 'rows')
+        
+        if not image_name:
+            return jsonify({'error': '画像名が指定されていません'}), 400
+        
+        if order not in READING_ORDERS:
+            return jsonify({'error': f'不明な並び順です: {order}'}), 400
+        
+        try:
+            overlap = float(data.get('overlap', 0.3))
+            max_results = int(data.get('maxResults', MAX_FIND_ALL))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'overlap / maxResults は数値で指定してください'}), 400
+        
+        try:
+            region = parse_region(data.get('region'))
+            max_age = parse_max_age(data.get('maxFrameAgeMs'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if max_results < 1 or max_results > MAX_FIND_ALL:
+            return jsonify({'error': f'maxResults は1～{MAX_FIND_ALL}で指定してください'}), 400
+        
+        try:
+            entry = template_cache.get(image_name)
+        except FileNotFoundError:
+            return jsonify({'error': '画像ファイルが存在しません'}), 404
+        
+        if entry is None:
+            return jsonify({'error': f'画像「{image_name}」が見つかりません'}), 404
+        
+        try:
+            color_mode, confidence = match_settings(image_name, data.get('colorMode'), data.get('confidence'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        template, mask = entry.pattern(color_mode)
+        
+        try:
+            locations = find_all_locations(template, confidence, region, order, max_results, overlap, mask, max_age)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        return jsonify({
+            'status': 'success',
+            'message': f'画像「{image_name}」が{len(locations)}件見つかりました',
+            'count': len(locations),
+            'locations': locations
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/images/find-many', methods=['POST'])
+def find_images_on_screen():
+    """1枚のスクリーンショットで複数の画像を並列に探す
+
+    firstMatch を指定した場合は、リストの先頭に近い画像から見て最初に見つかった
+    画像が確定した時点で、それより後ろの画像の探索を打ち切る。
+    """
+    try:
+        data = request.get_json()
+        image_names = data.get('imageNames')
+        mode = data.get('mode', MATCH_MODE)
+        use_hint = data.get('useHint', True)
+        first_match = bool(data.get('firstMatch', False))
+        
+        if not isinstance(image_names, list) or not image_names:
+            return jsonify({'error': '画像名のリストが指定されていません'}), 400
+        
+        if len(image_names) > MAX_FIND_MANY:
+            return jsonify({'error': f'一度に探せる画像は{MAX_FIND_MANY}個までです'}), 400
+        
+        if mode not in MATCH_MODES:
+            return jsonify({'error': f'不明なマッチング方式です: {mode}'}), 400
+        
+        try:
+            region = parse_region(data.get('region'))
+            max_age = parse_max_age(data.get('maxFrameAgeMs'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # 画像を名前で取得（デコード済みのキャッシュを利用）
+        entries = []
+        for image_name in image_names:
+            try:
+                entry = template_cache.get(image_name)
+            except FileNotFoundError:
+                return jsonify({'error': f'画像「{image_name}」のファイルが存在しません'}), 404
+            if entry is None:
+                return jsonify({'error': f'画像「{image_name}」が見つかりません'}), 404
+            entries.append(entry)
+        
+        # 画像ごとの色の扱いと信頼度（リクエストで指定された値を全画像に優先して使う）
+        settings = []
+        for entry in entries:
+            try:
+                color_mode, confidence = match_settings(entry.name, data.get('colorMode'), data.get('confidence'))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            settings.append((color_mode, confidence) + entry.pattern(color_mode))
+        
+        if region is not None:
+            try:
+                region = normalize_region(region, frame_source.size(), (1, 1))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        
+        # スクリーンショットは全画像で共有する（グレースケールの画面も1回だけ作る）
+        start_time = time.perf_counter()
+        frame = capture_screen(region, max_age)
+        origin = region[:2] if region else (0, 0)
+        capture_ms = round((time.perf_counter() - start_time) * 1000, 2)
+        frames = {3: frame}
+        if any(template.ndim == 2 for _, _, template, _ in settings):
+            frames[2] = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        
+        # ピラミッド探索の縮小画面も倍率・色ごとに1回だけ作る
+        small_screens = {}
+        if mode == 'pyramid':
+            for _, _, template, _ in settings:
+                key = (pyramid_scale(frame.shape, template.shape), template.ndim)
+                if key[0] < 1.0 and key not in small_screens:
+                    small_screens[key] = downscale(frames[template.ndim], key[0])
+        
+        def find_one(index):
+            entry = entries[index]
+            color_mode, confidence, template, mask = settings[index]
+            started = time.perf_counter()
+            try:
+                max_val, location, search = locate_in_frame(
+                    frames[template.ndim], origin, template, mode, entry, confidence,
+                    entry.name if use_hint else None, 'region' if region else 'screen', small_screens, mask)
+            except ValueError as e:
+                return {'imageName': entry.name, 'status': 'error', 'error': str(e)}
+            result = {
+                'imageName': entry.name,
+                'status': 'found' if max_val >= confidence else 'not_found',
+                'confidence': max_val,
+                'colorMode': color_mode,
+                'search': search,
+                'ms': round((time.perf_counter() - started) * 1000, 2)
+            }
+            if max_val >= confidence:
+                result['location'] = location
+            return result
+        
+        futures = {match_executor.submit(find_one, index): index for index in range(len(entries))}
+        results = [None] * len(entries)
+        winner = None
+        for future in as_completed(futures):
+            index = futures[future]
+            if future.cancelled():
+                continue
+            results[index] = future.result()
+            if first_match and results[index]['status'] == 'found' and (winner is None or index < winner):
+                winner = index
+                for other, other_index in futures.items():
+                    if other_index > winner:
+                        other.cancel()
+            # 先頭側の結果がすべて揃えば、後ろの画像の結果を待たずに返す
+            if winner is not None and all(result is not None for result in results[:winner]):
+                break
+        
+        for index, entry in enumerate(entries):
+            if results[index] is None:
+                results[index] = {'imageName': entry.name, 'status': 'skipped'}
+        
+        matched = [result['imageName'] for result in results if result['status'] == 'found']
+        return jsonify({
+            'status': 'success',
+            'match': matched[0] if matched else None,
+            'results': results,
+            'captureMs': capture_ms,
+            'elapsedMs': round((time.perf_counter() - start_time) * 1000, 2)
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/images/cache', methods=['GET'])
+def image_cache_stats():
+    try:
+        return jsonify({'status': 'success', 'cache': template_cache.stats()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/capture', methods=['GET'])
+def capture_info():
+    try:
+        width, height = frame_source.size()
+        return jsonify({
+            'status': 'success',
+            'backend': frame_source.name,
+            'width': width,
+            'height': height,
+            'maxFrameAgeMs': FRAME_MAX_AGE_MS,
+            'frameCache': frame_cache.stats()
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# サーバー側プログラム実行
+def run_mouse_move_to_image(params, ctx):
+    image_name = params.get('imageName')
+    if not image_name:
+        raise actions.ActionError('画像名が指定されていません')
+    
+    entry = load_image_template(image_name)
+    if entry is None:
+        raise actions.ActionError(f'画像「{image_name}」が見つかりません')
+    
+    color_mode, confidence = match_settings(image_name)
+    template, mask = entry.pattern(color_mode)
+    max_val, location, search = locate_template(template, entry=entry, confidence=confidence, hint_key=image_name,
+                                                mask=mask)
+    ctx.emit('match', imageName=image_name, found=max_val >= confidence, confidence=max_val,
+             location=location, search=search)
+    if max_val < confidence:
+        raise actions.ActionError(f'画像「{image_name}」が画面上に見つかりません（最大信頼度: {max_val:.2f}）')
+    
+    if params.get('position', 'center') == 'center':
+        target = {'x': location['center_x'], 'y': location['center_y']}
+    else:
+        target = {'x': location['x'], 'y': location['y']}
+    actions.perform('mouse_move', target, ctx)
+    return f'画像「{image_name}」へ移動しました: ({target["x"]}, {target["y"]})'
+
+def run_find_all_images(params, ctx):
+    image_name = params.get('imageName')
+    confidence = float(params.get('confidence', 80)) / 100  # パーセントから小数に変換
+    order = params.get('order', 'rows')
+    
+    if not image_name:
+        raise actions.ActionError('画像名が指定されていません')
+    if order not in READING_ORDERS:
+        raise actions.ActionError(f'不明な並び順です: {order}')
+    
+    entry = load_image_template(image_name)
+    if entry is None:
+        raise actions.ActionError(f'画像「{image_name}」が見つかりません')
+    
+    template, mask = entry.pattern(match_settings(image_name)[0])
+    locations = find_all_locations(template, confidence, order=order, mask=mask)
+    ctx.emit('match', imageName=image_name, found=bool(locations), count=len(locations), locations=locations)
+    return locations
+
+def run_wait_for_element(params, ctx):
+    image_name = params.get('imageName')
+    timeout = float(params.get('timeout', 30))
+    confidence = float(params.get('confidence', 80)) / 100  # パーセントから小数に変換
+    
+    if not image_name:
+        raise actions.ActionError('画像名が指定されていません')
+    
+    entry = load_image_template(image_name)
+    if entry is None:
+        raise actions.ActionError(f'画像「{image_name}」が見つかりません')
+    
+    template, mask = entry.pattern(match_settings(image_name)[0])
+    max_val, location, search, frames = wait_for_template(
+        template, timeout, confidence, entry=entry, hint_key=image_name, ctx=ctx, mask=mask)
+    ctx.emit('match', imageName=image_name, found=location is not None, confidence=max_val,
+             location=location, search=search, frames=frames)
+    if location is not None:
+        return (f'要素が見つかりました: ({location["center_x"]}, {location["center_y"]})（信頼度: {max_val:.2f}、'
+                f'取得{frames["captured"]}枚・照合{frames["matched"]}回）')
+    
+    raise actions.ActionError(f'{timeout:g}秒以内に要素が見つかりませんでした')
+
+def run_file_read_text(params, ctx):
+    file_path = ask_text_file_path()
+    if not file_path:
+        return ''
+    return decode_text_file(file_path)
+
+def run_file_read_path(params, ctx):
+    file_path = params.get('path')
+    if not file_path:
+        raise actions.ActionError('ファイルパスが指定されていません')
+    
+    file_path = normalize_file_path(str(file_path))
+    if not os.path.isfile(file_path):
+        raise actions.ActionError(f'ファイルが存在しません: {file_path}')
+    return decode_text_file(file_path)
+
+def run_file_read_lines(params, ctx):
+    file_path = params.get('path')
+    if not file_path:
+        raise actions.ActionError('ファイルパスが指定されていません')
+    try:
+        start = int(float(params.get('start', 1)))
+        count = int(float(params.get('count', 1)))
+    except (TypeError, ValueError):
+        raise actions.ActionError('行番号と行数は数値で指定してください')
+    if start < 1 or not 1 <= count <= MAX_READ_LINES:
+        raise actions.ActionError(f'行番号は1以上、行数は1～{MAX_READ_LINES}で指定してください')
+    
+    file_path = normalize_file_path(str(file_path))
+    if not os.path.isfile(file_path):
+        raise actions.ActionError(f'ファイルが存在しません: {file_path}')
+    # 指定した範囲の行だけを読み、改行でつないで返す（ファイルの終わりを過ぎた場合は空文字列）
+    with FILE_READ_SECONDS.time():
+        return '\n'.join(text_reader.read_lines(file_path, start, count)['lines'])
+
+PROGRAM_HANDLERS = actions.handlers()
+PROGRAM_HANDLERS.update({
+    'mouse_move_to_image': run_mouse_move_to_image,
+    'wait_for_element': run_wait_for_element,
+    'find_all_images': run_find_all_images,
+    'file_read_text': run_file_read_text,
+    'file_read_path': run_file_read_path,
+    'file_read_lines': run_file_read_lines,
+})
+
+def check_program_step(action, values, ctx):
+    """引数が定数の操作1件を、実行時と同じ規則で検証する（不正なら ActionError）"""
+    if action in actions.ACTIONS:
+        actions.validate(action, values, ctx)
+        return
+    if 'imageName' in values:
+        image_name = values['imageName']
+        if not image_name:
+            raise actions.ActionError('画像名が指定されていません')
+        if image_name not in image_library:
+            raise actions.ActionError(f'画像「{image_name}」が見つかりません')
+    if 'order' in values and values['order'] not in READING_ORDERS:
+        raise actions.ActionError(f'不明な並び順です: {values["order"]}')
+    for name in ('timeout', 'confidence'):
+        if name in values:
+            try:
+                value = float(values[name])
+            except (TypeError, ValueError):
+                raise actions.ActionError(f'{name} は数値で指定してください')
+            if value < 0 or (name == 'confidence' and value > 100):
+                raise actions.ActionError(f'{name} の値が範囲外です: {values[name]}')
+    if action in ('file_read_path', 'file_read_lines') and not values.get('path'):
+        raise actions.ActionError('ファイルパスが指定されていません')
+    if action == 'file_read_lines':
+        try:
+            start, count = int(float(values.get('start', 1))), int(float(values.get('count', 1)))
+        except (TypeError, ValueError):
+            raise actions.ActionError('行番号と行数は数値で指定してください')
+        if start < 1 or not 1 <= count <= MAX_READ_LINES:
+            raise actions.ActionError(f'行番号は1以上、行数は1～{MAX_READ_LINES}で指定してください')
+
+def program_problems(compiled, failsafe_enabled):
+    """コンパイル結果のうち、実行すると失敗することが分かっている操作の一覧"""
+    ctx = actions.ActionContext(session=current_session().derive(failsafe=bool(failsafe_enabled)))
+    return find_problems(compiled['code'], lambda action, values: check_program_step(action, values, ctx))
+
+def publish_run_event(run, event_type, data):
+    event_bus.publish('run', dict(data, runId=run.id, type=event_type))
+
+run_manager = RunManager(listener=publish_run_event)
+
+def prepare_saved_program(name):
+    """保存済みプログラムを実行用に準備し、(命令列, 入力セッション, キャッシュを使ったか, 問題の一覧) を返す
+
+    プログラムがない場合は LookupError、コンパイルできない場合は CompileError、
+    速度の指定が不正な場合は ValueError を送出する。
+    """
+    file_path = os.path.join(PROGRAM_DIR, f"{name}.json")
+    if not os.path.exists(file_path):
+        raise LookupError('プログラムが見つかりません')
+    
+    with open(file_path, 'r', encoding='utf-8') as f:
+        program = json.load(f)
+    
+    # 保存時のコンパイル結果を使う（保存データが変わっていればコンパイルし直す）
+    compiled, cached = compiled_store.get(name, program.get('data'))
+    
+    # 途中で失敗しないよう、画像の有無と定数の引数を実行前に確かめる
+    failsafe_enabled = bool(program.get('failsafeEnabled', True))
+    problems = program_problems(compiled, failsafe_enabled)
+    
+    # プログラムごとのフェイルセーフ・速度設定を反映（この実行の入力操作にだけ適用）
+    session = program_session(failsafe_enabled, program.get('speed'))
+    return compiled['code'], session, cached, problems
+
+def program_session(failsafe_enabled, speed=None):
+    """プログラムの実行に使う入力セッション（フェイルセーフ・速度はこの実行にだけ適用）"""
+    profile = get_profile(speed) if speed else None
+    return current_session().derive(failsafe=failsafe_enabled, profile=profile)
+
+def start_program_run(name, code, session, problems, **extra):
+    """実行前の検査結果を確かめてプログラムの実行を始め、応答を返す"""
+    if problems:
+        return jsonify({'error': f'プログラムに問題があります: {problems[0]["error"]}', 'problems': problems}), 400
+    
+    if batch_manager.active():
+        return jsonify({'error': 'バッチ実行中です'}), 409
+    try:
+        run = run_manager.start(name, code, PROGRAM_HANDLERS, session)
+    except CompileError as e:
+        return jsonify({'error': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    
+    return jsonify(dict({
+        'status': 'success',
+        'message': f'プログラム「{name}」の実行を開始しました',
+        'runId': run.id,
+        'instructions': len(code)
+    }, **extra))
+
+@app.route('/api/run/<name>', methods=['POST'])
+def run_saved_program(name):
+    try:
+        try:
+            code, session, cached, problems = prepare_saved_program(name)
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 404
+        except (CompileError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        return start_program_run(name, code, session, problems, cached=cached)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/run', methods=['POST'])
+def run_workspace():
+    """送られたワークスペース（data）を保存せずに実行する（保存済みのプログラムは変更しない）"""
+    try:
+        data = request.get_json(silent=True) or {}
+        if not data.get('data'):
+            return jsonify({'error': 'プログラムデータがありません'}), 400
+        name = (data.get('name') or '').strip() or '（未保存）'
+        failsafe_enabled = bool(data.get('failsafeEnabled', True))
+        try:
+            code = fold_constants(compile_program(data['data']))
+            session = program_session(failsafe_enabled, data.get('speed'))
+        except (CompileError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        problems = program_problems({'code': code}, failsafe_enabled)
+        return start_program_run(name, code, session, problems, cached=False)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/runs', methods=['GET'])
+def list_runs():
+    try:
+        active = run_manager.active()
+        return jsonify({
+            'status': 'success',
+            'active': active.id if active else None,
+            'runs': run_manager.list()
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/runs/<run_id>', methods=['GET'])
+def get_run(run_id):
+    try:
+        run = run_manager.get(run_id)
+        if not run:
+            return jsonify({'error': '実行が見つかりません'}), 404
+        
+        since = request.args.get('since', 0, type=int)
+        return jsonify({'status': 'success', 'run': run.snapshot(since)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/runs/<run_id>/stop', methods=['POST'])
+def stop_run(run_id):
+    try:
+        run = run_manager.get(run_id)
+        if not run:
+            return jsonify({'error': '実行が見つかりません'}), 404
+        
+        run.stop()
+        return jsonify({'status': 'success', 'message': 'プログラムの停止を要求しました'})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def publish_batch_event(batch, event_type, data):
+    event_bus.publish('batch', dict(data, batchId=batch.id, type=event_type))
+
+batch_manager = BatchManager(BATCH_DIR, listener=publish_batch_event)
+
+def batch_row_starter(name):
+    """バッチの1行ごとにプログラムの実行を開始する関数を返す（開始前に問題がないか確かめる）"""
+    code, session, _, problems = prepare_saved_program(name)
+    if problems:
+        raise actions.ActionError(f'プログラムに問題があります: {problems[0]["error"]}')
+    
+    def start_row(variables):
+        return run_manager.start(name, code, PROGRAM_HANDLERS, session, variables=variables)
+    return start_row
+
+@app.route('/api/batches', methods=['POST'])
+def create_batch():
+    """保存済みプログラムをCSV/TSVファイルの1行ごとに実行するバッチを開始する"""
+    try:
+        data = request.get_json(silent=True) or {}
+        name = data.get('program')
+        file_path = data.get('path')
+        if not name or not file_path:
+            return jsonify({'error': 'program と path を指定してください'}), 400
+        file_path = normalize_file_path(str(file_path))
+        if not os.path.isfile(file_path):
+            return jsonify({'error': f'ファイルが存在しません: {file_path}'}), 404
+        on_error = data.get('onError', 'stop')
+        if on_error not in ON_ERROR:
+            return jsonify({'error': f'onError は {", ".join(ON_ERROR)} のいずれかを指定してください'}), 400
+        encoding = data.get('encoding')
+        if encoding:
+            try:
+                codecs.lookup(encoding)
+            except LookupError:
+                return jsonify({'error': f'不明なエンコーディングです: {encoding}'}), 400
+        
+        try:
+            start_row = batch_row_starter(name)
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 404
+        except (CompileError, ValueError, actions.ActionError) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if run_manager.active():
+            return jsonify({'error': '別のプログラムが実行中です'}), 409
+        try:
+            batch = batch_manager.create(name, file_path, start_row, delimiter=data.get('delimiter'),
+                                         header=data.get('header', True), on_error=on_error,
+                                         row_variable=data.get('rowVariable'), encoding=encoding)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 409
+        
+        return jsonify({
+            'status': 'accepted',
+            'batchId': batch.id,
+            'encoding': batch.state['encoding'],
+            'statusUrl': f'/api/batches/{batch.id}'
+        }), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/batches', methods=['GET'])
+def list_batches():
+    try:
+        active = batch_manager.active()
+        return jsonify({
+            'status': 'success',
+            'active': active.id if active else None,
+            'batches': batch_manager.list()
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    try:
+        batch = batch_manager.get(batch_id)
+        if not batch:
+            return jsonify({'error': 'バッチが見つかりません'}), 404
+        return jsonify({'status': 'success', 'batch': batch.snapshot()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/batches/<batch_id>/rows', methods=['GET'])
+def get_batch_rows(batch_id):
+    """行ごとの記録（status で絞り込み、offset / limit でページ分け）"""
+    try:
+        batch = batch_manager.get(batch_id)
+        if not batch:
+            return jsonify({'error': 'バッチが見つかりません'}), 404
+        
+        status = request.args.get('status')
+        offset = request.args.get('offset', 0, type=int)
+        limit = request.args.get('limit', PROGRAM_PAGE_SIZE, type=int)
+        if offset < 0 or not 1 <= limit <= MAX_PROGRAM_PAGE_SIZE:
+            return jsonify({'error': f'offset は0以上、limit は1～{MAX_PROGRAM_PAGE_SIZE}で指定してください'}), 400
+        
+        rows = []
+        total = 0
+        for record in batch.checkpoint.records():
+            if status and record.get('status') != status:
+                continue
+            if offset <= total < offset + limit:
+                rows.append(record)
+            total += 1
+        return jsonify({'status': 'success', 'rows': rows, 'total': total, 'offset': offset, 'limit': limit})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/batches/<batch_id>/stop', methods=['POST'])
+def stop_batch(batch_id):
+    try:
+        batch = batch_manager.get(batch_id)
+        if not batch:
+            return jsonify({'error': 'バッチが見つかりません'}), 404
+        
+        batch.stop()
+        return jsonify({'status': 'success', 'message': 'バッチの停止を要求しました'})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/batches/<batch_id>/resume', methods=['POST'])
+def resume_batch(batch_id):
+    """完了済みの行を飛ばして、停止・失敗・中断したバッチを続きから実行する"""
+    try:
+        data = request.get_json(silent=True) or {}
+        batch = batch_manager.get(batch_id)
+        if not batch:
+            return jsonify({'error': 'バッチが見つかりません'}), 404
+        
+        try:
+            start_row = batch_row_starter(batch.state['program'])
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 404
+        except (CompileError, ValueError, actions.ActionError) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if run_manager.active():
+            return jsonify({'error': '別のプログラムが実行中です'}), 409
+        try:
+            batch_manager.resume(batch_id, start_row, force=bool(data.get('force')))
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 404
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 409
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 409
+        
+        return jsonify({
+            'status': 'accepted',
+            'batchId': batch.id,
+            'completedRows': batch.completed_rows,
+            'statusUrl': f'/api/batches/{batch.id}'
+        }), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# 入力の記録
+# マウス・キーボードの操作を記録し、終了時にブロックのプログラムに変換する
+@app.route('/api/record/start', methods=['POST'])
+def start_recording():
+    try:
+        data = request.get_json(silent=True) or {}
+        if RECORD_BACKEND not in RECORD_BACKENDS:
+            return jsonify({'error': f'不明な記録方式です: {RECORD_BACKEND}'}), 500
+        if input_recorder.active():
+            return jsonify({'error': 'すでに記録中です'}), 409
+        
+        # synthetic の場合はリクエストで渡されたイベント列を記録する（テスト用）
+        try:
+            source = create_event_source(RECORD_BACKEND, data.get('events') or ())
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        try:
+            input_recorder.start(source)
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 409
+        return jsonify({'status': 'success', 'message': '記録を開始しました', 'backend': source.name})
+    except RuntimeError as e:
+        # pynput がない環境など
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/record', methods=['GET'])
+def recording_status():
+    try:
+        return jsonify({'status': 'success', **input_recorder.status()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/record/stop', methods=['POST'])
+def stop_recording():
+    """記録を終えてブロックに変換する（name を指定した場合はプログラムとして保存する）"""
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            epsilon = float(data.get('epsilon', 5))
+            idle = float(data.get('idleSeconds', 0.3))
+            trim = float(data.get('trimEndSeconds', 0))
+            max_wait = data.get('maxWaitSeconds')
+            max_wait = float(max_wait) if max_wait is not None else None
+        except (TypeError, ValueError):
+            return jsonify({'error': 'epsilon / idleSeconds / trimEndSeconds / maxWaitSeconds は数値で指定してください'}), 400
+        if epsilon < 0 or idle <= 0 or trim < 0 or (max_wait is not None and max_wait < 0):
+            return jsonify({'error': 'epsilon / trimEndSeconds / maxWaitSeconds は0以上、idleSeconds は0より大きい値を指定してください'}), 400
+        speed = data.get('speed') or DEFAULT_SPEED
+        if speed not in SPEED_PROFILES:
+            return jsonify({'error': f'速度は {", ".join(SPEED_PROFILES)} のいずれかを指定してください'}), 400
+        
+        try:
+            events, recorded = input_recorder.stop()
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 409
+        
+        # 記録を止めるための操作（停止ボタンのクリックなど）を末尾から除く
+        if trim and events:
+            end = events[-1][1] - trim
+            events = [event for event in events if event[1] < end]
+        
+        blocks, warnings, summary = build_steps(events, epsilon, idle, bool(data.get('paths', True)), max_wait)
+        workspace = to_workspace(blocks)
+        response = {
+            'status': 'success',
+            'message': f'{len(events)}件のイベントを{len(blocks)}個のブロックに変換しました',
+            'recording': recorded,
+            'summary': summary,
+            'warnings': warnings,
+            'data': json.dumps(workspace, ensure_ascii=False)
+        }
+        
+        name = data.get('name')
+        if name and blocks:
+            try:
+                safe_name, compile_result = write_program(str(name), response['data'],
+                                                          data.get('failsafeEnabled', True), speed)
+            except ValueError as e:
+                return jsonify(dict(response, error=str(e))), 400
+            response.update(name=safe_name, compiled=compile_result, message=response['message'] + '（保存しました）')
+        return jsonify(response)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # 入力操作はディスパッチャが1件ずつ実行するので、複数スレッドでリクエストを受けても操作は混ざらない
+    try:
+        if os.environ.get('AUTONEX_DEBUG'):
+            app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
+        else:
+            try:
+                from waitress import serve
+            except ImportError:
+                print('waitress がインストールされていないため、Flaskの開発用サーバーで起動します')
+                app.run(host='0.0.0.0', port=5000, threaded=True)
+            else:
+                serve(app, host='0.0.0.0', port=5000, threads=SERVER_THREADS)
+    finally:
+        # 実行中・待機中のジョブを取り消す（プロセスの終了がワーカーの終了待ちで止まらないように）
+        job_manager.cancel_all()
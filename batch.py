@@ -0,0 +1,455 @@
+"""CSV/TSV の行ごとのプログラム実行（バッチ）
+
+保存済みプログラムをCSV/TSVファイルの1行ごとに1回ずつ実行する。ファイルは
+textfile と同じ方法でエンコーディングを判定し、csv モジュールで1行ずつ読むので
+全体をメモリに載せない。各行の値は見出しの列名と同じ名前の変数に入れて実行する。
+
+行の結果（状態・所要時間・実行ID）は1行ごとに記録ファイル（JSON Lines）へ追記して
+fsync するので、途中で停止・異常終了しても、再開すると完了済みの行を飛ばして続きから実行する。
+失敗・停止した行は完了扱いにしないため、再開時にもう一度実行される。
+
+    save/batches/<batchId>.json        バッチの設定と状態
+    save/batches/<batchId>.rows.jsonl  行ごとの結果（同じ行は後の記録が優先）
+"""
+import codecs
+import csv
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime
+
+import metrics
+from library import atomic_write
+from textfile import detect_encoding
+
+BATCH_ROWS = metrics.counter('autonex_batch_rows_total', 'バッチで実行した行の数（結果別）', ('status',))
+
+# 行でエラーが起きたときの動作（stop: バッチを止める / continue: 記録して次の行へ）
+ON_ERROR = ('stop', 'continue')
+# 区切り文字の別名
+DELIMITERS = {'csv': ',', 'tsv': '\t', 'tab': '\t'}
+# スループット（行/秒）の計算に使う直近の行数
+RATE_WINDOW = 50
+# 行の実行が終わったかを確かめる間隔（秒）
+POLL_SECONDS = 0.05
+
+_BATCH_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def resolve_delimiter(path, delimiter=None):
+    """区切り文字を返す（省略時は拡張子が .tsv / .tab ならタブ、それ以外はカンマ）"""
+    if not delimiter:
+        return '\t' if os.path.splitext(path)[1].lower() in ('.tsv', '.tab') else ','
+    delimiter = DELIMITERS.get(delimiter, delimiter)
+    if len(delimiter) != 1:
+        raise ValueError('区切り文字は1文字（または csv / tsv）で指定してください')
+    return delimiter
+
+
+class _CountingLines:
+    """テキストの行をそのまま返し、元のファイルで何バイト読んだかを offset に数える（csv.reader に渡す）
+
+    行を同じ文字コードで符号化し直して長さを数える。状態を持つエンコーダなので BOM は最初の1回だけ数え、
+    utf-16 なども同じ方法で数えられる（デコードできなかったバイトがある場合は近似値になる）。
+    """
+
+    def __init__(self, f, encoding):
+        self.offset = 0
+        self._file = f
+        self._encode = codecs.getincrementalencoder(encoding)('replace').encode
+
+    def __iter__(self):
+        encode = self._encode
+        for line in self._file:
+            self.offset += len(encode(line))
+            yield line
+
+
+def iter_rows(path, encoding, delimiter):
+    """データ行を (行, 読み終えたバイト数) の組で順に返す（空行は飛ばす。引用符内の改行は1行として扱う）"""
+    with open(path, 'r', encoding=encoding, errors='replace', newline='') as f:
+        lines = _CountingLines(f, encoding)
+        for row in csv.reader(lines, delimiter=delimiter):
+            if row and any(cell != '' for cell in row):
+                yield row, lines.offset
+
+
+def column_names(header):
+    """見出し行から変数名を作る（空の見出しは colN、重複した見出しは最初の列だけを使う）"""
+    names = []
+    for index, cell in enumerate(header, 1):
+        name = cell.strip() or f'col{index}'
+        names.append(None if name in names else name)
+    return names
+
+
+def bind_row(columns, row):
+    """1行の値を {変数名: 値} にする（足りない列は空文字、見出しのない列は colN）"""
+    variables = {}
+    for index, value in enumerate(row):
+        name = columns[index] if index < len(columns) else f'col{index + 1}'
+        if name is not None:
+            variables[name] = value
+    for name in columns[len(row):]:
+        if name is not None:
+            variables[name] = ''
+    return variables
+
+
+def source_stamp(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtimeNs': stat.st_mtime_ns}
+
+
+class Checkpoint:
+    """バッチの状態ファイルと行ごとの記録ファイル"""
+
+    def __init__(self, directory, batch_id):
+        self.state_path = os.path.join(directory, f'{batch_id}.json')
+        self.rows_path = os.path.join(directory, f'{batch_id}.rows.jsonl')
+        self._lock = threading.Lock()
+
+    def save_state(self, state):
+        atomic_write(self.state_path, json.dumps(state, ensure_ascii=False, indent=2).encode('utf-8'))
+
+    def load_state(self):
+        with open(self.state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self.rows_path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def records(self):
+        """記録を古い順に返す（書き込み途中で終わった最後の行は無視する）"""
+        try:
+            f = open(self.rows_path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and isinstance(record.get('row'), int):
+                    yield record
+
+    def latest(self):
+        """行番号 → 最後に記録された状態"""
+        return {record['row']: record.get('status') for record in self.records()}
+
+
+class BatchRun:
+    """1件のバッチ実行（ワーカースレッド）
+
+    start_row(variables) は1行分のプログラム実行を開始して ProgramRun を返す関数。
+    listener を渡した場合、listener(batch, 種類, データ) で batch_start / row_end / batch_end を通知する。
+    """
+
+    def __init__(self, state, checkpoint, listener=None):
+        self.state = state
+        self.checkpoint = checkpoint
+        self.listener = listener
+        self.stop_event = threading.Event()
+        self.current_row = None
+        self.current_run = None
+        self.completed_rows = 0
+        self.failed = set()
+        self.processed_rows = 0
+        self.bytes_read = 0
+        # (時刻, 実行した行のバイト数の累計)。飛ばした行はスループットに含めない
+        self._marks = deque(maxlen=RATE_WINDOW + 1)
+        self._run_bytes = 0
+        self._thread = None
+
+    @property
+    def id(self):
+        return self.state['batchId']
+
+    @property
+    def status(self):
+        return self.state['status']
+
+    @property
+    def active(self):
+        return self.status in ('pending', 'running')
+
+    def start(self, start_row):
+        self.stop_event.clear()
+        self.state.update(status='pending', error=None, finished=None, started=datetime.now().isoformat())
+        self.checkpoint.save_state(self.state)
+        self._thread = threading.Thread(target=self._run, args=(start_row,),
+                                        name=f'batch-{self.id[:8]}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    def emit(self, event_type, data):
+        if self.listener is None:
+            return
+        try:
+            self.listener(self, event_type, data)
+        except Exception:
+            # 通知の失敗でバッチを止めない
+            pass
+
+    @property
+    def failed_rows(self):
+        return len(self.failed)
+
+    def progress(self):
+        """完了・失敗した行数とスループット（行/秒）、残り時間の見込み（秒）
+
+        全体の行数は最後まで読むまで分からないので、残り時間は読み終えたバイト数とファイルサイズの差を
+        直近の行のバイト数/秒で割って見積もる。
+        """
+        size = (self.state.get('source') or {}).get('size')
+        rate = byte_rate = None
+        if len(self._marks) >= 2 and self._marks[-1][0] > self._marks[0][0]:
+            (first_time, first_bytes), (last_time, last_bytes) = self._marks[0], self._marks[-1]
+            rate = (len(self._marks) - 1) / (last_time - first_time)
+            byte_rate = (last_bytes - first_bytes) / (last_time - first_time)
+        eta = None
+        if byte_rate and size is not None:
+            eta = max(0, size - self.bytes_read) / byte_rate
+        return {
+            'totalRows': self.state.get('totalRows'),
+            'completedRows': self.completed_rows,
+            'failedRows': self.failed_rows,
+            'processedRows': self.processed_rows,
+            'bytesRead': self.bytes_read,
+            'totalBytes': size,
+            'rowsPerSecond': round(rate, 3) if rate else None,
+            'etaSeconds': round(eta, 1) if eta is not None else None,
+        }
+
+    def load_progress(self):
+        """記録ファイルから完了・失敗した行を数え直し、完了した行番号の集合を返す"""
+        latest = self.checkpoint.latest()
+        done = {row for row, status in latest.items() if status == 'completed'}
+        self.completed_rows = len(done)
+        self.failed = {row for row, status in latest.items() if status == 'error'}
+        return done
+
+    def snapshot(self):
+        return dict(self.state, currentRow=self.current_row, currentRunId=self.current_run, **self.progress())
+
+    def _finish(self, status, error=None):
+        self.state.update(status=status, error=error, finished=datetime.now().isoformat())
+
+    def _run(self, start_row):
+        state = self.state
+        path, encoding, delimiter = state['path'], state['encoding'], state['delimiter']
+        try:
+            # 記録済みの結果を読み、完了した行を飛ばす（失敗・停止した行はもう一度実行する）
+            done = self.load_progress()
+            self.processed_rows = 0
+            self._marks.clear()
+            self._run_bytes = 0
+
+            rows = iter_rows(path, encoding, delimiter)
+            self.bytes_read = 0
+            if state['header']:
+                header, self.bytes_read = next(rows, (None, 0))
+                state['columns'] = column_names(header or [])
+            state['status'] = 'running'
+            self.checkpoint.save_state(state)
+            self.emit('batch_start', self.snapshot())
+            self._marks.append((time.perf_counter(), self._run_bytes))
+
+            number = 0
+            for number, (row, offset) in enumerate(rows, 1):
+                if self.stop_event.is_set():
+                    self._finish('stopped')
+                    break
+                if number in done:
+                    self.bytes_read = offset
+                    continue
+                self._run_bytes += offset - self.bytes_read
+                self.bytes_read = offset
+                status, error = self._run_row(start_row, number, row)
+                if status == 'stopped':
+                    self._finish('stopped')
+                    break
+                if status != 'completed' and state['onError'] == 'stop':
+                    self._finish('failed', f'{number}行目: {error}')
+                    break
+            else:
+                state['totalRows'] = number
+                self._finish('completed' if not self.failed_rows else 'failed',
+                             None if not self.failed_rows else f'{self.failed_rows}行が失敗しました')
+        except Exception as e:
+            self._finish('failed', str(e))
+        finally:
+            self.current_row = None
+            self.current_run = None
+            try:
+                self.checkpoint.save_state(state)
+            except OSError:
+                pass
+            self.emit('batch_end', self.snapshot())
+
+    def _run_row(self, start_row, number, row):
+        variables = bind_row(self.state.get('columns') or [], row)
+        if self.state.get('rowVariable'):
+            variables[self.state['rowVariable']] = number
+        self.current_row = number
+        started = time.perf_counter()
+        run_id = None
+        try:
+            run = start_row(variables)
+            run_id = self.current_run = run.id
+            while run.active:
+                if self.stop_event.is_set():
+                    run.stop()
+                run.join(POLL_SECONDS)
+            run.join()
+            status, error = run.status, run.error
+        except Exception as e:
+            status, error = 'error', str(e)
+        elapsed = time.perf_counter() - started
+
+        self.checkpoint.append({
+            'row': number,
+            'status': status,
+            'error': error,
+            'ms': round(elapsed * 1000, 1),
+            'runId': run_id,
+            'finished': datetime.now().isoformat(),
+        })
+        BATCH_ROWS.inc(status=status)
+        if status == 'completed':
+            self.completed_rows += 1
+            self.failed.discard(number)
+        elif status == 'error':
+            self.failed.add(number)
+        self.processed_rows += 1
+        self._marks.append((time.perf_counter(), self._run_bytes))
+        self.emit('row_end', dict(self.progress(), row=number, status=status, error=error,
+                                  ms=round(elapsed * 1000, 1), runId=run_id))
+        return status, error
+
+
+class BatchManager:
+    """バッチの管理（同時に実行できるのは1つだけ）
+
+    状態は directory に保存し、サーバーを再起動しても一覧・再開できる。実行中のまま
+    終わっていたバッチ（異常終了したもの）は interrupted として扱う。
+    """
+
+    def __init__(self, directory, listener=None):
+        self.directory = directory
+        self.listener = listener
+        self._batches = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def create(self, program, path, start_row, delimiter=None, header=True, on_error='stop',
+               row_variable=None, encoding=None):
+        """バッチを作成して実行を開始する"""
+        if on_error not in ON_ERROR:
+            raise ValueError(f'onError は {", ".join(ON_ERROR)} のいずれかを指定してください')
+        path = os.path.abspath(path)
+        state = {
+            'batchId': uuid.uuid4().hex,
+            'program': program,
+            'path': path,
+            'encoding': encoding or detect_encoding(path),
+            'delimiter': resolve_delimiter(path, delimiter),
+            'header': bool(header),
+            'onError': on_error,
+            'rowVariable': row_variable or None,
+            'columns': None,
+            'source': source_stamp(path),
+            'created': datetime.now().isoformat(),
+            'started': None,
+            'finished': None,
+            'status': 'pending',
+            'error': None,
+            'totalRows': None,
+        }
+        batch = BatchRun(state, Checkpoint(self.directory, state['batchId']), listener=self.listener)
+        with self._lock:
+            self._check_idle_locked()
+            self._batches[batch.id] = batch
+            batch.start(start_row)
+        return batch
+
+    def resume(self, batch_id, start_row, force=False):
+        """記録済みの完了行を飛ばして実行を再開する
+
+        作成時からCSVファイルが変わっている場合は、行番号がずれるため force を指定しない限り ValueError。
+        """
+        batch = self.get(batch_id)
+        if batch is None:
+            raise LookupError('バッチが見つかりません')
+        path = batch.state['path']
+        if not os.path.exists(path):
+            raise LookupError(f'ファイルが見つかりません: {path}')
+        if source_stamp(path) != batch.state.get('source'):
+            if not force:
+                raise ValueError('CSVファイルが作成時から変更されています（force を指定すると続きから実行します）')
+            # 行数が変わっている可能性があるので、最後まで読み直すまで不明にする
+            batch.state.update(source=source_stamp(path), totalRows=None)
+        with self._lock:
+            self._check_idle_locked()
+            batch.start(start_row)
+        return batch
+
+    def _check_idle_locked(self):
+        for batch in self._batches.values():
+            if batch.active:
+                raise RuntimeError('別のバッチが実行中です')
+
+    def get(self, batch_id):
+        if not _BATCH_ID.match(batch_id or ''):
+            return None
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch is None:
+                batch = self._load_locked(batch_id)
+            return batch
+
+    def _load_locked(self, batch_id):
+        checkpoint = Checkpoint(self.directory, batch_id)
+        try:
+            state = checkpoint.load_state()
+        except (OSError, ValueError):
+            return None
+        if state.get('status') in ('pending', 'running'):
+            state['status'] = 'interrupted'
+        batch = BatchRun(state, checkpoint, listener=self.listener)
+        batch.load_progress()
+        self._batches[batch_id] = batch
+        return batch
+
+    def active(self):
+        with self._lock:
+            for batch in self._batches.values():
+                if batch.active:
+                    return batch
+        return None
+
+    def list(self):
+        """保存されているバッチの一覧（新しい順）"""
+        try:
+            names = [name[:-5] for name in os.listdir(self.directory) if name.endswith('.json')]
+        except FileNotFoundError:
+            names = []
+        batches = [batch for batch in (self.get(name) for name in names) if batch is not None]
+        batches.sort(key=lambda batch: batch.state.get('created') or '', reverse=True)
+        return [batch.snapshot() for batch in batches]
@@ -0,0 +1,374 @@
+"""app.py のルート・保存済みプログラム・画像ライブラリ・ファイル読み込みのベンチマーク
+
+pyautogui を呼び出しを記録するだけのモック（mock_pyautogui.py）に置き換え、
+画面は合成画像（synthetic.py）を返すので、デスクトップがない環境でも同じ条件で
+繰り返し計測できる。一時ディレクトリを作業ディレクトリにするため、実際の
+save/ 以下には触れない。
+
+    http     : 入力操作のAPI 1回あたりの時間と、操作関数を直接呼んだ場合との差（HTTPのオーバーヘッド）
+    program  : 保存済みプログラムのサーバー側実行（1ステップあたりの時間）
+    matching : 画面サイズ・画像の数ごとの複数画像検索（/api/images/find-many）のスループット
+    library  : 画像ライブラリ（images.json）の件数ごとの追加・取得・一覧・削除・読み込みの時間
+    fileread : 文字コードごとのテキストファイル読み込みのスループット（初回・キャッシュ・行単位）
+
+使い方:
+    python benchmarks/bench_app.py [--only http matching] [--quick] [--repeat 20] [--json result.json]
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mock_pyautogui  # noqa: E402
+from synthetic import SCREEN_SIZES, make_screen, place_button  # noqa: E402
+
+SECTIONS = ('http', 'program', 'matching', 'library', 'fileread')
+
+# (名前, ルート, リクエスト, 操作名)
+HTTP_ACTIONS = (
+    ('click', '/api/click', {'x': 400, 'y': 300}, 'mouse_click'),
+    ('move', '/api/mouse/move-absolute', {'x': 640, 'y': 360}, 'mouse_move_absolute'),
+    ('scroll', '/api/scroll', {'direction': 'down', 'amount': 3}, 'mouse_scroll'),
+    ('keypress', '/api/keypress', {'key': 'enter'}, 'key_press'),
+    ('type', '/api/type', {'text': 'hello world'}, 'type_text'),
+)
+
+TEMPLATE_COUNTS = (1, 4, 16)
+LIBRARY_SIZES = (10, 100, 500)
+FILE_ENCODINGS = ('utf-8', 'utf-8-sig', 'shift_jis', 'euc-jp', 'iso-2022-jp')
+SAMPLE_TEXT = 'AutoNexのベンチマーク用テキストです。画像認識とマウス操作を自動化します。0123456789\n'
+
+
+def summarize(timings):
+    """秒のリストをミリ秒の統計にまとめる"""
+    ms = sorted(t * 1000 for t in timings)
+    return {
+        'n': len(ms),
+        'medianMs': round(statistics.median(ms), 4),
+        'meanMs': round(statistics.fmean(ms), 4),
+        'p95Ms': round(ms[min(len(ms) - 1, int(len(ms) * 0.95))], 4),
+        'minMs': round(ms[0], 4),
+    }
+
+
+def timed(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def timed_each(fn, items):
+    timings = []
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def png_base64(image):
+    return base64.b64encode(cv2.imencode('.png', image)[1].tobytes()).decode()
+
+
+def expect(response, status=200):
+    if response.status_code != status:
+        raise RuntimeError(f'{response.request.path}: {response.status_code} {response.get_data(as_text=True)[:200]}')
+    return response
+
+
+def bench_http(app, client, repeat):
+    import actions
+
+    results = []
+    for label, route, params, action in HTTP_ACTIONS:
+        direct = timed(lambda: actions.perform(action, params, actions.ActionContext()), repeat)
+        routed = timed(lambda: expect(client.post(route, json=params)), repeat)
+        direct_stats, route_stats = summarize(direct), summarize(routed)
+        results.append({
+            'action': label,
+            'route': route,
+            'direct': direct_stats,
+            'http': route_stats,
+            'overheadMs': round(route_stats['medianMs'] - direct_stats['medianMs'], 4),
+        })
+
+    batch_size = 50
+    batch = {'actions': [dict(params, type=action) for _, _, params, action in HTTP_ACTIONS] * (batch_size // 5)}
+    timings = timed(lambda: expect(client.post('/api/actions/batch', json=batch)), max(1, repeat // 5))
+    stats = summarize(timings)
+    results.append({
+        'action': 'batch',
+        'route': '/api/actions/batch',
+        'actions': len(batch['actions']),
+        'http': stats,
+        'perActionMs': round(stats['medianMs'] / len(batch['actions']), 4),
+    })
+    return results
+
+
+def program_workspace(steps):
+    """絶対座標への移動とクリックを steps 回繰り返すワークスペース"""
+    def number(value):
+        return {'block': {'type': 'math_number', 'fields': {'NUM': value}}}
+
+    body = {
+        'type': 'mouse_move_absolute', 'id': 'move',
+        'inputs': {'X': number(500), 'Y': number(400)},
+        'next': {'block': {'type': 'mouse_single_click', 'id': 'click', 'fields': {'BUTTON': 'left'}}},
+    }
+    return {'blocks': {'languageVersion': 0, 'blocks': [{
+        'type': 'controls_repeat', 'id': 'loop', 'fields': {'TIMES': steps // 2},
+        'inputs': {'DO': {'block': body}},
+    }]}}
+
+
+def bench_program(app, client, repeat, steps):
+    # 保存済みプログラムは保存時の speed で実行されるので、最速の max を指定する
+    # （max でもクリックなどは操作ごとの最小の落ち着き時間（0.02秒）だけ待つ）
+    expect(client.post('/api/save', json={
+        'name': 'bench', 'data': program_workspace(steps), 'failsafeEnabled': False, 'speed': 'max'}))
+
+    timings = []
+    run_steps = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run_id = expect(client.post('/api/run/bench')).get_json()['runId']
+        run = app.run_manager.get(run_id)
+        run.join()
+        timings.append(time.perf_counter() - start)
+        if run.status != 'completed':
+            raise RuntimeError(f'プログラムの実行に失敗しました: {run.error}')
+        run_steps = run.steps
+
+    stats = summarize(timings)
+    return {
+        'steps': run_steps,
+        'run': stats,
+        'perStepMs': round(stats['medianMs'] / max(run_steps, 1), 4),
+        'stepsPerSecond': round(run_steps / (stats['medianMs'] / 1000), 1),
+    }
+
+
+def bench_matching(app, client, repeat, screens):
+    results = []
+    for screen_label in screens:
+        width, height = SCREEN_SIZES[screen_label]
+        screen = make_screen(width, height, seed=width)
+        rng = np.random.default_rng(width)
+        names = []
+        for index in range(max(TEMPLATE_COUNTS)):
+            x = int(rng.integers(0, width - 130))
+            y = int(rng.integers(0, height - 40))
+            template = place_button(screen, x, y, label=f'B{index}', seed=index + 1)
+            name = f'bench-{screen_label}-{index}'
+            expect(client.post('/api/images/upload', json={'name': name, 'imageData': png_base64(template)}))
+            names.append(name)
+        app.frame_source.set_frames(screen)
+
+        for count in TEMPLATE_COUNTS:
+            request = {'imageNames': names[:count], 'useHint': False}
+            timings = timed(lambda: expect(client.post('/api/images/find-many', json=request)), repeat)
+            found = expect(client.post('/api/images/find-many', json=request)).get_json()
+            stats = summarize(timings)
+            results.append({
+                'screen': screen_label,
+                'templates': count,
+                'request': stats,
+                'templatesPerSecond': round(count / (stats['medianMs'] / 1000), 1),
+                'found': sum(1 for result in found['results'] if result.get('status') == 'found'),
+            })
+    return results
+
+
+def bench_library(workdir, sizes):
+    from library import ImageLibrary
+
+    png = cv2.imencode('.png', np.full((24, 24, 3), 128, dtype=np.uint8))[1].tobytes()
+    results = []
+    for size in sizes:
+        directory = os.path.join(workdir, f'library-{size}')
+        os.makedirs(directory)
+        index_path = os.path.join(directory, 'images.json')
+        library = ImageLibrary(directory, index_path)
+
+        add_timings = []
+        for index in range(size):
+            start = time.perf_counter()
+            library.add(f'image-{index}', png)
+            add_timings.append(time.perf_counter() - start)
+
+        middle = f'image-{size // 2}'
+        results.append({
+            'images': size,
+            # 件数が増えたときの1件あたりのコストを見るため、最後の1割の追加だけを集計する
+            'add': summarize(add_timings[-max(1, size // 10):]),
+            'get': summarize(timed(lambda: library.get(middle), 200)),
+            'list': summarize(timed(library.list, 50)),
+            'load': summarize(timed(lambda: ImageLibrary(directory, index_path), 10)),
+            'remove': summarize(timed_each(library.remove, [f'image-{index}' for index in range(min(size, 10))])),
+            'indexBytes': os.path.getsize(index_path),
+        })
+        shutil.rmtree(directory)
+    return results
+
+
+def bench_fileread(app, client, workdir, repeat, megabytes):
+    text = SAMPLE_TEXT * max(1, int(megabytes * 1024 * 1024 / len(SAMPLE_TEXT.encode('utf-8'))))
+    results = []
+    for encoding in FILE_ENCODINGS:
+        path = os.path.join(workdir, f'text-{encoding}.txt')
+        with open(path, 'wb') as f:
+            f.write(text.encode(encoding))
+        size = os.path.getsize(path)
+
+        # 速度だけでなく、元の文字列どおりに読めたか（BOMの除去を含む）も記録する
+        app.text_reader.clear()
+        correct = app.decode_text_file(path) == text
+
+        def cold_read():
+            app.text_reader.clear()
+            app.decode_text_file(path)
+
+        direct = summarize(timed(cold_read, repeat))
+        cached = summarize(timed(lambda: app.decode_text_file(path), repeat))
+        routed = summarize(timed(lambda: expect(client.post('/api/file/read-path', json={'path': path})), repeat))
+        # 行単位の読み込み（索引を作ったあと、ファイルの中ほどの100行）
+        middle = text.count('\n') // 2
+        page = summarize(timed(lambda: expect(client.post('/api/file/read-lines', json={
+            'path': path, 'start': middle, 'count': 100})), repeat))
+        results.append({
+            'encoding': encoding,
+            'bytes': size,
+            'correct': correct,
+            'direct': direct,
+            'cached': cached,
+            'http': routed,
+            'page': page,
+            'mbPerSecond': round(size / 1024 / 1024 / (direct['medianMs'] / 1000), 1),
+        })
+    return results
+
+
+def environment():
+    info = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+    }
+    try:
+        info['commit'] = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                        text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        info['commit'] = None
+    return info
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--only', nargs='+', choices=SECTIONS, default=list(SECTIONS))
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--quick', action='store_true', help='1080pの画面・少ない件数だけで計測する')
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    args = parser.parse_args()
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    screens = ['1080p'] if args.quick else list(SCREEN_SIZES)
+    library_sizes = LIBRARY_SIZES[:2] if args.quick else LIBRARY_SIZES
+    matching_repeat = max(1, args.repeat // (10 if args.quick else 5))
+
+    workdir = tempfile.mkdtemp(prefix='autonex-bench-')
+    os.chdir(workdir)
+    os.environ['AUTONEX_CAPTURE_BACKEND'] = 'synthetic'
+    mock_pyautogui.install(size=SCREEN_SIZES['1080p'])
+    try:
+        import app as app_module
+        client = app_module.app.test_client()
+        # 操作間の待機を除いた処理時間だけを計測する（保存済みプログラムは bench_program で speed を指定する）
+        expect(client.post('/api/session', json={'pause': 0, 'failsafe': False}))
+
+        results = {}
+        if 'http' in args.only:
+            results['http'] = bench_http(app_module, client, args.repeat)
+            print(f"{'action':<9} {'direct(ms)':>11} {'http(ms)':>9} {'overhead(ms)':>13}")
+            for row in results['http']:
+                if 'direct' in row:
+                    print(f"{row['action']:<9} {row['direct']['medianMs']:>11.3f} {row['http']['medianMs']:>9.3f} "
+                          f"{row['overheadMs']:>13.3f}")
+                else:
+                    print(f"{row['action']:<9} {'':>11} {row['http']['medianMs']:>9.3f} "
+                          f"({row['actions']}件, 1件あたり {row['perActionMs']:.3f}ms)")
+            print()
+
+        if 'program' in args.only:
+            results['program'] = bench_program(app_module, client, max(1, args.repeat // 4),
+                                               200 if args.quick else 1000)
+            row = results['program']
+            print(f"program: {row['steps']}ステップ {row['run']['medianMs']:.1f}ms "
+                  f"（1ステップ {row['perStepMs']:.3f}ms、{row['stepsPerSecond']:.0f}ステップ/秒）")
+            print()
+
+        if 'matching' in args.only:
+            results['matching'] = bench_matching(app_module, client, matching_repeat, screens)
+            print(f"{'screen':<7} {'templates':>9} {'request(ms)':>12} {'templates/s':>12} {'found':>6}")
+            for row in results['matching']:
+                print(f"{row['screen']:<7} {row['templates']:>9} {row['request']['medianMs']:>12.1f} "
+                      f"{row['templatesPerSecond']:>12.1f} {row['found']:>6}")
+            print()
+
+        if 'library' in args.only:
+            results['library'] = bench_library(workdir, library_sizes)
+            print(f"{'images':>6} {'add(ms)':>8} {'get(ms)':>8} {'list(ms)':>9} {'load(ms)':>9} {'remove(ms)':>11} "
+                  f"{'index KB':>9}")
+            for row in results['library']:
+                print(f"{row['images']:>6} {row['add']['medianMs']:>8.3f} {row['get']['medianMs']:>8.4f} "
+                      f"{row['list']['medianMs']:>9.3f} {row['load']['medianMs']:>9.3f} "
+                      f"{row['remove']['medianMs']:>11.3f} {row['indexBytes'] / 1024:>9.1f}")
+            print()
+
+        if 'fileread' in args.only:
+            results['fileread'] = bench_fileread(app_module, client, workdir, max(1, args.repeat // 4),
+                                                 0.25 if args.quick else 1)
+            print(f"{'encoding':<12} {'KB':>7} {'direct(ms)':>11} {'cached(ms)':>11} {'http(ms)':>9} "
+                  f"{'page(ms)':>9} {'MB/s':>7} {'correct':>8}")
+            for row in results['fileread']:
+                print(f"{row['encoding']:<12} {row['bytes'] / 1024:>7.0f} {row['direct']['medianMs']:>11.2f} "
+                      f"{row['cached']['medianMs']:>11.3f} {row['http']['medianMs']:>9.2f} "
+                      f"{row['page']['medianMs']:>9.2f} {row['mbPerSecond']:>7.1f} {str(row['correct']):>8}")
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'benchmark': 'app',
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'options': {'sections': args.only, 'repeat': args.repeat, 'quick': args.quick},
+                'environment': environment(),
+                'results': results,
+            }, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
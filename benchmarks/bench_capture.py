@@ -0,0 +1,132 @@
+"""画面キャプチャ方式ごとのフレームレートと1フレームあたりのメモリ確保量
+
+各バックエンドで全画面と一部範囲の取得を繰り返し、FPSと tracemalloc で
+計測した1フレームあたりの確保量を表示する。あわせて、画面を持たない環境でも
+比較できるように、従来のPIL経由の変換（PIL画像→np.array→RGB→BGR）と
+x11shm と同じBGRAビューからの1回変換を合成画像で比較する。
+
+PILやXサーバー側のバッファは tracemalloc の計測対象外のため、
+pyautogui の確保量は実際より小さく表示される点に注意。
+
+使い方:
+    python benchmarks/bench_capture.py [--backend synthetic x11shm pyautogui] [--frames 60] [--json result.json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capture import SyntheticSource, create_frame_source  # noqa: E402
+from synthetic import SCREEN_SIZES, make_screen  # noqa: E402
+
+
+def measure(grab, frames):
+    grab()  # 初回の遅延初期化を除外する
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    allocated = 0
+    for _ in range(frames):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        frame = grab()
+        allocated += tracemalloc.get_traced_memory()[1] - before
+        del frame
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+    return {
+        'fps': round(frames / elapsed, 1),
+        'msPerFrame': round(elapsed * 1000 / frames, 2),
+        'allocKBPerFrame': round(allocated / frames / 1024, 1),
+    }
+
+
+def open_backend(name, screen):
+    if name == 'synthetic':
+        return SyntheticSource(screen)
+    return create_frame_source(name)
+
+
+def run_backends(names, frames):
+    results = []
+    screen = make_screen(*SCREEN_SIZES['1080p'], seed=1)
+    for name in names:
+        try:
+            source = open_backend(name, screen)
+        except Exception as e:
+            results.append({'backend': name, 'error': str(e)})
+            continue
+        try:
+            width, height = source.size()
+            region = (width // 4, height // 4, width // 2, height // 2)
+            results.append({
+                'backend': name,
+                'size': [width, height],
+                'full': measure(source.grab, frames),
+                'region': measure(lambda: source.grab(region), frames),
+            })
+        except Exception as e:
+            results.append({'backend': name, 'error': str(e)})
+        finally:
+            source.close()
+    return results
+
+
+def run_conversion(frames):
+    # 画面取得後の変換処理だけを比較する
+    results = []
+    for label, (width, height) in SCREEN_SIZES.items():
+        bgr = make_screen(width, height, seed=width)
+        rgb = Image.fromarray(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
+        bgra = cv2.cvtColor(bgr, cv2.COLOR_BGR2BGRA)
+        results.append({
+            'screen': label,
+            'pil': measure(lambda: cv2.cvtColor(np.array(rgb), cv2.COLOR_RGB2BGR), frames),
+            'bgraView': measure(lambda: cv2.cvtColor(bgra, cv2.COLOR_BGRA2BGR), frames),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', nargs='+', default=['synthetic', 'x11shm', 'pyautogui'])
+    parser.add_argument('--frames', type=int, default=60)
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    args = parser.parse_args()
+
+    backends = run_backends(args.backend, args.frames)
+    conversion = run_conversion(args.frames)
+
+    print(f"{'backend':<10} {'full fps':>9} {'full KB/f':>10} {'region fps':>11} {'region KB/f':>12}")
+    for row in backends:
+        if 'error' in row:
+            print(f"{row['backend']:<10} 利用不可: {row['error']}")
+            continue
+        full, region = row['full'], row['region']
+        print(f"{row['backend']:<10} {full['fps']:>9.1f} {full['allocKBPerFrame']:>10.1f} "
+              f"{region['fps']:>11.1f} {region['allocKBPerFrame']:>12.1f}")
+
+    print()
+    print(f"{'screen':<7} {'PIL(ms)':>8} {'PIL KB/f':>9} {'BGRA(ms)':>9} {'BGRA KB/f':>10} {'speedup':>8}")
+    for row in conversion:
+        pil, view = row['pil'], row['bgraView']
+        print(f"{row['screen']:<7} {pil['msPerFrame']:>8.2f} {pil['allocKBPerFrame']:>9.1f} "
+              f"{view['msPerFrame']:>9.2f} {view['allocKBPerFrame']:>10.1f} "
+              f"{pil['msPerFrame'] / max(view['msPerFrame'], 1e-6):>7.1f}x")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'benchmark': 'capture', 'frames': args.frames,
+                       'backends': backends, 'conversion': conversion}, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
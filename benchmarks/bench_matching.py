@@ -0,0 +1,151 @@
+"""全画素探索とピラミッド探索、照合の色の扱い（color / gray / masked）ごとの速度・精度比較
+
+使い方:
+    python benchmarks/bench_matching.py [--only modes colors] [--repeat 10] [--json result.json]
+
+colors は角が透明な丸いボタンを、キャプチャしたときとは別の背景色の上に置いて探す。
+gray の時間には画面のグレースケール変換を含む。
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matching import COLOR_MODES, match  # noqa: E402
+from synthetic import SCREEN_SIZES, make_screen, place_button  # noqa: E402
+
+TEMPLATE_SIZES = {
+    'icon': (32, 32),
+    'button': (120, 36),
+    'panel': (320, 120),
+}
+SECTIONS = ('modes', 'colors')
+
+
+def measure(screen, template, mode, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = match(screen, template, mode)
+        timings.append((time.perf_counter() - start) * 1000)
+    return result, timings
+
+
+def run_modes(repeat):
+    results = []
+    for screen_label, (width, height) in SCREEN_SIZES.items():
+        for template_label, size in TEMPLATE_SIZES.items():
+            screen = make_screen(width, height, seed=width)
+            truth = (width * 2 // 3, height // 2)
+            template = place_button(screen, truth[0], truth[1], label=template_label.upper(), size=size)
+
+            row = {'screen': screen_label, 'template': template_label}
+            for mode in ('exhaustive', 'pyramid'):
+                (confidence, location), timings = measure(screen, template, mode, repeat)
+                row[mode] = {
+                    'medianMs': round(statistics.median(timings), 2),
+                    'minMs': round(min(timings), 2),
+                    'confidence': round(confidence, 4),
+                    'location': list(location),
+                    'exact': tuple(location) == truth,
+                }
+            row['speedup'] = round(row['exhaustive']['medianMs'] / max(row['pyramid']['medianMs'], 1e-6), 2)
+            results.append(row)
+    return results
+
+
+def round_button(size=64, seed=2):
+    """角が透明な丸いボタン（BGRA、縁はアンチエイリアス）"""
+    rng = np.random.default_rng(seed)
+    color = tuple(int(c) for c in rng.integers(60, 200, 3))
+    button = np.zeros((size, size, 4), dtype=np.uint8)
+    cv2.circle(button, (size // 2, size // 2), size // 2 - 3, color + (255,), -1, cv2.LINE_AA)
+    cv2.putText(button, 'OK', (size // 4, size * 5 // 8), cv2.FONT_HERSHEY_SIMPLEX,
+                0.6, (255, 255, 255, 255), 2, cv2.LINE_AA)
+    return button
+
+
+def blend(screen, x, y, image, background):
+    """image（BGRA）を単色の背景の上に合成して画面に描く"""
+    h, w = image.shape[:2]
+    alpha = image[:, :, 3:4].astype(np.float32) / 255.0
+    screen[y:y + h, x:x + w] = (image[:, :, :3] * alpha + np.float32(background) * (1 - alpha)).astype(np.uint8)
+
+
+def run_colors(repeat):
+    results = []
+    button = round_button()
+    for screen_label, (width, height) in SCREEN_SIZES.items():
+        screen = make_screen(width, height, seed=width)
+        truth = (width // 3, height * 2 // 3)
+        # テンプレートを切り出したときの背景（黒）とは違う背景の上に置く
+        blend(screen, truth[0], truth[1], button, (40, 190, 70))
+        bgr = np.ascontiguousarray(button[:, :, :3])
+        patterns = {
+            'color': (bgr, None),
+            'gray': (cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY), None),
+            'masked': (bgr, button[:, :, 3].astype(np.float32) / 255.0),
+        }
+
+        row = {'screen': screen_label}
+        for color_mode in COLOR_MODES:
+            image, mask = patterns[color_mode]
+            for mode in ('exhaustive', 'pyramid'):
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    confidence, location = match(screen, image, mode, mask=mask)
+                    timings.append((time.perf_counter() - start) * 1000)
+                row[f'{color_mode}/{mode}'] = {
+                    'medianMs': round(statistics.median(timings), 2),
+                    'minMs': round(min(timings), 2),
+                    'confidence': round(confidence, 4),
+                    'location': list(location),
+                    'exact': tuple(location) == truth,
+                }
+        results.append(row)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--only', nargs='+', choices=SECTIONS, default=list(SECTIONS))
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    args = parser.parse_args()
+
+    output = {'benchmark': 'matching', 'repeat': args.repeat}
+    if 'modes' in args.only:
+        results = output['results'] = run_modes(args.repeat)
+        print(f"{'screen':<7} {'template':<8} {'exhaustive(ms)':>15} {'pyramid(ms)':>12} {'speedup':>8} {'exact':>6} "
+              f"{'Δconf':>7}")
+        for row in results:
+            exhaustive, pyramid = row['exhaustive'], row['pyramid']
+            print(f"{row['screen']:<7} {row['template']:<8} {exhaustive['medianMs']:>15.2f} "
+                  f"{pyramid['medianMs']:>12.2f} {row['speedup']:>7.1f}x {str(pyramid['exact']):>6} "
+                  f"{pyramid['confidence'] - exhaustive['confidence']:>7.4f}")
+
+    if 'colors' in args.only:
+        colors = output['colorModes'] = run_colors(args.repeat)
+        print()
+        print(f"{'screen':<7} {'colorMode':<9} {'exhaustive(ms)':>15} {'pyramid(ms)':>12} {'confidence':>11} {'exact':>6}")
+        for row in colors:
+            for color_mode in COLOR_MODES:
+                exhaustive, pyramid = row[f'{color_mode}/exhaustive'], row[f'{color_mode}/pyramid']
+                print(f"{row['screen']:<7} {color_mode:<9} {exhaustive['medianMs']:>15.2f} {pyramid['medianMs']:>12.2f} "
+                      f"{exhaustive['confidence']:>11.4f} {str(exhaustive['exact']):>6}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""ベンチマーク用の pyautogui の代わり
+
+実際にはマウスやキーボードを動かさず、呼び出しを記録するだけのモジュールを
+sys.modules['pyautogui'] として登録する。screenshot() は合成画面を返す。
+app.py などを import する前に install() を呼ぶこと。
+
+    mock = install(screen=make_screen(1920, 1080))
+    import app
+    ...
+    mock.calls  # [(関数名, 引数, キーワード引数), ...]
+"""
+import sys
+import threading
+import types
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# 記録だけ行う入力関数
+INPUT_FUNCTIONS = (
+    'click', 'doubleClick', 'tripleClick', 'mouseDown', 'mouseUp', 'moveTo', 'move', 'moveRel',
+    'dragTo', 'scroll', 'press', 'keyDown', 'keyUp', 'typewrite', 'write', 'hotkey',
+)
+
+
+class FailSafeException(Exception):
+    pass
+
+
+def install(screen=None, size=(1920, 1080)):
+    """呼び出しを記録する pyautogui モジュールを登録して返す
+
+    screen（BGR配列）を渡した場合は、そのサイズを画面サイズとし、screenshot() で返す。
+    """
+    module = types.ModuleType('pyautogui')
+    lock = threading.Lock()
+    state = {'position': (0, 0), 'screen': screen}
+    if screen is not None:
+        size = (screen.shape[1], screen.shape[0])
+
+    module.FAILSAFE = False
+    module.PAUSE = 0.0
+    module.FailSafeException = FailSafeException
+    module.calls = []
+
+    def record(name):
+        def call(*args, **kwargs):
+            with lock:
+                module.calls.append((name, args, kwargs))
+                if name == 'moveTo' and len(args) >= 2:
+                    state['position'] = (int(args[0]), int(args[1]))
+        call.__name__ = name
+        return call
+
+    for name in INPUT_FUNCTIONS:
+        setattr(module, name, record(name))
+
+    def screenshot(region=None):
+        frame = state['screen']
+        if frame is None:
+            frame = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+        if region:
+            x, y, w, h = region
+            frame = frame[y:y + h, x:x + w]
+        return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+    def set_screen(frame):
+        state['screen'] = frame
+
+    def reset():
+        with lock:
+            module.calls.clear()
+
+    module.size = lambda: size
+    module.position = lambda: state['position']
+    module.screenshot = screenshot
+    module.set_screen = set_screen
+    module.reset = reset
+    sys.modules['pyautogui'] = module
+    return module
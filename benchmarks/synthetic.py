@@ -0,0 +1,49 @@
+"""ベンチマーク用の合成スクリーンショット
+
+実際のデスクトップに近い見た目（背景・ウィンドウ・ボタン・文字）の画像を
+乱数の種から再現可能な形で生成する。
+"""
+import cv2
+import numpy as np
+
+SCREEN_SIZES = {
+    '1080p': (1920, 1080),
+    '1440p': (2560, 1440),
+    '4K': (3840, 2160),
+}
+
+
+def make_screen(width, height, seed=0):
+    """UI風の合成画面（BGR）を生成する"""
+    rng = np.random.default_rng(seed)
+    screen = np.full((height, width, 3), 235, dtype=np.uint8)
+
+    # 縦方向のグラデーション（壁紙）
+    gradient = np.linspace(180, 240, height, dtype=np.float32)[:, None, None]
+    screen[:] = np.clip(gradient + rng.normal(0, 2, (height, 1, 3)), 0, 255).astype(np.uint8)
+
+    # ウィンドウ・ボタン・文字を散りばめる
+    for _ in range(width * height // 40000):
+        x = int(rng.integers(0, width - 40))
+        y = int(rng.integers(0, height - 20))
+        w = int(rng.integers(40, 400))
+        h = int(rng.integers(20, 200))
+        color = tuple(int(c) for c in rng.integers(120, 255, 3))
+        cv2.rectangle(screen, (x, y), (x + w, y + h), color, -1)
+        cv2.rectangle(screen, (x, y), (x + w, y + h), (90, 90, 90), 1)
+        text = ''.join(chr(int(c)) for c in rng.integers(65, 91, int(rng.integers(3, 12))))
+        cv2.putText(screen, text, (x + 5, y + min(h - 5, 16)), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.45, (30, 30, 30), 1, cv2.LINE_AA)
+    return screen
+
+
+def place_button(screen, x, y, label='OK', size=(120, 36), seed=1):
+    """ボタン風の目印を描画し、テンプレートとして切り出した画像を返す"""
+    rng = np.random.default_rng(seed)
+    w, h = size
+    color = tuple(int(c) for c in rng.integers(60, 200, 3))
+    cv2.rectangle(screen, (x, y), (x + w, y + h), color, -1)
+    cv2.rectangle(screen, (x, y), (x + w, y + h), (20, 20, 20), 2)
+    cv2.putText(screen, label, (x + 10, y + h - 11), cv2.FONT_HERSHEY_SIMPLEX,
+                0.6, (255, 255, 255), 2, cv2.LINE_AA)
+    return screen[y:y + h, x:x + w].copy()
@@ -0,0 +1,427 @@
+"""画面キャプチャのバックエンド
+
+画像検索が使うスクリーンショットの取得元を差し替えられるようにする。
+どのバックエンドも grab() でOpenCV形式（BGR, uint8, C連続）の配列を返す。
+
+    pyautogui : 従来どおり pyautogui.screenshot() を使う（全OS対応）
+    x11shm    : Linux X11 の共有メモリ拡張（MIT-SHM）で直接取得する
+    synthetic : メモリ上の画像を返す（テスト・ベンチマーク用）
+
+FrameCache は直近に取得した全画面フレームを時刻付きで保持し、「N ミリ秒以内のフレーム」を
+求める要求には取得し直さずに返す。同時に届いた取得は1回にまとめる。
+"""
+import ctypes
+import ctypes.util
+import os
+import platform
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+CAPTURE_BACKENDS = ('auto', 'pyautogui', 'x11shm', 'synthetic')
+
+
+class FrameSource:
+    """キャプチャバックエンドの基底クラス"""
+
+    name = 'base'
+
+    def size(self):
+        """画面サイズ (width, height) を返す"""
+        raise NotImplementedError
+
+    def grab(self, region=None):
+        """画面（region 指定時は (x, y, width, height) の範囲）をBGR配列で返す"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PyAutoGuiSource(FrameSource):
+    """pyautogui.screenshot() を使うバックエンド
+
+    PIL画像の生成・NumPy配列への変換・RGB→BGR変換で1フレームあたり3回コピーが発生する。
+    """
+
+    name = 'pyautogui'
+
+    def __init__(self):
+        import pyautogui
+        self._pyautogui = pyautogui
+
+    def size(self):
+        return tuple(self._pyautogui.size())
+
+    def grab(self, region=None):
+        screenshot = self._pyautogui.screenshot(region=region) if region else self._pyautogui.screenshot()
+        return cv2.cvtColor(np.asarray(screenshot), cv2.COLOR_RGB2BGR)
+
+
+class _XImage(ctypes.Structure):
+    # Xlib.h の XImage 構造体（関数ポインタ表より前の部分のみ）
+    _fields_ = [
+        ('width', ctypes.c_int),
+        ('height', ctypes.c_int),
+        ('xoffset', ctypes.c_int),
+        ('format', ctypes.c_int),
+        ('data', ctypes.c_void_p),
+        ('byte_order', ctypes.c_int),
+        ('bitmap_unit', ctypes.c_int),
+        ('bitmap_bit_order', ctypes.c_int),
+        ('bitmap_pad', ctypes.c_int),
+        ('depth', ctypes.c_int),
+        ('bytes_per_line', ctypes.c_int),
+        ('bits_per_pixel', ctypes.c_int),
+        ('red_mask', ctypes.c_ulong),
+        ('green_mask', ctypes.c_ulong),
+        ('blue_mask', ctypes.c_ulong),
+    ]
+
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ('shmseg', ctypes.c_ulong),
+        ('shmid', ctypes.c_int),
+        ('shmaddr', ctypes.c_void_p),
+        ('readOnly', ctypes.c_int),
+    ]
+
+
+class X11ShmSource(FrameSource):
+    """X11 MIT-SHM 拡張で共有メモリに直接画面を取り込むバックエンド
+
+    Xサーバーが共有メモリに書き込んだBGRA画素をそのままNumPyのビューとして扱い、
+    OpenCVのBGRA→BGR変換1回だけで結果の配列を作る（中間のPIL画像やコピーは作らない）。
+    """
+
+    name = 'x11shm'
+
+    _ZPIXMAP = 2
+    _IPC_PRIVATE = 0
+    _IPC_CREAT = 0o1000
+    _IPC_RMID = 0
+
+    def __init__(self, display_name=None):
+        if platform.system() != 'Linux':
+            raise RuntimeError('x11shm はLinuxでのみ使用できます')
+
+        xlib_path = ctypes.util.find_library('X11')
+        xext_path = ctypes.util.find_library('Xext')
+        if not xlib_path or not xext_path:
+            raise RuntimeError('libX11 / libXext が見つかりません')
+
+        self._xlib = xlib = ctypes.CDLL(xlib_path)
+        self._xext = xext = ctypes.CDLL(xext_path)
+        self._libc = libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._setup_prototypes()
+
+        name = display_name or os.environ.get('DISPLAY')
+        self._display = xlib.XOpenDisplay(name.encode() if name else None)
+        if not self._display:
+            raise RuntimeError('Xディスプレイに接続できません')
+
+        self._shm_addr = None
+        try:
+            if not xext.XShmQueryExtension(self._display):
+                raise RuntimeError('XサーバーがMIT-SHM拡張に対応していません')
+
+            screen = xlib.XDefaultScreen(self._display)
+            self._root = xlib.XRootWindow(self._display, screen)
+            self._width = xlib.XDisplayWidth(self._display, screen)
+            self._height = xlib.XDisplayHeight(self._display, screen)
+
+            self._info = _XShmSegmentInfo()
+            self._image = xext.XShmCreateImage(
+                self._display, xlib.XDefaultVisual(self._display, screen),
+                xlib.XDefaultDepth(self._display, screen), self._ZPIXMAP, None,
+                ctypes.byref(self._info), self._width, self._height)
+            if not self._image:
+                raise RuntimeError('共有メモリ画像を作成できません')
+
+            image = self._image.contents
+            if image.bits_per_pixel != 32:
+                raise RuntimeError(f'未対応の画素形式です（{image.bits_per_pixel}bpp）')
+
+            stride = image.bytes_per_line
+            nbytes = stride * self._height
+            self._info.shmid = libc.shmget(self._IPC_PRIVATE, nbytes, self._IPC_CREAT | 0o600)
+            if self._info.shmid < 0:
+                raise RuntimeError('共有メモリを確保できません')
+            addr = libc.shmat(self._info.shmid, None, 0)
+            if addr in (None, ctypes.c_void_p(-1).value):
+                raise RuntimeError('共有メモリを割り当てられません')
+            self._shm_addr = addr
+            self._info.shmaddr = addr
+            self._info.readOnly = 0
+            image.data = addr
+
+            if not xext.XShmAttach(self._display, ctypes.byref(self._info)):
+                raise RuntimeError('共有メモリをXサーバーに登録できません')
+            xlib.XSync(self._display, 0)
+            # 全プロセスが切り離した時点で自動的に解放されるようにしておく
+            libc.shmctl(self._info.shmid, self._IPC_RMID, None)
+
+            raw = (ctypes.c_ubyte * nbytes).from_address(addr)
+            self._bgra = np.ctypeslib.as_array(raw).reshape(self._height, stride)[:, :self._width * 4] \
+                .reshape(self._height, self._width, 4)
+        except Exception:
+            self.close()
+            raise
+
+        self._lock = threading.Lock()
+
+    def _setup_prototypes(self):
+        xlib, xext, libc = self._xlib, self._xext, self._libc
+        xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        xlib.XRootWindow.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XRootWindow.restype = ctypes.c_ulong
+        xlib.XDisplayWidth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDisplayHeight.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDefaultVisual.restype = ctypes.c_void_p
+        xlib.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                                         ctypes.c_char_p, ctypes.POINTER(_XShmSegmentInfo),
+                                         ctypes.c_uint, ctypes.c_uint]
+        xext.XShmCreateImage.restype = ctypes.POINTER(_XImage)
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XImage),
+                                      ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+    def size(self):
+        return (self._width, self._height)
+
+    def grab(self, region=None):
+        with self._lock:
+            if not self._xext.XShmGetImage(self._display, self._root, self._image, 0, 0, 0xFFFFFFFF):
+                raise RuntimeError('画面を取得できませんでした')
+            frame = self._bgra
+            if region:
+                x, y, w, h = region
+                frame = frame[y:y + h, x:x + w]
+            # 共有メモリ上のビューから結果の配列へ直接変換する（コピーはこの1回だけ）
+            return cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+
+    def close(self):
+        display = getattr(self, '_display', None)
+        if not display:
+            return
+        if self._shm_addr is not None:
+            self._xext.XShmDetach(display, ctypes.byref(self._info))
+            self._xlib.XSync(display, 0)
+            self._libc.shmdt(self._shm_addr)
+            self._shm_addr = None
+        self._xlib.XCloseDisplay(display)
+        self._display = None
+
+
+class SyntheticSource(FrameSource):
+    """メモリ上の画像を画面として返すバックエンド（テスト・ベンチマーク用）
+
+    frames には1枚の画像、画像のリスト（grab のたびに順に返し、最後の1枚を繰り返す）、
+    または呼び出すたびに画像を返す関数を指定できる。
+    """
+
+    name = 'synthetic'
+
+    def __init__(self, frames=None, size=(1920, 1080)):
+        self._lock = threading.Lock()
+        self._index = 0
+        self.grabs = 0
+        if frames is None:
+            frames = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+        self.set_frames(frames)
+
+    def set_frames(self, frames):
+        with self._lock:
+            self._frames = frames
+            self._index = 0
+
+    def _current_frame(self, advance):
+        frames = self._frames
+        if callable(frames):
+            return frames()
+        if isinstance(frames, np.ndarray):
+            return frames
+        frame = frames[min(self._index, len(frames) - 1)]
+        if advance:
+            self._index += 1
+        return frame
+
+    def size(self):
+        with self._lock:
+            frame = self._current_frame(advance=False)
+        return (frame.shape[1], frame.shape[0])
+
+    def grab(self, region=None):
+        with self._lock:
+            frame = self._current_frame(advance=True)
+            self.grabs += 1
+        if region:
+            x, y, w, h = region
+            frame = frame[y:y + h, x:x + w]
+        return frame.copy()
+
+
+def _crop(frame, region):
+    if not region:
+        return frame
+    x, y, w, h = region
+    return frame[y:y + h, x:x + w]
+
+
+class FrameCache:
+    """直近に取得した全画面フレームのリングバッファ
+
+    get(max_age) は max_age 秒以内に取得を始めたフレームがあればそれを返し、なければ取得する。
+    複数のスレッドが同時に新しいフレームを求めた場合、取得は1回だけ行って全員で使う。
+    background を有効にすると、get() が呼ばれてから idle_timeout 秒の間だけバックグラウンドの
+    スレッドが interval 秒ごとに取得しておき、要求が途絶えると止まる。
+    保持するフレームは読み取り専用の配列なので、書き換える場合は呼び出し側で copy() すること。
+    """
+
+    def __init__(self, grab, size=4, interval=0.1, idle_timeout=2.0, background=False):
+        self.grab = grab
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.background = background
+        self._frames = deque(maxlen=size)
+        self._cond = threading.Condition()
+        self._grabbing = False
+        self._thread = None
+        self._last_request = 0.0
+        self._capture_times = deque(maxlen=256)
+        self._stats = {'hits': 0, 'shared': 0, 'misses': 0, 'direct': 0, 'captures': 0, 'backgroundCaptures': 0}
+
+    def _fresh_locked(self, oldest):
+        if self._frames and self._frames[-1][0] >= oldest:
+            return self._frames[-1][1]
+        return None
+
+    def get(self, max_age=0.0, region=None):
+        """max_age 秒以内に取得した画面（region 指定時はその部分）を返す
+
+        max_age が0の場合は要求より後に取得を始めたフレームだけを使う（同時の要求とだけ共有する）。
+        """
+        requested = time.monotonic()
+        oldest = requested - max(0.0, max_age)
+        with self._cond:
+            self._last_request = requested
+            if self.background:
+                self._ensure_thread_locked()
+            frame = self._fresh_locked(oldest)
+            if frame is not None:
+                self._stats['hits'] += 1
+                return _crop(frame, region)
+            direct = bool(region) and max_age <= 0
+            if direct:
+                self._stats['direct'] += 1
+        if direct:
+            # 鮮度を指定しない範囲の取得はバッファを通さず、その範囲だけを取得する
+            return self.grab(region)
+        return _crop(self._capture(oldest), region)
+
+    def _capture(self, oldest, background=False):
+        with self._cond:
+            while self._grabbing:
+                self._cond.wait()
+                frame = self._fresh_locked(oldest)
+                if frame is not None:
+                    if not background:
+                        self._stats['shared'] += 1
+                    return frame
+            self._grabbing = True
+        try:
+            started = time.monotonic()
+            frame = self.grab()
+            frame.flags.writeable = False
+            with self._cond:
+                self._frames.append((started, frame))
+                self._capture_times.append(started)
+                self._stats['backgroundCaptures' if background else 'captures'] += 1
+                if not background:
+                    self._stats['misses'] += 1
+            return frame
+        finally:
+            with self._cond:
+                self._grabbing = False
+                self._cond.notify_all()
+
+    def _ensure_thread_locked(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='frame-capture', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if time.monotonic() - self._last_request > self.idle_timeout:
+                    # 要求が途絶えたら止まる（次の get() で再び起動する）
+                    self._thread = None
+                    return
+            started = time.monotonic()
+            try:
+                self._capture(started, background=True)
+            except Exception:
+                # 取得の失敗は要求した側の取得で報告される
+                pass
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def clear(self):
+        with self._cond:
+            self._frames.clear()
+
+    def stats(self, window=10.0):
+        """参照数・取得数と、直近 window 秒の取得レート（フレーム/秒）"""
+        now = time.monotonic()
+        with self._cond:
+            stats = dict(self._stats)
+            recent = sum(1 for started in self._capture_times if now - started <= window)
+            latest = self._frames[-1][0] if self._frames else None
+            running = self._thread is not None
+            buffered = len(self._frames)
+        requests = stats['hits'] + stats['shared'] + stats['misses'] + stats['direct']
+        return dict(
+            stats,
+            requests=requests,
+            hitRatio=round((stats['hits'] + stats['shared']) / requests, 4) if requests else 0.0,
+            captureRate=round(recent / window, 2),
+            latestAgeMs=round((now - latest) * 1000, 1) if latest is not None else None,
+            buffered=buffered,
+            background=self.background,
+            running=running,
+        )
+
+
+def create_frame_source(backend='auto'):
+    """設定名からキャプチャバックエンドを生成する
+
+    auto の場合、Linux X11 環境では x11shm を試し、使えなければ pyautogui を使う。
+    """
+    if backend not in CAPTURE_BACKENDS:
+        raise ValueError(f'不明なキャプチャ方式です: {backend}')
+    if backend == 'synthetic':
+        return SyntheticSource()
+    if backend == 'x11shm':
+        return X11ShmSource()
+    if backend == 'auto' and platform.system() == 'Linux' and os.environ.get('DISPLAY'):
+        try:
+            return X11ShmSource()
+        except Exception:
+            pass
+    return PyAutoGuiSource()
@@ -0,0 +1,166 @@
+"""保存済みプログラムの目録
+
+プログラムごとの名前・作成/更新日時・ブロック数・参照している画像・ファイルサイズを
+目録ファイル（JSON）に保持し、一覧・検索・並べ替え・ページ分けをメモリ上で行う。
+保存時は save_program から record() で1件だけ更新する。一覧のたびにディレクトリの
+mtime/サイズだけを調べ、目録と食い違うファイル（手動でコピー・削除されたものなど）に
+限って読み直すので、プログラムが増えても一覧でファイルを全部開くことはない。
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from engine import parse_workspace
+from library import atomic_write
+
+# 並べ替えに使えるキー
+SORT_KEYS = ('name', 'created', 'modified', 'blocks', 'size')
+
+
+def summarize_workspace(serialized):
+    """ワークスペースのブロック数と参照している画像名（重複なし・出現順）を返す"""
+    try:
+        top_blocks, _ = parse_workspace(serialized)
+    except Exception:
+        # 読めないデータでも目録からは外さない（ブロック数0として扱う）
+        return 0, []
+
+    count = 0
+    images = OrderedDict()
+    stack = list(reversed(top_blocks))
+    while stack:
+        block = stack.pop()
+        if not isinstance(block, dict):
+            continue
+        count += 1
+        image_name = (block.get('fields') or {}).get('IMAGE_NAME')
+        if isinstance(image_name, str) and image_name:
+            images[image_name] = True
+        children = []
+        for connection in (block.get('inputs') or {}).values():
+            if isinstance(connection, dict) and connection.get('block'):
+                children.append(connection['block'])
+        if isinstance(block.get('next'), dict) and block['next'].get('block'):
+            children.append(block['next']['block'])
+        stack.extend(reversed(children))
+    return count, list(images)
+
+
+def _entry(name, program, stat):
+    blocks, images = summarize_workspace(program.get('data'))
+    return {
+        'name': name,
+        'title': program.get('name') or name,
+        'created': program.get('created'),
+        'modified': program.get('modified'),
+        'failsafeEnabled': program.get('failsafeEnabled', True),
+        'blocks': blocks,
+        'images': images,
+        'size': stat.st_size,
+        'mtimeNs': stat.st_mtime_ns,
+    }
+
+
+class ProgramCatalog:
+    """保存済みプログラム（directory/*.json）の目録"""
+
+    def __init__(self, directory, index_path):
+        self.directory = directory
+        self.index_path = index_path
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self._entries = {entry['name']: entry for entry in data.get('programs', [])}
+            except (OSError, ValueError, KeyError, TypeError):
+                # 壊れた目録は作り直す
+                self._entries = {}
+        self.refresh()
+
+    def _persist(self):
+        data = {'programs': sorted(self._entries.values(), key=lambda entry: entry['name'])}
+        atomic_write(self.index_path, json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8'))
+
+    def _path(self, name):
+        return os.path.join(self.directory, f'{name}.json')
+
+    def record(self, name, program):
+        """保存したプログラム（name はファイル名、program は書き込んだ内容）を目録に反映する"""
+        stat = os.stat(self._path(name))
+        with self._lock:
+            entry = self._entries[name] = _entry(name, program, stat)
+            self._persist()
+            return entry
+
+    def refresh(self):
+        """ファイルの mtime/サイズが目録と異なるものだけ読み直し、変更があった件数を返す"""
+        found = {}
+        try:
+            with os.scandir(self.directory) as it:
+                for item in it:
+                    if item.name.endswith('.json') and item.is_file():
+                        found[item.name[:-5]] = item.stat()
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            changed = 0
+            for name in [name for name in self._entries if name not in found]:
+                del self._entries[name]
+                changed += 1
+            for name, stat in found.items():
+                entry = self._entries.get(name)
+                if entry is not None and entry.get('mtimeNs') == stat.st_mtime_ns and entry.get('size') == stat.st_size:
+                    continue
+                try:
+                    with open(self._path(name), 'r', encoding='utf-8') as f:
+                        program = json.load(f)
+                except (OSError, ValueError):
+                    program = {}
+                if not isinstance(program, dict):
+                    program = {}
+                self._entries[name] = _entry(name, program, stat)
+                changed += 1
+            if changed:
+                self._persist()
+            return changed
+
+    def query(self, search='', sort='name', order='asc', offset=0, limit=None, image=None):
+        """目録を絞り込み・並べ替えて (ページ分のエントリ, 該当件数) を返す
+
+        search は名前・表示名・参照画像名の部分一致（大文字小文字を区別しない）、
+        image は指定した画像を参照しているプログラムだけに絞り込む。
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f'並べ替えのキーは {", ".join(SORT_KEYS)} のいずれかです')
+        self.refresh()
+        with self._lock:
+            entries = list(self._entries.values())
+
+        if search:
+            needle = search.casefold()
+            entries = [
+                entry for entry in entries
+                if needle in entry['name'].casefold() or needle in str(entry.get('title', '')).casefold()
+                or any(needle in image_name.casefold() for image_name in entry.get('images', []))
+            ]
+        if image:
+            entries = [entry for entry in entries if image in entry.get('images', [])]
+
+        def sort_key(entry):
+            value = entry.get(sort)
+            if sort == 'name':
+                return (entry['name'].casefold(), entry['name'])
+            # 日時のないエントリは昇順で先頭に来るようにする
+            return (value is not None, value if value is not None else 0, entry['name'])
+
+        entries.sort(key=sort_key, reverse=(order == 'desc'))
+        total = len(entries)
+        end = None if limit is None else offset + limit
+        return [{k: v for k, v in entry.items() if k != 'mtimeNs'} for entry in entries[offset:end]], total
@@ -0,0 +1,263 @@
+"""入力操作のディスパッチャ
+
+pyautogui によるマウス・キーボード操作は、すべてこのモジュールの専用スレッド1本で
+順に実行する。複数のタブやAPIクライアントから同時に操作が届いても、1つの入力が
+終わるまで次の入力は始まらない。長押しや分割した貼り付けのように途中に待機を含む操作は
+押す・離す、断片1つ分の貼り付けのように入力ごとに分けて渡し、その間に他の入力が入る。
+
+フェイルセーフ（pyautogui.FAILSAFE）はプロセス全体の設定なので、クライアントごとの設定を
+InputSession に持たせ、ディスパッチャのスレッドが操作の直前に適用する。操作間の待機は
+pyautogui.PAUSE を使わず、InputSession が速度プロファイルの落ち着き時間から次の操作の
+締め切りを決め、呼び出し元のスレッドで待つ（ディスパッチャのスレッドは待機でふさがない）。
+待ち行列は上限付きで、あふれた場合は InputQueueFull を送出する。
+"""
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import pyautogui
+
+import timing
+from actions import StopRequested
+
+# 待ち時間の集計区切り（秒）
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class InputQueueFull(RuntimeError):
+    """入力操作の待ち行列がいっぱいの場合の例外"""
+
+
+class _InputRequest:
+    def __init__(self, fn, args, failsafe):
+        self.fn = fn
+        self.args = args
+        self.failsafe = failsafe
+        self.queued = time.perf_counter()
+        self.started = False
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class InputDispatcher:
+    """入力操作を専用スレッドで1件ずつ実行する"""
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'cancelled': 0,
+            'maxDepth': 0,
+            'waitSeconds': 0.0,
+            'maxWaitSeconds': 0.0,
+            'runSeconds': 0.0,
+        }
+        self._wait_buckets = [0] * (len(WAIT_BUCKETS) + 1)
+
+    def ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='input-dispatcher', daemon=True)
+                self._thread.start()
+
+    def call(self, fn, args=(), failsafe=True, stop_event=None):
+        """fn(*args) をディスパッチャのスレッドで実行し、その戻り値を返す
+
+        stop_event が設定された場合、まだ始まっていない操作は取り消して StopRequested を送出する。
+        """
+        if threading.current_thread() is self._thread:
+            # 操作の中から別の操作を呼んだ場合はそのまま実行する（自分自身を待たない）
+            return fn(*args)
+
+        self.ensure_started()
+        request = _InputRequest(fn, args, failsafe)
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise InputQueueFull(f'入力操作の待ち行列がいっぱいです（上限{self.maxsize}件）')
+        with self._lock:
+            self._stats['submitted'] += 1
+            self._stats['maxDepth'] = max(self._stats['maxDepth'], self._queue.qsize())
+
+        if stop_event is None:
+            request.done.wait()
+        else:
+            while not request.done.wait(0.05):
+                if stop_event.is_set():
+                    with self._lock:
+                        if not request.started:
+                            request.cancelled = True
+                    if request.cancelled:
+                        raise StopRequested('実行が停止されました')
+
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            with self._lock:
+                if request.cancelled:
+                    self._stats['cancelled'] += 1
+                    request.done.set()
+                    continue
+                waited = time.perf_counter() - request.queued
+                # 実行が始まった操作は取り消さない（呼び出し元は終了まで待つ）
+                request.started = True
+                self._stats['waitSeconds'] += waited
+                self._stats['maxWaitSeconds'] = max(self._stats['maxWaitSeconds'], waited)
+                self._wait_buckets[_bucket_index(waited)] += 1
+
+            start = time.perf_counter()
+            try:
+                pyautogui.FAILSAFE = request.failsafe
+                pyautogui.PAUSE = 0
+                request.result = request.fn(*request.args)
+            except BaseException as e:
+                request.error = e
+            elapsed = time.perf_counter() - start
+
+            with self._lock:
+                self._stats['runSeconds'] += elapsed
+                self._stats['failed' if request.error is not None else 'completed'] += 1
+            request.done.set()
+
+    def stats(self):
+        """待ち行列の深さ・待ち時間などの統計を返す"""
+        with self._lock:
+            stats = dict(self._stats)
+            buckets = list(self._wait_buckets)
+        started = stats['completed'] + stats['failed']
+        stats['depth'] = self._queue.qsize()
+        stats['maxsize'] = self.maxsize
+        stats['avgWaitSeconds'] = stats['waitSeconds'] / started if started else 0.0
+        # 累積件数（le は秒。最後の '+Inf' は全件）
+        stats['waitBuckets'] = [
+            {'le': bound, 'count': count}
+            for bound, count in zip(WAIT_BUCKETS + ('+Inf',), _cumulative(buckets))
+        ]
+        return stats
+
+
+def _bucket_index(seconds):
+    for index, bound in enumerate(WAIT_BUCKETS):
+        if seconds <= bound:
+            return index
+    return len(WAIT_BUCKETS)
+
+
+def _cumulative(counts):
+    total = 0
+    result = []
+    for count in counts:
+        total += count
+        result.append(total)
+    return result
+
+
+class InputSession:
+    """1クライアント分の入力設定
+
+    failsafe は画面の角へのマウス移動で停止する pyautogui のフェイルセーフ、
+    profile は操作のあとの落ち着き時間を決める速度プロファイル（timing.SpeedProfile）。
+    ready_at は前の操作の落ち着き時間が終わる時刻で、次の操作はそれまで待ってから始める。
+    """
+
+    def __init__(self, dispatcher, failsafe=True, profile=None, session_id=None):
+        self.id = session_id or uuid.uuid4().hex
+        self.dispatcher = dispatcher
+        self.failsafe = failsafe
+        self.profile = profile or timing.get_profile(timing.DEFAULT_SPEED)
+        self.ready_at = 0.0
+        self.pending_settle = 0.0
+        self.last_used = time.monotonic()
+        self._lock = threading.Lock()
+
+    def settings(self):
+        return {'failsafe': self.failsafe, 'speed': self.profile.name, 'pause': self.profile.uniform}
+
+    def derive(self, **settings):
+        """設定の一部を変えた一時的なセッションを返す（プログラムごとのフェイルセーフ・速度設定など）
+
+        直前の操作の落ち着き時間は引き継ぐ。
+        """
+        session = InputSession(self.dispatcher, settings.get('failsafe', self.failsafe),
+                               settings.get('profile') or self.profile, self.id)
+        with self._lock:
+            session.ready_at = self.ready_at
+            session.pending_settle = self.pending_settle
+        return session
+
+    def call(self, fn, *args, stop_event=None, action=None, report=None):
+        """前の操作の落ち着き時間が終わるのを待ってから fn(*args) をディスパッチャで実行する
+
+        action を渡した場合、終了後にその操作の落ち着き時間を次の操作の締め切りにする。
+        report（timing.TimingReport）には待った時間を settle として記録する。
+        """
+        self.last_used = time.monotonic()
+        with self._lock:
+            ready_at, requested = self.ready_at, self.pending_settle
+            self.pending_settle = 0.0
+        start = time.perf_counter()
+        if ready_at > start:
+            if not timing.sleep_until(ready_at, stop_event):
+                raise StopRequested('実行が停止されました')
+            if report is not None:
+                report.record('settle', requested, time.perf_counter() - start)
+        elif report is not None and requested:
+            # 締め切りを過ぎていた（前の操作のあとの処理で落ち着き時間が済んでいた）
+            report.record('settle', requested, 0.0)
+
+        try:
+            return self.dispatcher.call(fn, args, self.failsafe, stop_event)
+        finally:
+            if action is not None:
+                self.start_settle(action)
+
+    def start_settle(self, action):
+        """今から操作 action の落ち着き時間が終わるまでを、次の操作の締め切りにする"""
+        settle = self.profile.settle(action)
+        with self._lock:
+            self.ready_at = time.perf_counter() + settle
+            self.pending_settle = settle
+
+
+class SessionRegistry:
+    """セッションIDごとの InputSession（使われなくなった古いものから捨てる）"""
+
+    def __init__(self, dispatcher, limit=100, **defaults):
+        self.dispatcher = dispatcher
+        self.limit = limit
+        self.defaults = defaults
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id=None):
+        """セッションを返す（IDがないか未知の場合は新しく作る）"""
+        with self._lock:
+            session = self._sessions.get(session_id) if session_id else None
+            if session is None:
+                session = InputSession(self.dispatcher, session_id=session_id, **self.defaults)
+                self._sessions[session.id] = session
+                while len(self._sessions) > self.limit:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session.id)
+            return session
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
@@ -0,0 +1,854 @@
+"""Blocklyプログラムのサーバー側実行エンジン
+
+保存済みのBlocklyワークスペース（JSON/XML）を平坦な命令列にコンパイルし、
+ワーカースレッド上で実行する。ブラウザは開始・停止と進捗の取得だけを行う。
+
+命令は以下のタプルで表す。
+    ('action', 操作名, ((引数名, 式), ...), ブロックID)
+    ('set', 変数名, 式, ブロックID)
+    ('jump', 飛び先)
+    ('jump_if_false', 式, 飛び先, ブロックID)
+    ('loop_init', スロット, 回数の式, ブロックID)
+    ('loop_next', スロット, ループ終了時の飛び先)
+    ('each_init', スロット, リストの式, ブロックID)
+    ('each_next', スロット, ((変数名, 要素のキー), ...), ループ終了時の飛び先)
+
+式は ('const', 値) / ('var', 名前) / ('compare', 演算子, a, b) などのタプル。
+
+保存時にコンパイルした命令列（定数式は畳み込み済み）は CompiledStore に保存し、
+ワークスペースの内容が変わるまで実行のたびに使い回す。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from collections import OrderedDict, deque
+from datetime import datetime
+
+import metrics
+import timing
+from actions import ActionContext, StopRequested
+from library import atomic_write
+
+RUN_SECONDS = metrics.histogram('autonex_program_run_seconds', 'プログラム1回の実行時間（結果別）', ('status',),
+                                buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0))
+
+# 命令列の形式・コンパイラの版。変えた場合は保存済みのコンパイル結果がすべて作り直される
+COMPILER_VERSION = 1
+# 定数の畳み込みで計算するべき乗の指数の上限（巨大な整数の計算で保存が止まらないように）
+MAX_FOLD_EXPONENT = 64
+
+
+class CompileError(Exception):
+    """ワークスペースを命令列に変換できない場合の例外"""
+
+
+# 文として実行するブロック → (操作名, ((引数名, 種別, 入力/フィールド名, 既定値), ...))
+# 既定値はJavaScriptジェネレータ（blockly-init.js / blocks.js）に合わせている
+STATEMENT_BLOCKS = {
+    'mouse_click': ('mouse_click', (('x', 'input', 'X', 0), ('y', 'input', 'Y', 0))),
+    'mouse_move': ('mouse_move', (('x', 'input', 'X', 0), ('y', 'input', 'Y', 0))),
+    'mouse_move_absolute': ('mouse_move_absolute', (('x', 'input', 'X', 0), ('y', 'input', 'Y', 0))),
+    'mouse_move_relative': ('mouse_move_relative', (('x', 'input', 'X', 0), ('y', 'input', 'Y', 0))),
+    'mouse_move_to_image': ('mouse_move_to_image', (('imageName', 'field', 'IMAGE_NAME', ''),
+                                                    ('position', 'field', 'POSITION', 'center'))),
+    'mouse_scroll': ('mouse_scroll', (('amount', 'input', 'AMOUNT', 3),
+                                      ('direction', 'field', 'DIRECTION', 'down'))),
+    'mouse_single_click': ('mouse_single_click', (('button', 'field', 'BUTTON', 'left'),)),
+    'mouse_double_click': ('mouse_double_click', (('button', 'field', 'BUTTON', 'left'),)),
+    'mouse_triple_click': ('mouse_triple_click', (('button', 'field', 'BUTTON', 'left'),)),
+    'mouse_long_press': ('mouse_long_press', (('button', 'field', 'BUTTON', 'left'),
+                                              ('duration', 'input', 'DURATION', 1))),
+    'mouse_release': ('mouse_release', (('button', 'field', 'BUTTON', 'left'),)),
+    'mouse_middle_click': ('mouse_middle_click', ()),
+    'key_press': ('key_press', (('key', 'field', 'KEY', ''),)),
+    'type_text': ('type_text', (('text', 'field', 'TEXT', ''),)),
+    'type_text_variable': ('type_text', (('text', 'input', 'TEXT', ''),)),
+    'wait': ('wait', (('seconds', 'input', 'TIME', 1),)),
+    'browser_open_url': ('browser_open_url', (('url', 'field', 'URL', ''),)),
+    'browser_refresh': ('browser_refresh', ()),
+    'wait_for_element': ('wait_for_element', (('imageName', 'field', 'IMAGE_NAME', ''),
+                                              ('timeout', 'input', 'TIMEOUT', 30),
+                                              ('confidence', 'input', 'CONFIDENCE', 80))),
+}
+
+# 値を返す操作ブロック → (操作名, 引数定義)
+CALL_BLOCKS = {
+    'file_read_text': ('file_read_text', ()),
+    'file_read_path': ('file_read_path', (('path', 'input', 'PATH', ''),)),
+    'file_read_lines': ('file_read_lines', (('path', 'input', 'PATH', ''), ('start', 'input', 'START', 1),
+                                            ('count', 'input', 'COUNT', 1))),
+}
+
+REPEAT_BLOCKS = ('repeat_times', 'controls_repeat_ext', 'controls_repeat')
+
+# 操作の結果（リスト）の要素ごとに繰り返すブロック
+#   → (操作名, 引数定義, ((変数フィールド名, 要素のキー), ...))
+EACH_BLOCKS = {
+    'image_for_each': ('find_all_images', (('imageName', 'field', 'IMAGE_NAME', ''),
+                                           ('order', 'field', 'ORDER', 'rows'),
+                                           ('confidence', 'input', 'CONFIDENCE', 80)),
+                       (('VAR_X', 'center_x'), ('VAR_Y', 'center_y'))),
+}
+
+
+def _local_tag(tag):
+    # 名前空間付きのタグ（{https://developers.google.com/blockly/xml}block）から名前だけを取り出す
+    return tag.rsplit('}', 1)[-1]
+
+
+def _xml_block_to_dict(elem, variables):
+    block = {
+        'type': elem.get('type'),
+        'id': elem.get('id'),
+        'x': float(elem.get('x', 0)),
+        'y': float(elem.get('y', 0)),
+        'fields': {},
+        'inputs': {},
+    }
+    for child in elem:
+        tag = _local_tag(child.tag)
+        if tag == 'field':
+            if child.get('name') == 'VAR' or child.get('id'):
+                var_id = child.get('id') or (child.text or '')
+                variables.setdefault(var_id, child.text or '')
+                block['fields'][child.get('name')] = {'id': var_id}
+            else:
+                block['fields'][child.get('name')] = child.text or ''
+        elif tag in ('value', 'statement'):
+            connection = {}
+            for sub in child:
+                sub_tag = _local_tag(sub.tag)
+                if sub_tag in ('block', 'shadow'):
+                    connection[sub_tag] = _xml_block_to_dict(sub, variables)
+            block['inputs'][child.get('name')] = connection
+        elif tag == 'next':
+            for sub in child:
+                if _local_tag(sub.tag) in ('block', 'shadow'):
+                    block['next'] = {'block': _xml_block_to_dict(sub, variables)}
+        elif tag == 'mutation':
+            block['extraState'] = dict(child.attrib)
+    return block
+
+
+def parse_workspace(serialized):
+    """保存データからトップレベルのブロック列と変数表（ID→名前）を取り出す"""
+    if isinstance(serialized, dict):
+        state = serialized
+    else:
+        text = (serialized or '').strip()
+        if text.startswith('<'):
+            root = ET.fromstring(text)
+            variables = {}
+            blocks = []
+            for child in root:
+                tag = _local_tag(child.tag)
+                if tag == 'variables':
+                    for var in child:
+                        variables[var.get('id') or (var.text or '')] = var.text or ''
+                elif tag == 'block':
+                    blocks.append(_xml_block_to_dict(child, variables))
+            return _sort_top_blocks(blocks), variables
+        state = json.loads(text) if text else {}
+
+    variables = {v.get('id'): v.get('name') for v in state.get('variables', [])}
+    blocks = state.get('blocks', {}).get('blocks', [])
+    return _sort_top_blocks(blocks), variables
+
+
+def _sort_top_blocks(blocks):
+    # workspaceToCode と同じく、上から順（同じ高さなら左から）に実行する
+    return sorted(blocks, key=lambda b: (b.get('y', 0), b.get('x', 0)))
+
+
+def _number(value):
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+class Compiler:
+    """Blocklyのブロック木を命令列に変換する"""
+
+    def __init__(self, variables):
+        self.variables = variables
+        self.code = []
+        self.loop_slots = 0
+
+    def compile(self, top_blocks):
+        for block in top_blocks:
+            # トップレベルに置かれた値ブロックはJavaScript版と同様に無視する
+            if not self._is_expression(block):
+                self.compile_chain(block)
+        return self.code
+
+    def _is_expression(self, block):
+        return block.get('type') in CALL_BLOCKS or block.get('type') in (
+            'math_number', 'text', 'logic_boolean', 'variables_get', 'logic_compare',
+            'logic_operation', 'logic_negate', 'text_join', 'math_arithmetic', 'image_variable')
+
+    def _emit(self, instruction):
+        self.code.append(instruction)
+        return len(self.code) - 1
+
+    def _input_block(self, block, name):
+        connection = block.get('inputs', {}).get(name)
+        if not connection:
+            return None
+        return connection.get('block') or connection.get('shadow')
+
+    def _var_name(self, block, field_name='VAR'):
+        field = block.get('fields', {}).get(field_name)
+        if isinstance(field, dict):
+            return self.variables.get(field.get('id'), field.get('name') or field.get('id'))
+        return field
+
+    def compile_chain(self, block):
+        while block:
+            self.compile_statement(block)
+            block = (block.get('next') or {}).get('block')
+
+    def compile_statement(self, block):
+        block_type = block.get('type')
+        block_id = block.get('id')
+
+        if block_type in STATEMENT_BLOCKS:
+            action, params = STATEMENT_BLOCKS[block_type]
+            self._emit(('action', action, self._params(block, params), block_id))
+        elif block_type in REPEAT_BLOCKS:
+            if block_type == 'controls_repeat':
+                times = ('const', _number(block.get('fields', {}).get('TIMES', 10)))
+            else:
+                times = self.expression(self._input_block(block, 'TIMES'), 1)
+            slot = self.loop_slots
+            self.loop_slots += 1
+            self._emit(('loop_init', slot, times, block_id))
+            head = self._emit(('loop_next', slot, None))
+            self.compile_chain(self._input_block(block, 'DO'))
+            self._emit(('jump', head))
+            self.code[head] = ('loop_next', slot, len(self.code))
+        elif block_type in EACH_BLOCKS:
+            action, params, bindings = EACH_BLOCKS[block_type]
+            slot = self.loop_slots
+            self.loop_slots += 1
+            targets = tuple((self._var_name(block, field), key) for field, key in bindings)
+            self._emit(('each_init', slot, ('call', action, self._params(block, params)), block_id))
+            head = self._emit(('each_next', slot, targets, None))
+            self.compile_chain(self._input_block(block, 'DO'))
+            self._emit(('jump', head))
+            self.code[head] = ('each_next', slot, targets, len(self.code))
+        elif block_type == 'controls_whileUntil':
+            condition = self.expression(self._input_block(block, 'BOOL'), False)
+            if block.get('fields', {}).get('MODE') == 'UNTIL':
+                condition = ('not', condition)
+            head = self._emit(('jump_if_false', condition, None, block_id))
+            self.compile_chain(self._input_block(block, 'DO'))
+            self._emit(('jump', head))
+            self.code[head] = ('jump_if_false', condition, len(self.code), block_id)
+        elif block_type == 'controls_if':
+            end_jumps = []
+            index = 0
+            while f'IF{index}' in block.get('inputs', {}):
+                condition = self.expression(self._input_block(block, f'IF{index}'), False)
+                branch = self._emit(('jump_if_false', condition, None, block_id))
+                self.compile_chain(self._input_block(block, f'DO{index}'))
+                end_jumps.append(self._emit(('jump', None)))
+                self.code[branch] = ('jump_if_false', condition, len(self.code), block_id)
+                index += 1
+            self.compile_chain(self._input_block(block, 'ELSE'))
+            for position in end_jumps:
+                self.code[position] = ('jump', len(self.code))
+        elif block_type == 'variables_set':
+            self._emit(('set', self._var_name(block),
+                        self.expression(self._input_block(block, 'VALUE'), 0), block_id))
+        elif block_type == 'math_change':
+            name = self._var_name(block)
+            delta = self.expression(self._input_block(block, 'DELTA'), 1)
+            self._emit(('set', name, ('arith', 'ADD', ('var', name), delta), block_id))
+        else:
+            raise CompileError(f'未対応のブロックです: {block_type}')
+
+    def _params(self, block, specs):
+        params = []
+        for name, kind, source, default in specs:
+            if kind == 'field':
+                value = block.get('fields', {}).get(source, default)
+                params.append((name, ('const', default if value is None else value)))
+            else:
+                params.append((name, self.expression(self._input_block(block, source), default)))
+        return tuple(params)
+
+    def expression(self, block, default):
+        if block is None:
+            return ('const', default)
+
+        block_type = block.get('type')
+        fields = block.get('fields', {})
+
+        if block_type == 'math_number':
+            return ('const', _number(fields.get('NUM', 0)))
+        if block_type == 'text':
+            return ('const', fields.get('TEXT', ''))
+        if block_type == 'logic_boolean':
+            return ('const', fields.get('BOOL') == 'TRUE')
+        if block_type == 'image_variable':
+            return ('const', fields.get('IMAGE_NAME', ''))
+        if block_type == 'variables_get':
+            return ('var', self._var_name(block))
+        if block_type == 'logic_compare':
+            return ('compare', fields.get('OP', 'EQ'),
+                    self.expression(self._input_block(block, 'A'), 0),
+                    self.expression(self._input_block(block, 'B'), 0))
+        if block_type == 'logic_operation':
+            return ('logic', fields.get('OP', 'AND'),
+                    self.expression(self._input_block(block, 'A'), False),
+                    self.expression(self._input_block(block, 'B'), False))
+        if block_type == 'logic_negate':
+            return ('not', self.expression(self._input_block(block, 'BOOL'), True))
+        if block_type == 'math_arithmetic':
+            return ('arith', fields.get('OP', 'ADD'),
+                    self.expression(self._input_block(block, 'A'), 0),
+                    self.expression(self._input_block(block, 'B'), 0))
+        if block_type == 'text_join':
+            extra_state = block.get('extraState') or {}
+            count = int(extra_state.get('itemCount', extra_state.get('items', 2)))
+            return ('join', tuple(self.expression(self._input_block(block, f'ADD{index}'), '')
+                                  for index in range(count)))
+        if block_type in CALL_BLOCKS:
+            action, params = CALL_BLOCKS[block_type]
+            return ('call', action, self._params(block, params))
+
+        raise CompileError(f'未対応のブロックです: {block_type}')
+
+
+def compile_program(serialized):
+    """保存データを命令列に変換する"""
+    try:
+        top_blocks, variables = parse_workspace(serialized)
+    except (ValueError, ET.ParseError) as e:
+        raise CompileError(f'プログラムデータを解析できません: {e}')
+    return Compiler(variables).compile(top_blocks)
+
+
+def source_hash(serialized):
+    """保存データ（とコンパイラの版）のハッシュ。コンパイル結果を使い回せるかの判定に使う"""
+    if not isinstance(serialized, str):
+        serialized = json.dumps(serialized, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(f'{COMPILER_VERSION}\n{serialized}'.encode('utf-8')).hexdigest()
+
+
+def _fold(expr):
+    kind = expr[0]
+    if kind in ('compare', 'arith'):
+        a, b = _fold(expr[2]), _fold(expr[3])
+        folded = (kind, expr[1], a, b)
+        if a[0] != 'const' or b[0] != 'const':
+            return folded
+        if kind == 'arith' and expr[1] == 'POWER' and abs(_to_number(b[1])) > MAX_FOLD_EXPONENT:
+            return folded
+        try:
+            return ('const', (_compare if kind == 'compare' else _arith)(expr[1], a[1], b[1]))
+        except (ArithmeticError, CompileError, TypeError, ValueError):
+            # 0除算などは実行時に同じエラーになるよう、畳み込まずに残す
+            return folded
+    if kind == 'logic':
+        a, b = _fold(expr[2]), _fold(expr[3])
+        if a[0] == 'const':
+            # 実行時と同じ短絡評価（AND は偽、OR は真の左辺をそのまま返す）
+            return a if (expr[1] == 'AND') != bool(a[1]) else b
+        return ('logic', expr[1], a, b)
+    if kind == 'not':
+        operand = _fold(expr[1])
+        return ('const', not operand[1]) if operand[0] == 'const' else ('not', operand)
+    if kind == 'join':
+        items = tuple(_fold(item) for item in expr[1])
+        if all(item[0] == 'const' for item in items):
+            return ('const', ''.join('' if item[1] is None else _to_text(item[1]) for item in items))
+        return ('join', items)
+    if kind == 'call':
+        return ('call', expr[1], tuple((name, _fold(arg)) for name, arg in expr[2]))
+    return expr
+
+
+def fold_constants(code):
+    """定数だけからなる式（1 + 2、文字列の結合など）を実行前に計算しておいた命令列を返す"""
+    folded = []
+    for instruction in code:
+        op = instruction[0]
+        if op == 'action':
+            _, action, params, block_id = instruction
+            instruction = ('action', action, tuple((name, _fold(expr)) for name, expr in params), block_id)
+        elif op in ('set', 'loop_init', 'each_init'):
+            instruction = (op, instruction[1], _fold(instruction[2])) + tuple(instruction[3:])
+        elif op == 'jump_if_false':
+            instruction = ('jump_if_false', _fold(instruction[1])) + tuple(instruction[2:])
+        folded.append(instruction)
+    return folded
+
+
+def constant_calls(code):
+    """引数がすべて定数の操作を (操作名, 引数, ブロックID) として列挙する（保存時の検証用）"""
+
+    def visit(expr, block_id):
+        if expr[0] == 'call':
+            for _, arg in expr[2]:
+                yield from visit(arg, block_id)
+            if all(arg[0] == 'const' for _, arg in expr[2]):
+                yield expr[1], {name: arg[1] for name, arg in expr[2]}, block_id
+        elif expr[0] in ('compare', 'logic', 'arith'):
+            yield from visit(expr[2], block_id)
+            yield from visit(expr[3], block_id)
+        elif expr[0] == 'not':
+            yield from visit(expr[1], block_id)
+        elif expr[0] == 'join':
+            for item in expr[1]:
+                yield from visit(item, block_id)
+
+    for instruction in code:
+        op = instruction[0]
+        if op == 'action':
+            _, action, params, block_id = instruction
+            for _, expr in params:
+                yield from visit(expr, block_id)
+            if all(expr[0] == 'const' for _, expr in params):
+                yield action, {name: expr[1] for name, expr in params}, block_id
+        elif op in ('set', 'loop_init', 'each_init'):
+            yield from visit(instruction[2], instruction[3])
+        elif op == 'jump_if_false':
+            yield from visit(instruction[1], instruction[3])
+
+
+def find_problems(code, check):
+    """引数が定数の操作を check(操作名, 引数) で検証し、失敗したものを返す
+
+    check は不正な引数に例外を送出する。戻り値は [{'block', 'action', 'error'}, ...]。
+    """
+    problems = []
+    for action, values, block_id in constant_calls(code):
+        try:
+            check(action, values)
+        except Exception as e:
+            problems.append({'block': block_id, 'action': action, 'error': str(e)})
+    return problems
+
+
+def _tuplify(value):
+    # JSONから読み込んだ命令列（リスト）をコンパイル直後と同じタプルに戻す
+    if isinstance(value, list):
+        return tuple(_tuplify(item) for item in value)
+    return value
+
+
+class CompiledStore:
+    """コンパイル済みプログラムの保存先（directory/<プログラム名>.json）
+
+    保存データのハッシュが一致する間は保存済みの命令列を返し、一致しない場合
+    （ワークスペースの変更・コンパイラの更新）だけコンパイルし直す。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, f'{name}.json')
+
+    def load(self, name, digest):
+        """ハッシュが一致するコンパイル結果（なければ None）を返す"""
+        try:
+            with open(self.path(name), 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(record, dict) or record.get('sourceHash') != digest:
+            return None
+        record['code'] = list(_tuplify(record.get('code', [])))
+        return record
+
+    def compile(self, name, serialized):
+        """コンパイルして保存し、コンパイル結果を返す（CompileError はそのまま送出する）"""
+        digest = source_hash(serialized)
+        try:
+            code = fold_constants(compile_program(serialized))
+        except CompileError:
+            self.discard(name)
+            raise
+        images = []
+        for action, values, _ in constant_calls(code):
+            image_name = values.get('imageName')
+            if image_name and image_name not in images:
+                images.append(image_name)
+        record = {
+            'version': COMPILER_VERSION,
+            'sourceHash': digest,
+            'compiled': datetime.now().isoformat(),
+            'images': images,
+            'code': code,
+        }
+        atomic_write(self.path(name), json.dumps(record, ensure_ascii=False).encode('utf-8'))
+        return record
+
+    def get(self, name, serialized):
+        """(コンパイル結果, 保存済みのものを使ったか) を返す"""
+        record = self.load(name, source_hash(serialized))
+        if record is not None:
+            return record, True
+        return self.compile(name, serialized), False
+
+    def discard(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+
+def required_actions(code):
+    """命令列が使う操作名の集合を返す"""
+    names = set()
+
+    def visit(expr):
+        if expr[0] == 'call':
+            names.add(expr[1])
+            for _, arg in expr[2]:
+                visit(arg)
+        elif expr[0] in ('compare', 'logic', 'arith'):
+            visit(expr[2])
+            visit(expr[3])
+        elif expr[0] == 'not':
+            visit(expr[1])
+        elif expr[0] == 'join':
+            for item in expr[1]:
+                visit(item)
+
+    for instruction in code:
+        op = instruction[0]
+        if op == 'action':
+            names.add(instruction[1])
+            for _, expr in instruction[2]:
+                visit(expr)
+        elif op in ('set', 'loop_init', 'each_init'):
+            visit(instruction[2])
+        elif op == 'jump_if_false':
+            visit(instruction[1])
+    return names
+
+
+def _to_text(value):
+    # JavaScriptの文字列変換に合わせる（1.0 → "1", True → "true"）
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _to_number(value):
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return _number(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _compare(op, a, b):
+    if isinstance(a, (int, float)) or isinstance(b, (int, float)):
+        a, b = _to_number(a), _to_number(b)
+    if op == 'EQ':
+        return a == b
+    if op == 'NEQ':
+        return a != b
+    if op == 'LT':
+        return a < b
+    if op == 'LTE':
+        return a <= b
+    if op == 'GT':
+        return a > b
+    if op == 'GTE':
+        return a >= b
+    raise CompileError(f'未対応の比較演算子です: {op}')
+
+
+def _arith(op, a, b):
+    if op == 'ADD' and (isinstance(a, str) or isinstance(b, str)):
+        return _to_text(a) + _to_text(b)
+    a, b = _to_number(a), _to_number(b)
+    if op == 'ADD':
+        return a + b
+    if op == 'MINUS':
+        return a - b
+    if op == 'MULTIPLY':
+        return a * b
+    if op == 'DIVIDE':
+        return a / b
+    if op == 'POWER':
+        return a ** b
+    raise CompileError(f'未対応の演算子です: {op}')
+
+
+class ProgramRun:
+    """1回分のプログラム実行（ワーカースレッド）
+
+    listener を渡した場合、listener(run, 種類, データ) で実行の経過を通知する。
+    種類は run_start / step_start / step_end / log / run_end と、操作が
+    ActionContext.emit() で通知するもの（match など）。
+    timing には待機ブロック・長押し・落ち着き時間について、要求した秒数と実際に待った秒数を集計する。
+    variables には実行開始時の変数の値（バッチ実行でCSVの1行を渡すなど）を指定できる。
+    """
+
+    def __init__(self, name, code, handlers, max_logs=1000, listener=None, session=None, variables=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.code = code
+        self.handlers = handlers
+        self.status = 'pending'
+        self.error = None
+        self.steps = 0
+        self.current_block = None
+        self.started = None
+        self.finished = None
+        self.variables = dict(variables or {})
+        self.stop_event = threading.Event()
+        self._logs = deque(maxlen=max_logs)
+        self._log_seq = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self.listener = listener
+        self.session = session
+        self.timing = timing.TimingReport(session.profile if session is not None else None)
+
+    def start(self):
+        self.status = 'running'
+        self.started = datetime.now().isoformat()
+        self._thread = threading.Thread(target=self._run, name=f'program-run-{self.id[:8]}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    @property
+    def active(self):
+        return self.status in ('pending', 'running')
+
+    def emit(self, event_type, data):
+        if self.listener is None:
+            return
+        try:
+            self.listener(self, event_type, data)
+        except Exception:
+            # 通知の失敗で実行を止めない
+            pass
+
+    def log(self, message, log_type='info'):
+        with self._lock:
+            entry = {
+                'seq': self._log_seq,
+                'time': datetime.now().isoformat(),
+                'message': message,
+                'type': log_type,
+            }
+            self._logs.append(entry)
+            self._log_seq += 1
+        self.emit('log', {'entry': entry})
+
+    def snapshot(self, since=0):
+        with self._lock:
+            logs = [entry for entry in self._logs if entry['seq'] >= since]
+            next_seq = self._log_seq
+        return {
+            'runId': self.id,
+            'name': self.name,
+            'status': self.status,
+            'error': self.error,
+            'steps': self.steps,
+            'timing': self.timing.snapshot(),
+            'currentBlock': self.current_block,
+            'started': self.started,
+            'finished': self.finished,
+            'logs': logs,
+            'nextSeq': next_seq,
+        }
+
+    def _run(self):
+        start_time = time.perf_counter()
+        self.emit('run_start', {'name': self.name})
+        self.log('プログラム実行開始', 'info')
+        try:
+            self._execute(ActionContext(self.stop_event, lambda event_type, data: self.emit(
+                event_type, dict(data, block=self.current_block)), self.session, self.timing))
+            self.status = 'completed'
+            self.log('プログラム実行完了', 'success')
+            summary = self.timing.snapshot()
+            if summary['byKind']:
+                self.log(f'待機時間: 要求 {summary["requestedSeconds"]:.2f}秒 / 実際 {summary["actualSeconds"]:.2f}秒'
+                         f'（速度: {summary["profile"]}）', 'info')
+        except StopRequested:
+            self.status = 'stopped'
+            self.log('プログラムを停止しました', 'info')
+        except Exception as e:
+            self.status = 'error'
+            self.error = str(e)
+            self.log(f'エラー: {e}', 'error')
+        finally:
+            self.current_block = None
+            self.finished = datetime.now().isoformat()
+            elapsed = time.perf_counter() - start_time
+            RUN_SECONDS.observe(elapsed, status=self.status)
+            self.emit('run_end', {
+                'status': self.status,
+                'error': self.error,
+                'steps': self.steps,
+                'elapsedMs': round(elapsed * 1000, 1),
+                'timing': self.timing.snapshot(),
+            })
+
+    def _execute(self, ctx):
+        code = self.code
+        handlers = self.handlers
+        counters = {}
+        pc = 0
+        end = len(code)
+
+        while pc < end:
+            if self.stop_event.is_set():
+                raise StopRequested('実行が停止されました')
+
+            instruction = code[pc]
+            op = instruction[0]
+
+            if op == 'action':
+                _, action, params, block_id = instruction
+                self.current_block = block_id
+                self.emit('step_start', {'block': block_id, 'action': action, 'step': self.steps + 1})
+                step_start = time.perf_counter()
+                try:
+                    values = {name: self._eval(expr, ctx) for name, expr in params}
+                    message = handlers[action](values, ctx)
+                    ctx.step_done()
+                except Exception as e:
+                    self.emit('step_end', {
+                        'block': block_id, 'action': action, 'error': str(e),
+                        'status': 'stopped' if isinstance(e, StopRequested) else 'error',
+                        'ms': round((time.perf_counter() - step_start) * 1000, 1),
+                    })
+                    raise
+                self.steps += 1
+                self.emit('step_end', {
+                    'block': block_id, 'action': action, 'status': 'ok', 'message': message,
+                    'ms': round((time.perf_counter() - step_start) * 1000, 1),
+                })
+                if message:
+                    self.log(message, 'info')
+                pc += 1
+            elif op == 'jump':
+                pc = instruction[1]
+            elif op == 'jump_if_false':
+                pc = pc + 1 if self._eval(instruction[1], ctx) else instruction[2]
+            elif op == 'loop_next':
+                slot = instruction[1]
+                if counters[slot] <= 0:
+                    pc = instruction[2]
+                else:
+                    counters[slot] -= 1
+                    pc += 1
+            elif op == 'loop_init':
+                counters[instruction[1]] = int(_to_number(self._eval(instruction[2], ctx)))
+                pc += 1
+            elif op == 'each_next':
+                items = counters[instruction[1]]
+                if not items:
+                    pc = instruction[3]
+                else:
+                    item = items.popleft()
+                    for name, key in instruction[2]:
+                        self.variables[name] = item.get(key)
+                    pc += 1
+            elif op == 'each_init':
+                self.current_block = instruction[3]
+                counters[instruction[1]] = deque(self._eval(instruction[2], ctx) or ())
+                pc += 1
+            elif op == 'set':
+                self.current_block = instruction[3]
+                self.variables[instruction[1]] = self._eval(instruction[2], ctx)
+                pc += 1
+            else:
+                raise CompileError(f'不明な命令です: {op}')
+
+    def _eval(self, expr, ctx):
+        kind = expr[0]
+        if kind == 'const':
+            return expr[1]
+        if kind == 'var':
+            # 未代入の変数はJavaScript版と同様に空（undefined相当）として扱う
+            return self.variables.get(expr[1])
+        if kind == 'compare':
+            return _compare(expr[1], self._eval(expr[2], ctx), self._eval(expr[3], ctx))
+        if kind == 'logic':
+            left = self._eval(expr[2], ctx)
+            if expr[1] == 'AND':
+                return left and self._eval(expr[3], ctx)
+            return left or self._eval(expr[3], ctx)
+        if kind == 'not':
+            return not self._eval(expr[1], ctx)
+        if kind == 'arith':
+            return _arith(expr[1], self._eval(expr[2], ctx), self._eval(expr[3], ctx))
+        if kind == 'join':
+            return ''.join('' if value is None else _to_text(value)
+                           for value in (self._eval(item, ctx) for item in expr[1]))
+        if kind == 'call':
+            values = {name: self._eval(arg, ctx) for name, arg in expr[2]}
+            return self.handlers[expr[1]](values, ctx)
+        raise CompileError(f'不明な式です: {kind}')
+
+
+class RunManager:
+    """プログラム実行の管理（同時に実行できるのは1つだけ）"""
+
+    def __init__(self, history=20, listener=None):
+        self.history = history
+        self.listener = listener
+        self._runs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, name, code, handlers, session=None, variables=None):
+        missing = required_actions(code) - set(handlers)
+        if missing:
+            raise CompileError(f'未対応の操作です: {", ".join(sorted(missing))}')
+
+        with self._lock:
+            if self._active_locked():
+                raise RuntimeError('別のプログラムが実行中です')
+            run = ProgramRun(name, code, handlers, listener=self.listener, session=session, variables=variables)
+            self._runs[run.id] = run
+            while len(self._runs) > self.history:
+                self._runs.popitem(last=False)
+            run.start()
+        return run
+
+    def get(self, run_id):
+        with self._lock:
+            return self._runs.get(run_id)
+
+    def active(self):
+        with self._lock:
+            return self._active_locked()
+
+    def _active_locked(self):
+        for run in self._runs.values():
+            if run.active:
+                return run
+        return None
+
+    def list(self):
+        with self._lock:
+            return [
+                {'runId': run.id, 'name': run.name, 'status': run.status,
+                 'steps': run.steps, 'started': run.started, 'finished': run.finished}
+                for run in reversed(self._runs.values())
+            ]
@@ -0,0 +1,118 @@
+"""サーバーからブラウザへのイベント配信（Server-Sent Events）
+
+EventBus は購読者ごとに上限付きのキューを持ち、publish されたイベントを全購読者に配る。
+キューがあふれた場合は古いイベントから捨てるので、遅い購読者が他の購読者や
+配信元を止めることはない。PositionSampler は購読者がいる間だけマウス位置を
+一定間隔で調べ、位置が変わったときだけ配信する。
+"""
+import json
+import threading
+import time
+from collections import deque
+
+
+class Subscription:
+    """1購読者分のイベントキュー"""
+
+    def __init__(self, maxsize):
+        self._events = deque(maxlen=maxsize)
+        self._cond = threading.Condition()
+
+    def put(self, event):
+        with self._cond:
+            self._events.append(event)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """届いているイベントをすべて取り出す（なければ timeout 秒まで待つ）"""
+        with self._cond:
+            if not self._events:
+                self._cond.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+        return events
+
+
+class EventBus:
+    """イベントの配信元。イベントは {'seq', 'event', 'time', 'data'} の辞書"""
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._subscribers = set()
+        self._latest = {}
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def subscribe(self):
+        subscription = Subscription(self.maxsize)
+        with self._cond:
+            self._subscribers.add(subscription)
+            self._cond.notify_all()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._cond:
+            self._subscribers.discard(subscription)
+
+    def subscriber_count(self):
+        with self._cond:
+            return len(self._subscribers)
+
+    def wait_for_subscribers(self, timeout=None):
+        """購読者が現れるまで待ち、購読者がいれば True を返す"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._subscribers, timeout)
+
+    def latest(self, event_type):
+        """種類ごとの最後のイベント（接続直後の初期表示用）"""
+        with self._cond:
+            return self._latest.get(event_type)
+
+    def publish(self, event_type, data):
+        with self._cond:
+            self._seq += 1
+            event = {'seq': self._seq, 'event': event_type, 'time': time.time(), 'data': data}
+            self._latest[event_type] = event
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.put(event)
+        return event
+
+
+def format_sse(event):
+    """イベントを text/event-stream の1メッセージに整形する"""
+    data = json.dumps(event['data'], ensure_ascii=False, separators=(',', ':'))
+    return f"id: {event['seq']}\nevent: {event['event']}\ndata: {data}\n\n"
+
+
+class PositionSampler:
+    """購読者がいる間だけマウス位置を調べ、変化したときに 'position' イベントを配信する"""
+
+    def __init__(self, bus, read_position, hz=20):
+        self.bus = bus
+        self.read_position = read_position
+        self.interval = 1.0 / hz
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='position-sampler', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        last = None
+        while True:
+            if not self.bus.subscriber_count():
+                self.bus.wait_for_subscribers()
+                # 購読が途切れていた間の位置は分からないので、再開時は必ず配信する
+                last = None
+            try:
+                position = tuple(int(v) for v in self.read_position())
+            except Exception:
+                position = None
+            if position is not None and position != last:
+                self.bus.publish('position', {'x': position[0], 'y': position[1]})
+                last = position
+            time.sleep(self.interval)
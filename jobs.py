@@ -0,0 +1,175 @@
+"""時間のかかる操作のジョブ実行
+
+要素の出現待ちや長押しなど、数秒〜数十秒かかる操作をワーカースレッドで実行し、
+リクエストのスレッドはジョブIDを返してすぐに戻る。ジョブは ActionContext の
+停止イベントを持っており、cancel() するとマッチングのループや待機が
+停止イベントで起こされ、数ミリ秒で中断される。
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import metrics
+from actions import ActionContext, StopRequested
+
+JOB_SECONDS = metrics.histogram('autonex_job_seconds', 'ジョブの所要時間（結果別）', ('action', 'status'))
+
+
+class JobQueueFull(RuntimeError):
+    """実行待ちのジョブが上限に達した場合の例外"""
+
+
+class JobError(Exception):
+    """ジョブの失敗。result に失敗時までの結果（検索したフレーム数など）を持たせられる"""
+
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result
+
+
+class Job:
+    """1件のジョブ
+
+    fn(ctx) を実行し、戻り値（JSONに変換できる値）を result に保持する。
+    listener を渡した場合、listener(job, 種類, データ) で job_start / job_end と、
+    操作が ActionContext.emit() で通知するもの（match など）を通知する。
+    """
+
+    def __init__(self, action, fn, listener=None, session=None):
+        self.id = uuid.uuid4().hex
+        self.action = action
+        self.fn = fn
+        self.listener = listener
+        self.session = session
+        self.status = 'pending'
+        self.result = None
+        self.error = None
+        self.created = datetime.now().isoformat()
+        self.started = None
+        self.finished = None
+        self.elapsed_ms = None
+        self.stop_event = threading.Event()
+        self._done = threading.Event()
+
+    @property
+    def active(self):
+        return self.status in ('pending', 'running')
+
+    def cancel(self):
+        self.stop_event.set()
+
+    def wait(self, timeout=None):
+        """ジョブの終了を待ち、終了していれば True を返す"""
+        return self._done.wait(timeout)
+
+    def emit(self, event_type, data):
+        if self.listener is None:
+            return
+        try:
+            self.listener(self, event_type, data)
+        except Exception:
+            # 通知の失敗でジョブを止めない
+            pass
+
+    def snapshot(self):
+        return {
+            'jobId': self.id,
+            'action': self.action,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'elapsedMs': self.elapsed_ms,
+        }
+
+    def run(self):
+        start_time = time.perf_counter()
+        self.started = datetime.now().isoformat()
+        try:
+            if self.stop_event.is_set():
+                # 待ち行列にいる間に取り消された
+                raise StopRequested('ジョブが取り消されました')
+            self.status = 'running'
+            self.emit('job_start', {'action': self.action})
+            ctx = ActionContext(self.stop_event, lambda event_type, data: self.emit(event_type, data),
+                                self.session)
+            self.result = self.fn(ctx)
+            self.status = 'completed'
+        except StopRequested:
+            self.status = 'cancelled'
+            self.error = 'ジョブが取り消されました'
+        except JobError as e:
+            self.status = 'failed'
+            self.error = str(e)
+            self.result = e.result
+        except Exception as e:
+            self.status = 'failed'
+            self.error = str(e)
+        finally:
+            self.finished = datetime.now().isoformat()
+            self.elapsed_ms = round((time.perf_counter() - start_time) * 1000, 1)
+            JOB_SECONDS.observe(self.elapsed_ms / 1000, action=self.action, status=self.status)
+            self._done.set()
+            self.emit('job_end', {
+                'action': self.action,
+                'status': self.status,
+                'result': self.result,
+                'error': self.error,
+                'elapsedMs': self.elapsed_ms,
+            })
+
+
+class JobManager:
+    """ジョブの受付と実行（最大 workers 件を並行して実行する）
+
+    実行を待っているジョブが max_pending 件を超える場合、submit() は JobQueueFull を送出する。
+    """
+
+    def __init__(self, workers=4, history=100, listener=None, max_pending=64):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.history = history
+        self.listener = listener
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+
+    def submit(self, action, fn, session=None):
+        job = Job(action, fn, listener=self.listener, session=session)
+        with self._lock:
+            active = sum(1 for old in self._jobs.values() if old.active)
+            if active >= self.workers + self.max_pending:
+                raise JobQueueFull(f'実行待ちのジョブが多すぎます（上限{self.max_pending}件）')
+            self._jobs[job.id] = job
+            # 終了済みのジョブから古い順に捨てる
+            for job_id in [job_id for job_id, old in self._jobs.items() if not old.active]:
+                if len(self._jobs) <= self.history:
+                    break
+                del self._jobs[job_id]
+        self._executor.submit(job.run)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return [
+                {'jobId': job.id, 'action': job.action, 'status': job.status,
+                 'created': job.created, 'finished': job.finished}
+                for job in reversed(self._jobs.values())
+            ]
+
+    def cancel_all(self):
+        """実行中・待機中のジョブをすべて取り消し、取り消した件数を返す"""
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if job.active]
+        for job in jobs:
+            job.cancel()
+        return len(jobs)
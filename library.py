@@ -0,0 +1,188 @@
+"""画像ライブラリの保存と索引
+
+images.json は起動時に一度だけ読み込み、名前 → レコードの索引としてメモリに保持する。
+更新は書き込みロックの下で行い、一時ファイルに書き出してから置き換えることで、
+途中で失敗しても images.json が壊れないようにする。
+サムネイルは thumbs/ 以下に生成してキャッシュし、元画像が更新されたら作り直す。
+"""
+import glob
+import json
+import os
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from io import BytesIO
+
+from PIL import Image
+
+
+class DuplicateImageError(ValueError):
+    """同じ名前の画像が既に登録されている場合の例外"""
+
+
+def atomic_write(path, data):
+    """同じディレクトリの一時ファイルに書き込んでから path を置き換える"""
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix=os.path.splitext(path)[1])
+    try:
+        os.chmod(tmp_path, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class ImageLibrary:
+    """画像ライブラリ（画像ファイルと images.json）"""
+
+    def __init__(self, directory, index_path):
+        self.directory = directory
+        self.index_path = index_path
+        self.thumbnail_dir = os.path.join(directory, 'thumbs')
+        self._lock = threading.RLock()
+        self._records = OrderedDict()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            self._persist()
+            return
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for record in data.get('images', []):
+            self._records[record['name']] = record
+
+    def _persist(self, records=None):
+        records = self._records if records is None else records
+        data = {'images': list(records.values())}
+        atomic_write(self.index_path, json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8'))
+
+    def _commit(self, records):
+        # 変更後の索引を保存できた場合だけメモリ上の索引を置き換える
+        self._persist(records)
+        self._records = records
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._records
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
+    def get(self, name):
+        """レコードのコピーを返す（未登録の場合はNone）"""
+        with self._lock:
+            record = self._records.get(name)
+            return dict(record) if record is not None else None
+
+    def path(self, name):
+        """画像ファイルのパスを返す（未登録の場合はNone）"""
+        with self._lock:
+            record = self._records.get(name)
+            return os.path.join(self.directory, record['filename']) if record is not None else None
+
+    def list(self):
+        with self._lock:
+            return [dict(record) for record in self._records.values()]
+
+    def add(self, name, png_bytes):
+        """PNGデータを保存して登録し、レコードのコピーを返す
+
+        同名の画像がある場合はファイルを書かずに DuplicateImageError を送出する。
+        """
+        with self._lock:
+            if name in self._records:
+                raise DuplicateImageError(f'名前「{name}」は既に使用されています')
+
+            unique_id = str(uuid.uuid4())
+            record = {
+                'id': unique_id,
+                'name': name,
+                'filename': f'{unique_id}.png',
+                'created': datetime.now().isoformat()
+            }
+            filepath = os.path.join(self.directory, record['filename'])
+            atomic_write(filepath, png_bytes)
+
+            records = OrderedDict(self._records)
+            records[name] = record
+            try:
+                self._commit(records)
+            except BaseException:
+                # 索引を保存できなかった場合は画像ファイルも残さない
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+                raise
+            return dict(record)
+
+    def update(self, name, **fields):
+        """レコードの項目を更新して保存し、更新後のコピーを返す（未登録の場合はNone）"""
+        with self._lock:
+            if name not in self._records:
+                return None
+            records = OrderedDict(self._records)
+            records[name] = dict(records[name], **fields)
+            self._commit(records)
+            return dict(records[name])
+
+    def remove(self, name):
+        """登録を削除して画像ファイルも消し、削除したレコードを返す（未登録の場合はNone）"""
+        with self._lock:
+            if name not in self._records:
+                return None
+            records = OrderedDict(self._records)
+            record = records.pop(name)
+            self._commit(records)
+
+        paths = [os.path.join(self.directory, record['filename'])]
+        paths += glob.glob(os.path.join(self.thumbnail_dir, f"{record['id']}_*.png"))
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return dict(record)
+
+    def thumbnail(self, name, size):
+        """短辺を size px に縮小したサムネイルのパスを返す（未登録の場合はNone）
+
+        元画像が size より小さい場合は拡大しない。元画像が存在しない場合は
+        FileNotFoundError を送出する。
+        """
+        with self._lock:
+            record = self._records.get(name)
+        if record is None:
+            return None
+
+        source = os.path.join(self.directory, record['filename'])
+        source_mtime = os.stat(source).st_mtime_ns
+        path = os.path.join(self.thumbnail_dir, f"{record['id']}_{size}.png")
+        try:
+            if os.stat(path).st_mtime_ns >= source_mtime:
+                return path
+        except FileNotFoundError:
+            pass
+
+        with Image.open(source) as image:
+            scale = size / min(image.size)
+            if scale < 1:
+                image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                                     Image.LANCZOS)
+            data = BytesIO()
+            image.save(data, 'PNG', optimize=True)
+
+        os.makedirs(self.thumbnail_dir, exist_ok=True)
+        atomic_write(path, data.getvalue())
+        return path
@@ -0,0 +1,490 @@
+"""テンプレート画像のキャッシュと画像マッチング
+
+画像ライブラリのテンプレートはデコード済みの配列としてメモリに保持し、
+ファイルの更新日時とサイズで有効性を確認する。容量の上限を超えた場合は
+最も長く使われていないものから破棄する（LRU）。
+
+照合の色の扱いは画像ごとに color（BGRの3チャンネル）/ gray（グレースケール、計算量は約1/3）/
+masked（PNGのアルファチャンネルを重みにして、透明な部分を照合から除く）から選ぶ。
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+import metrics
+
+
+# 照合の色の扱い
+COLOR_MODES = ('color', 'gray', 'masked')
+DEFAULT_COLOR_MODE = 'color'
+
+
+def read_template(path):
+    """画像ファイルを (BGR画像, アルファチャンネル) として読み込む（アルファがなければNone）
+
+    16ビットのPNGは8ビットに、グレースケールのPNGはBGRに変換する。読み込めない場合はNone。
+    """
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        return None
+    if image.dtype == np.uint16:
+        image = (image >> 8).astype(np.uint8)
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR), None
+    if image.shape[2] == 4:
+        return np.ascontiguousarray(image[:, :, :3]), image[:, :, 3]
+    return image, None
+
+
+class Template:
+    """デコード済みのテンプレート画像と、そこから導出したデータ
+
+    mask は透明な画素を含む画像だけに作る、アルファを 0～1 にした重み（float32）。
+    """
+
+    def __init__(self, name, path, stat, bgr, alpha=None):
+        self.name = name
+        self.path = path
+        self.mtime_ns = stat.st_mtime_ns
+        self.file_size = stat.st_size
+        self.bgr = bgr
+        self.gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+        self.mask = alpha.astype(np.float32) / 255.0 if alpha is not None and alpha.min() < 255 else None
+        self.height, self.width = bgr.shape[:2]
+        self.derived = {}
+        self.nbytes = self.bgr.nbytes + self.gray.nbytes + (self.mask.nbytes if self.mask is not None else 0)
+
+    def is_current(self, stat):
+        return stat.st_mtime_ns == self.mtime_ns and stat.st_size == self.file_size
+
+    def pattern(self, color_mode=DEFAULT_COLOR_MODE):
+        """照合に使う (テンプレート画像, マスク) を返す（透明な画素がなければ masked も color と同じ）"""
+        if color_mode == 'gray':
+            return self.gray, None
+        if color_mode == 'masked':
+            return self.bgr, self.mask
+        return self.bgr, None
+
+
+class TemplateCache:
+    """画像名 → Template のLRUキャッシュ
+
+    resolve_path は画像名からファイルパスを返す関数（ライブラリに無い場合はNone）。
+    """
+
+    def __init__(self, resolve_path, max_bytes=128 * 1024 * 1024):
+        self.resolve_path = resolve_path
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name):
+        """テンプレートを返す
+
+        ライブラリに登録されていない場合はNone、登録はあるが画像ファイルが
+        存在しない場合は FileNotFoundError を送出する。
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+
+        if entry is not None:
+            try:
+                stat = os.stat(entry.path)
+            except OSError:
+                stat = None
+            if stat is not None and entry.is_current(stat):
+                with self._lock:
+                    if name in self._entries:
+                        self._entries.move_to_end(name)
+                    self.hits += 1
+                return entry
+            self.invalidate(name)
+
+        with self._lock:
+            self.misses += 1
+
+        path = self.resolve_path(name)
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise FileNotFoundError(path)
+
+        decoded = read_template(path)
+        if decoded is None:
+            raise FileNotFoundError(path)
+
+        entry = Template(name, path, stat, *decoded)
+        self._store(entry)
+        return entry
+
+    def derive(self, entry, key, build):
+        """テンプレートから導出したデータ（縮小画像など）を遅延生成してキャッシュする"""
+        value = entry.derived.get(key)
+        if value is None:
+            value = build(entry)
+            with self._lock:
+                if key not in entry.derived:
+                    entry.derived[key] = value
+                    added = getattr(value, 'nbytes', 0)
+                    entry.nbytes += added
+                    if self._entries.get(entry.name) is entry:
+                        self._bytes += added
+                        self._evict_locked()
+                value = entry.derived[key]
+        return value
+
+    def invalidate(self, name):
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                self._bytes -= entry.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hitRatio': round(self.hits / total, 4) if total else 0.0,
+            }
+
+    def _store(self, entry):
+        # 1枚で上限を超える画像はキャッシュせずにそのまま使う
+        if entry.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(entry.name, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._entries[entry.name] = entry
+            self._bytes += entry.nbytes
+            self._evict_locked()
+
+    def _evict_locked(self):
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self.evictions += 1
+
+
+# 画像マッチング
+MATCH_MODES = ('exhaustive', 'pyramid')
+
+MATCH_SECONDS = metrics.histogram('autonex_match_seconds', 'テンプレートマッチング1回の所要時間', ('mode',))
+MATCH_CONFIDENCE = metrics.histogram('autonex_match_confidence', 'テンプレートマッチングの最大信頼度', ('mode',),
+                                     buckets=metrics.CONFIDENCE_BUCKETS)
+
+
+def screen_for(screen, template):
+    """テンプレートがグレースケールの場合は画面もグレースケールに変換する"""
+    if template.ndim == 2 and screen.ndim == 3:
+        return cv2.cvtColor(screen, cv2.COLOR_BGR2GRAY)
+    return screen
+
+
+def _match_result(screen, template, mask=None):
+    screen = screen_for(screen, template)
+    if mask is None:
+        return cv2.matchTemplate(screen, template, cv2.TM_CCOEFF_NORMED)
+    result = cv2.matchTemplate(screen, template, cv2.TM_CCOEFF_NORMED, mask=mask)
+    # マスク内が単色の位置は分母が0になり NaN / inf になるので、一致しないものとして扱う
+    np.nan_to_num(result, copy=False, nan=-1.0, posinf=-1.0, neginf=-1.0)
+    return np.clip(result, -1.0, 1.0, out=result)
+
+
+def match_exhaustive(screen, template, mask=None):
+    """画面全体でテンプレートマッチングし、(最大信頼度, (x, y)) を返す"""
+    result = _match_result(screen, template, mask)
+    _, max_val, _, max_loc = cv2.minMaxLoc(result)
+    return float(max_val), max_loc
+
+
+def pyramid_scale(screen_shape, template_shape, min_screen_width=640, min_template_side=10):
+    """縮小探索に使う倍率を決める（1.0の場合は縮小しない）
+
+    画面幅が min_screen_width 未満、またはテンプレートの短辺が
+    min_template_side 未満にならない範囲で1/2ずつ縮小する。
+    """
+    screen_width = screen_shape[1]
+    template_side = min(template_shape[:2])
+    scale = 1.0
+    while screen_width * scale / 2 >= min_screen_width and template_side * scale / 2 >= min_template_side:
+        scale /= 2
+    return scale
+
+
+def downscale(image, scale):
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+def _top_peaks(result, count, suppress_w, suppress_h):
+    # 最大値の周辺を塗りつぶしながら上位の候補位置を取り出す
+    result = result.copy()
+    peaks = []
+    for _ in range(count):
+        _, max_val, _, max_loc = cv2.minMaxLoc(result)
+        if peaks and max_val <= -1.0:
+            break
+        peaks.append((float(max_val), max_loc))
+        x, y = max_loc
+        result[max(0, y - suppress_h):y + suppress_h + 1, max(0, x - suppress_w):x + suppress_w + 1] = -1.0
+    return peaks
+
+
+def match_pyramid(screen, template, scale=None, small_template=None, candidates=5, small_screen=None, mask=None,
+                  small_mask=None):
+    """縮小画像で候補位置を求め、原寸の小さな窓の中だけで精密に探索する
+
+    戻り値は match_exhaustive と同じ (最大信頼度, (x, y))。
+    同じ画面を複数のテンプレートで探す場合は、縮小済みの画面を small_screen で渡せる。
+    """
+    if scale is None:
+        scale = pyramid_scale(screen.shape, template.shape)
+    if scale >= 1.0:
+        return match_exhaustive(screen, template, mask)
+
+    h, w = template.shape[:2]
+    screen = screen_for(screen, template)
+    screen_h, screen_w = screen.shape[:2]
+    if small_template is None:
+        small_template = downscale(template, scale)
+    if small_screen is None:
+        small_screen = downscale(screen, scale)
+    if mask is not None and small_mask is None:
+        small_mask = downscale(mask, scale)
+
+    coarse = _match_result(small_screen, small_template, small_mask)
+    small_h, small_w = small_template.shape[:2]
+    peaks = _top_peaks(coarse, candidates, max(1, small_w // 2), max(1, small_h // 2))
+
+    # 縮小による位置の誤差を吸収できる余白を付けて原寸で探索する
+    margin = int(round(2 / scale)) + 2
+    best_val, best_loc = -1.0, (0, 0)
+    for _, (sx, sy) in peaks:
+        x0 = max(0, int(sx / scale) - margin)
+        y0 = max(0, int(sy / scale) - margin)
+        x1 = min(screen_w, int(sx / scale) + w + margin)
+        y1 = min(screen_h, int(sy / scale) + h + margin)
+        if x1 - x0 < w or y1 - y0 < h:
+            continue
+        val, (lx, ly) = match_exhaustive(screen[y0:y1, x0:x1], template, mask)
+        if val > best_val:
+            best_val, best_loc = val, (x0 + lx, y0 + ly)
+    return best_val, best_loc
+
+
+def match(screen, template, mode='exhaustive', small_template=None, scale=None, small_screen=None, mask=None,
+          small_mask=None):
+    """指定した方式でテンプレートマッチングする（所要時間と最大信頼度を記録する）
+
+    template がグレースケールの場合、画面はここでグレースケールに変換する。mask を渡した場合は
+    その重みで照合する（0の画素は無視される）。
+    """
+    if mode not in MATCH_MODES:
+        raise ValueError(f'不明なマッチング方式です: {mode}')
+    start = time.perf_counter()
+    if mode == 'pyramid':
+        val, loc = match_pyramid(screen, template, scale=scale, small_template=small_template, small_screen=small_screen,
+                                 mask=mask, small_mask=small_mask)
+    else:
+        val, loc = match_exhaustive(screen, template, mask)
+    MATCH_SECONDS.observe(time.perf_counter() - start, mode=mode)
+    MATCH_CONFIDENCE.observe(val, mode=mode)
+    return val, loc
+
+
+# 画面上のすべての出現位置
+READING_ORDERS = ('rows', 'columns', 'confidence')
+
+
+def _overlap_ratio(a, b, w, h):
+    # 同じ大きさの矩形 a, b（左上座標）の重なり面積 / 矩形1つの面積
+    dx = w - abs(a[0] - b[0])
+    dy = h - abs(a[1] - b[1])
+    if dx <= 0 or dy <= 0:
+        return 0.0
+    return dx * dy / float(w * h)
+
+
+def sort_reading_order(found, template_shape, order='rows'):
+    """(信頼度, (x, y)) のリストを読み順に並べ替える
+
+    rows は上の行から左→右、columns は左の列から上→下の順。位置のずれが
+    テンプレートの高さ（幅）の半分以内なら同じ行（列）とみなす。
+    confidence は信頼度の高い順。
+    """
+    if order == 'confidence':
+        return sorted(found, key=lambda item: -item[0])
+    if order not in READING_ORDERS:
+        raise ValueError(f'不明な並び順です: {order}')
+
+    template_h, template_w = template_shape[:2]
+    major, minor, tolerance = (1, 0, template_h / 2) if order == 'rows' else (0, 1, template_w / 2)
+    ordered = []
+    line = []
+    line_start = None
+    for item in sorted(found, key=lambda item: item[1][major]):
+        position = item[1][major]
+        if line and position - line_start > tolerance:
+            ordered.extend(sorted(line, key=lambda entry: entry[1][minor]))
+            line = []
+        if not line:
+            line_start = position
+        line.append(item)
+    ordered.extend(sorted(line, key=lambda entry: entry[1][minor]))
+    return ordered
+
+
+def find_all(screen, template, confidence, max_results=100, overlap=0.3, order='rows', mask=None):
+    """信頼度が confidence 以上の位置をすべて求め、(信頼度, (x, y)) のリストを返す
+
+    近傍の極大値だけを候補にしてから、信頼度の高い順に、採用済みの位置と
+    overlap を超えて重なる候補を捨てる（non-maximum suppression）。
+    """
+    start = time.perf_counter()
+    template_h, template_w = template.shape[:2]
+    result = _match_result(screen, template, mask)
+
+    # 周囲（テンプレートの半分程度）で最大の位置だけを残す
+    kernel = np.ones((max(1, template_h // 2) | 1, max(1, template_w // 2) | 1), np.uint8)
+    peaks = (result >= confidence) & (result >= cv2.dilate(result, kernel))
+    ys, xs = np.nonzero(peaks)
+    scores = result[ys, xs]
+
+    kept = []
+    for index in np.argsort(-scores, kind='stable'):
+        location = (int(xs[index]), int(ys[index]))
+        if all(_overlap_ratio(location, other, template_w, template_h) <= overlap for _, other in kept):
+            kept.append((float(scores[index]), location))
+            if len(kept) >= max_results:
+                break
+    MATCH_SECONDS.observe(time.perf_counter() - start, mode='find_all')
+    return sort_reading_order(kept, template.shape, order)
+
+
+# 探索範囲と前回検出位置のヒント
+def normalize_region(region, screen_size, template_shape):
+    """探索範囲 (x, y, width, height) を画面内に収める
+
+    範囲がテンプレートより小さくなる場合は ValueError を送出する。
+    """
+    screen_w, screen_h = screen_size
+    x, y, w, h = (int(v) for v in region)
+    if w <= 0 or h <= 0:
+        raise ValueError('探索範囲の幅と高さは1以上で指定してください')
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(screen_w, x + w), min(screen_h, y + h)
+    template_h, template_w = template_shape[:2]
+    if x1 - x0 < template_w or y1 - y0 < template_h:
+        raise ValueError('探索範囲が画面外か、画像より小さくなっています')
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def hint_window(hint, template_shape, screen_size, margin):
+    """前回検出位置の周辺 margin px の窓を返す（画面に収まらない場合はNone）"""
+    template_h, template_w = template_shape[:2]
+    x, y = hint
+    try:
+        return normalize_region((x - margin, y - margin, template_w + margin * 2, template_h + margin * 2),
+                                screen_size, template_shape)
+    except ValueError:
+        return None
+
+
+class LocationHints:
+    """テンプレートごとの前回検出位置（左上座標）"""
+
+    def __init__(self):
+        self._hints = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._hints.get(key)
+
+    def remember(self, key, x, y):
+        with self._lock:
+            self._hints[key] = (int(x), int(y))
+
+    def forget(self, key):
+        with self._lock:
+            self._hints.pop(key, None)
+
+
+# 画面の変化検出
+class ChangeDetector:
+    """縮小した画像を比較して、画面の変化した範囲を求める
+
+    フレームを cell px 四方ごとにチャンネル別に平均した画像にし、いずれかのチャンネルで
+    平均値（0～255）の差が threshold を超えたセルを変化とみなす。輝度の変わらない色の変化
+    （同じ明るさの赤と緑など）も検出できる。threshold=2 なら、16px四方のセル（256画素）では
+    3画素以上が黒から白に変わると超え、1～2画素だけの変化や圧縮ノイズは無視する。
+    比較の基準は最後に変化を検出したフレームなので、少しずつ進む変化も積み重なった時点で検出できる。
+    """
+
+    def __init__(self, cell=16, threshold=2):
+        self.cell = cell
+        self.threshold = threshold
+        self._baseline = None
+
+    def reset(self):
+        self._baseline = None
+
+    def update(self, frame):
+        """変化した範囲 (x, y, width, height) を返す（変化なしはNone、初回はフレーム全体）"""
+        h, w = frame.shape[:2]
+        small = cv2.resize(frame, (max(1, w // self.cell), max(1, h // self.cell)),
+                           interpolation=cv2.INTER_AREA)
+
+        baseline = self._baseline
+        if baseline is None or baseline.shape != small.shape:
+            self._baseline = small
+            return (0, 0, w, h)
+
+        diff = cv2.absdiff(small, baseline)
+        if diff.ndim == 3:
+            # チャンネルごとの差のうち最大のもので判定する
+            diff = diff.max(axis=2)
+        ys, xs = np.nonzero(diff > self.threshold)
+        if len(xs) == 0:
+            return None
+        self._baseline = small
+
+        scale_x = w / small.shape[1]
+        scale_y = h / small.shape[0]
+        x0, y0 = int(xs.min() * scale_x), int(ys.min() * scale_y)
+        x1 = min(w, int(math.ceil((xs.max() + 1) * scale_x)))
+        y1 = min(h, int(math.ceil((ys.max() + 1) * scale_y)))
+        return (x0, y0, x1 - x0, y1 - y0)
+
+
+def affected_window(changed, template_shape, frame_size):
+    """変化範囲に一部でも重なるテンプレート位置をすべて含む探索範囲を返す"""
+    template_h, template_w = template_shape[:2]
+    x, y, w, h = changed
+    try:
+        return normalize_region((x - template_w + 1, y - template_h + 1,
+                                 w + (template_w - 1) * 2, h + (template_h - 1) * 2),
+                                frame_size, template_shape)
+    except ValueError:
+        return None
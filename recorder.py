@@ -0,0 +1,592 @@
+"""入力操作の記録
+
+記録中のマウス・キーボードのイベントを取得元（EventSource）から受け取り、固定長の
+リングバッファに (種類, 時刻, x, y, 詳細) のタプルで追加するだけにして、OSの入力フックを
+待たせない。記録を終えたあとで build_steps() がイベント列をブロックに変換する。
+
+    - マウスの軌跡は Douglas–Peucker 法で間引き、途中で止まった位置だけを残す
+    - 押してから離すまでをクリック・ダブル/トリプルクリック・長押しにまとめる
+    - 続けて入力した文字は1つの type_text にまとめる（途中の BackSpace は反映済みにする）
+    - 続けて回したスクロールは1つの mouse_scroll にまとめる
+    - 操作の間の空き時間のうち idle 秒以上のものだけを wait にする
+
+イベントの取得元:
+    pynput    : pynput のグローバルフック（全OS対応、pynput のインストールが必要）
+    synthetic : 渡されたイベント列を流す（テスト用）
+"""
+import platform
+import threading
+import time
+import uuid
+from collections import deque
+
+import numpy as np
+
+RECORD_BACKENDS = ('auto', 'pynput', 'synthetic')
+
+# イベントの種類（マウスは x, y が位置、詳細はボタン名またはスクロール量。キーは詳細がキー名）
+MOVE = 'move'
+DOWN = 'down'
+UP = 'up'
+SCROLL = 'scroll'
+KEY_DOWN = 'key_down'
+KEY_UP = 'key_up'
+EVENT_TYPES = (MOVE, DOWN, UP, SCROLL, KEY_DOWN, KEY_UP)
+
+# 押してから離すまでにこれ以上動いたらドラッグとみなす（px）
+DRAG_PIXELS = 4
+# これ以上押し続けたら長押しとみなす（秒）
+LONG_PRESS_SECONDS = 0.8
+# 前のクリックからこの時間以内に同じ位置を押したらダブル/トリプルクリックとみなす（秒）
+MULTI_CLICK_SECONDS = 0.5
+# ダブル/トリプルクリック・長押しのブロックで選べるボタン（中ボタンは中クリックのブロックにする）
+BLOCK_BUTTONS = ('left', 'right')
+# 組み合わせのキー名を作るときの修飾キーの順序（pyautogui のキー名）
+MODIFIER_KEYS = ('ctrl', 'alt', 'shift', 'win', 'command')
+# トップレベルのブロック列1本あたりのブロック数（長い記録は横に並べた複数の列に分ける）
+CHAIN_BLOCKS = 100
+CHAIN_SPACING = 400
+
+
+class EventSource:
+    """イベントの取得元の基底クラス
+
+    start(sink) のあと、イベントごとに sink((種類, 時刻, x, y, 詳細)) を呼び出す。
+    時刻は単調増加する秒数（time.monotonic() など）。
+    """
+
+    name = 'base'
+
+    def start(self, sink):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+class PynputSource(EventSource):
+    """pynput のマウス・キーボードのリスナーを使う取得元
+
+    キー名は pyautogui のキー名に合わせる（記録したプログラムを key_press でそのまま再生できるように）。
+    """
+
+    name = 'pynput'
+
+    # pynput の特殊キー名 → pyautogui のキー名（同じ名前のものは省略）
+    KEY_NAMES = {
+        'ctrl_l': 'ctrl', 'ctrl_r': 'ctrl', 'alt_l': 'alt', 'alt_r': 'alt', 'alt_gr': 'altright',
+        'shift_l': 'shift', 'shift_r': 'shift', 'page_up': 'pageup', 'page_down': 'pagedown',
+        'caps_lock': 'capslock', 'num_lock': 'numlock', 'scroll_lock': 'scrolllock',
+        'print_screen': 'printscreen', 'media_play_pause': 'playpause', 'media_volume_up': 'volumeup',
+        'media_volume_down': 'volumedown', 'media_volume_mute': 'volumemute', 'media_next': 'nexttrack',
+        'media_previous': 'prevtrack',
+    }
+
+    def __init__(self):
+        try:
+            from pynput import keyboard, mouse
+        except Exception as e:
+            raise RuntimeError(f'pynput を読み込めません（pip install pynput）: {e}')
+        self._keyboard = keyboard
+        self._mouse = mouse
+        self._listeners = []
+        command = 'command' if platform.system() == 'Darwin' else 'win'
+        self._key_names = dict(self.KEY_NAMES, cmd=command, cmd_l=command, cmd_r=command)
+
+    def _key_name(self, key):
+        char = getattr(key, 'char', None)
+        if char:
+            # Ctrl を押しながらの文字は制御文字として届く環境がある（Ctrl+C → \x03）
+            if len(char) == 1 and ord(char) < 32:
+                return chr(ord(char) + 96)
+            return char
+        name = getattr(key, 'name', None)
+        if name:
+            return self._key_names.get(name, name)
+        return None
+
+    def start(self, sink):
+        clock = time.monotonic
+
+        def on_move(x, y):
+            sink((MOVE, clock(), int(x), int(y), None))
+
+        def on_click(x, y, button, pressed):
+            sink((DOWN if pressed else UP, clock(), int(x), int(y), button.name))
+
+        def on_scroll(x, y, dx, dy):
+            if dy:
+                sink((SCROLL, clock(), int(x), int(y), int(dy)))
+
+        def on_press(key):
+            name = self._key_name(key)
+            if name:
+                sink((KEY_DOWN, clock(), None, None, name))
+
+        def on_release(key):
+            name = self._key_name(key)
+            if name:
+                sink((KEY_UP, clock(), None, None, name))
+
+        self._listeners = [
+            self._mouse.Listener(on_move=on_move, on_click=on_click, on_scroll=on_scroll),
+            self._keyboard.Listener(on_press=on_press, on_release=on_release),
+        ]
+        for listener in self._listeners:
+            listener.daemon = True
+            listener.start()
+
+    def stop(self):
+        for listener in self._listeners:
+            listener.stop()
+        self._listeners = []
+
+
+class SyntheticEventSource(EventSource):
+    """渡されたイベント列を流す取得元（テスト用）
+
+    events は (種類, 時刻, x, y, 詳細) の並び（リストでもよい）。realtime を指定した場合は
+    別スレッドで時刻の間隔どおりに流し、指定しない場合は start() の中ですべて流す。
+    """
+
+    name = 'synthetic'
+
+    def __init__(self, events=(), realtime=False):
+        self.events = [normalize_event(event) for event in events]
+        self.realtime = realtime
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, sink):
+        if not self.realtime:
+            for event in self.events:
+                sink(event)
+            return
+        self._thread = threading.Thread(target=self._run, args=(sink,), name='synthetic-events', daemon=True)
+        self._thread.start()
+
+    def _run(self, sink):
+        if not self.events:
+            return
+        origin = time.monotonic() - self.events[0][1]
+        for event in self.events:
+            if self._stop.wait(max(0.0, origin + event[1] - time.monotonic())):
+                return
+            sink(event)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def normalize_event(event):
+    """(種類, 時刻, x, y, 詳細) の形に整え、不正なものは ValueError"""
+    try:
+        kind, t, x, y, detail = event
+        t = float(t)
+        if kind in (MOVE, DOWN, UP, SCROLL):
+            x, y = int(x), int(y)
+        if kind == SCROLL:
+            detail = int(detail)
+    except (TypeError, ValueError):
+        raise ValueError(f'イベントは [種類, 時刻, x, y, 詳細] で指定してください: {event!r}')
+    if kind not in EVENT_TYPES:
+        raise ValueError(f'不明なイベントの種類です: {kind}')
+    if kind in (KEY_DOWN, KEY_UP, DOWN, UP) and not isinstance(detail, str):
+        raise ValueError(f'キー名・ボタン名がありません: {event!r}')
+    return (kind, t, x, y, detail)
+
+
+def create_event_source(backend='auto', events=()):
+    """設定名からイベントの取得元を生成する（events は synthetic の場合だけ使う）"""
+    if backend not in RECORD_BACKENDS:
+        raise ValueError(f'不明な記録方式です: {backend}')
+    if backend == 'synthetic':
+        return SyntheticEventSource(events)
+    return PynputSource()
+
+
+class Recorder:
+    """入力の記録（同時に1つだけ）
+
+    イベントは最大 capacity 件のリングバッファに追加し、あふれた場合は古いものから捨てる
+    （捨てた件数は dropped）。追加はロックを取らずに deque.append だけで行う。
+    """
+
+    def __init__(self, capacity=200000):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._source = None
+        self._events = deque(maxlen=capacity)
+        self._received = 0
+        self._started = None
+
+    def _push(self, event):
+        self._events.append(event)
+        self._received += 1
+
+    def start(self, source):
+        with self._lock:
+            if self._source is not None:
+                raise RuntimeError('すでに記録中です')
+            self._events = deque(maxlen=self.capacity)
+            self._received = 0
+            self._started = time.monotonic()
+            self._source = source
+        try:
+            source.start(self._push)
+        except Exception:
+            with self._lock:
+                self._source = None
+            raise
+
+    def stop(self):
+        """記録を終え、(時刻順のイベントのリスト, 状態) を返す"""
+        with self._lock:
+            source = self._source
+            if source is None:
+                raise RuntimeError('記録していません')
+            self._source = None
+        source.stop()
+        status = self.status()
+        # マウスとキーボードは別のスレッドから届くため、時刻で並べ直す
+        return sorted(self._events, key=lambda event: event[1]), status
+
+    def active(self):
+        return self._source is not None
+
+    def status(self):
+        source = self._source
+        return {
+            'recording': source is not None,
+            'backend': source.name if source is not None else None,
+            'events': len(self._events),
+            'dropped': max(0, self._received - self.capacity),
+            'elapsedSeconds': round(time.monotonic() - self._started, 2) if self._started is not None else None,
+        }
+
+
+def simplify_path(points, epsilon):
+    """Douglas–Peucker 法で折れ線を間引き、残す点の添字（昇順、両端を含む）を返す
+
+    points は (x, y) の並び。再帰せずに区間のスタックで処理し、区間内の点と線分の距離は
+    NumPy でまとめて計算する。
+    """
+    if len(points) <= 2:
+        return list(range(len(points)))
+    xy = np.asarray(points, dtype=np.float64)
+    keep = np.zeros(len(xy), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(xy) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = xy[first], xy[last]
+        inner = xy[first + 1:last] - start
+        direction = end - start
+        length = direction @ direction
+        if length == 0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            # 線分への最短距離（端点より外側は端点までの距離）
+            t = np.clip(inner @ direction / length, 0.0, 1.0)
+            offset = inner - t[:, None] * direction
+            distances = np.hypot(offset[:, 0], offset[:, 1])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > epsilon:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return np.flatnonzero(keep).tolist()
+
+
+class _Step:
+    __slots__ = ('start', 'end', 'block', 'fields', 'values')
+
+    def __init__(self, start, end, block, fields=None, values=None):
+        self.start = start
+        self.end = end
+        self.block = block
+        self.fields = fields or {}
+        self.values = values or {}
+
+
+class _StepBuilder:
+    def __init__(self, epsilon, idle, paths):
+        self.epsilon = epsilon
+        self.idle = idle
+        self.paths = paths
+        self.steps = []
+        self.warnings = []
+        self.path = []
+        self.cursor = None
+        self.text = None
+        self.held = set()
+        self.pressed = {}
+        self.last_click = None
+        self.scroll = None
+        self.moves = 0
+
+    def add(self, start, end, block, fields=None, values=None):
+        step = _Step(start, end, block, fields, values)
+        self.steps.append(step)
+        return step
+
+    def move_to(self, t, x, y):
+        if self.cursor != (x, y):
+            if self.steps:
+                # 後からまとめて出した軌跡が直前のブロックより前の時刻にならないようにする
+                t = max(t, self.steps[-1].end)
+            self.add(t, t, 'mouse_move_absolute', values={'X': x, 'Y': y})
+            self.cursor = (x, y)
+
+    def flush_text(self):
+        if self.text is not None:
+            start, end, chars = self.text
+            if chars:
+                self.add(start, end, 'type_text', fields={'TEXT': ''.join(chars)})
+            self.text = None
+
+    def flush_scroll(self):
+        if self.scroll is not None:
+            start, end, amount = self.scroll
+            if amount:
+                self.add(start, end, 'mouse_scroll', fields={'DIRECTION': 'up' if amount > 0 else 'down'},
+                         values={'AMOUNT': abs(amount)})
+            self.scroll = None
+
+    def flush_path(self, target=None):
+        """たまっている軌跡を移動のブロックにする（target は直後の操作の位置で、移動は作らない）"""
+        points = self.path
+        self.path = []
+        if target is not None:
+            points = points + [target]
+        if not points:
+            return
+        if not self.paths:
+            kept = [len(points) - 1]
+        else:
+            # 止まっていた位置（次の点まで idle 秒以上空いた点）で区切り、区間ごとに間引く
+            kept = []
+            begin = 0
+            for index in range(len(points)):
+                if index == len(points) - 1 or points[index + 1][0] - points[index][0] >= self.idle:
+                    segment = [(x, y) for _, x, y in points[begin:index + 1]]
+                    kept.extend(begin + i for i in simplify_path(segment, self.epsilon))
+                    begin = index + 1
+        if target is not None:
+            kept = [index for index in kept if index != len(points) - 1]
+        for index in kept:
+            t, x, y = points[index]
+            self.move_to(t, x, y)
+
+    def flush_pending(self):
+        self.flush_text()
+        self.flush_scroll()
+
+    def on_move(self, t, x, y):
+        self.moves += 1
+        if self.pressed:
+            for press in self.pressed.values():
+                if abs(x - press[1]) > DRAG_PIXELS or abs(y - press[2]) > DRAG_PIXELS:
+                    press[3] = True
+            return
+        self.path.append((t, x, y))
+
+    def on_down(self, t, x, y, button):
+        self.flush_pending()
+        last = self.last_click
+        if (last is not None and last['button'] == button and last['count'] < 3
+                and t - last['end'] <= MULTI_CLICK_SECONDS
+                and abs(x - last['x']) <= DRAG_PIXELS and abs(y - last['y']) <= DRAG_PIXELS):
+            # ダブル/トリプルクリックの途中の細かい動きは捨てる
+            self.path = []
+        else:
+            self.flush_path((t, x, y))
+            self.last_click = None
+        self.pressed[button] = [t, x, y, False]
+
+    def on_up(self, t, x, y, button):
+        press = self.pressed.pop(button, None)
+        if press is None:
+            # 記録を始める前に押されていたボタン
+            return
+        start, px, py, dragged = press
+        last = self.last_click
+        if dragged:
+            self.warnings.append({'t': round(start, 3),
+                                  'message': 'ドラッグは対応するブロックがないため、押した位置のクリックとして記録しました'})
+        elif t - start >= LONG_PRESS_SECONDS:
+            if button in BLOCK_BUTTONS:
+                self.move_to(start, px, py)
+                self.add(start, t, 'mouse_long_press', fields={'BUTTON': button},
+                         values={'DURATION': round(t - start, 2)})
+                self.last_click = None
+                return
+            self.warnings.append({'t': round(start, 3),
+                                  'message': f'{button}ボタンの長押しは対応するブロックがないため、クリックとして記録しました'})
+        elif (last is not None and last['button'] == button and button in BLOCK_BUTTONS
+              and start - last['end'] <= MULTI_CLICK_SECONDS):
+            last['count'] += 1
+            last['end'] = t
+            step = self.steps[-1]
+            step.end = t
+            if step.block == 'mouse_click':
+                # 左ボタンのクリックは座標付きのブロックから「移動 + ボタン」の2つに分ける
+                self.steps.pop()
+                self.cursor = None
+                self.move_to(step.start, last['x'], last['y'])
+                step = self.add(step.start, t, 'mouse_double_click', fields={'BUTTON': button})
+            step.block = 'mouse_double_click' if last['count'] == 2 else 'mouse_triple_click'
+            step.fields = {'BUTTON': button}
+            return
+
+        if button == 'left':
+            self.add(start, t, 'mouse_click', values={'X': px, 'Y': py})
+            self.cursor = (px, py)
+        else:
+            self.move_to(start, px, py)
+            if button == 'middle':
+                self.add(start, t, 'mouse_middle_click')
+            else:
+                self.add(start, t, 'mouse_single_click', fields={'BUTTON': button})
+        self.last_click = {'button': button, 'x': px, 'y': py, 'end': t, 'count': 1}
+        if dragged:
+            self.last_click = None
+
+    def on_scroll(self, t, x, y, amount):
+        self.flush_text()
+        if self.scroll is not None and (self.scroll[2] > 0) != (amount > 0):
+            self.flush_scroll()
+        if self.scroll is None:
+            self.flush_path((t, x, y))
+            self.move_to(t, x, y)
+            self.scroll = [t, t, 0]
+        self.scroll[1] = t
+        self.scroll[2] += amount
+        self.last_click = None
+
+    def on_key_down(self, t, key):
+        if key in MODIFIER_KEYS:
+            self.held.add(key)
+            return
+        self.flush_scroll()
+        self.last_click = None
+        if self.text is None:
+            self.flush_path()
+        if key == 'space':
+            key = ' '
+        printable = len(key) == 1
+        modifiers = [m for m in MODIFIER_KEYS if m in self.held and (m != 'shift' or not printable)]
+        if modifiers:
+            self.flush_text()
+            combo = '+'.join(modifiers + [key.lower() if printable else key])
+            self.add(t, t, 'key_press', fields={'KEY': combo})
+        elif printable:
+            if self.text is None:
+                self.text = [t, t, []]
+            self.text[1] = t
+            self.text[2].append(key)
+        elif key == 'backspace' and self.text is not None and self.text[2]:
+            # まとめている途中の文字を消した場合は、消したあとの文字列だけを入力する
+            self.text[1] = t
+            self.text[2].pop()
+        else:
+            self.flush_text()
+            self.add(t, t, 'key_press', fields={'KEY': key})
+
+    def on_key_up(self, t, key):
+        self.held.discard(key)
+
+
+def build_steps(events, epsilon=5.0, idle=0.3, paths=True, max_wait=None):
+    """時刻順のイベント列をブロックの並びに変換し、(ブロックのリスト, 警告, 集計) を返す
+
+    ブロックは {'type', 'fields', 'values'}（values は数値の入力）。epsilon は軌跡を間引くときの
+    許容誤差（px）、paths が偽の場合は軌跡を残さずクリックなどの位置だけに移動する。
+    idle 秒以上の空きは wait にし、max_wait を指定した場合はその秒数で打ち切る。
+    最後の操作のあとの移動は結果に影響しないので捨てる。
+    """
+    events = sorted(events, key=lambda event: event[1])
+    builder = _StepBuilder(epsilon, idle, paths)
+    for kind, t, x, y, detail in events:
+        if kind == MOVE:
+            builder.on_move(t, x, y)
+        elif kind == DOWN:
+            builder.on_down(t, x, y, detail)
+        elif kind == UP:
+            builder.on_up(t, x, y, detail)
+        elif kind == SCROLL:
+            builder.on_scroll(t, x, y, detail)
+        elif kind == KEY_DOWN:
+            builder.on_key_down(t, detail)
+        elif kind == KEY_UP:
+            builder.on_key_up(t, detail)
+    builder.flush_pending()
+
+    # 待機は間引いたあとのブロックの間隔ではなく、元のイベント列で何も起きなかった時間から求める
+    gaps = [(events[i + 1][1], events[i + 1][1] - events[i][1]) for i in range(len(events) - 1)
+            if events[i + 1][1] - events[i][1] >= idle]
+    blocks = []
+    waits = 0
+    gap_index = 0
+    previous_end = None
+    for step in builder.steps:
+        seconds = 0.0
+        while gap_index < len(gaps) and gaps[gap_index][0] <= step.start:
+            # 最初の操作より前の空きと、長押しのように前のブロック自体が続いていた時間は除く
+            gap_end, length = gaps[gap_index]
+            if previous_end is not None and gap_end > previous_end:
+                seconds += gap_end - max(gap_end - length, previous_end)
+            gap_index += 1
+        previous_end = step.end
+        if max_wait is not None:
+            seconds = min(seconds, max_wait)
+        if seconds > 0:
+            blocks.append({'type': 'wait', 'fields': {}, 'values': {'TIME': round(seconds, 2)}})
+            waits += 1
+        blocks.append({'type': step.block, 'fields': step.fields, 'values': step.values})
+
+    summary = {
+        'events': len(events),
+        'mouseMoves': builder.moves,
+        'moveBlocks': sum(1 for block in blocks if block['type'] == 'mouse_move_absolute'),
+        'waitBlocks': waits,
+        'blocks': len(blocks),
+        'durationSeconds': round(events[-1][1] - events[0][1], 2) if events else 0,
+    }
+    return blocks, builder.warnings, summary
+
+
+def _block_id():
+    return uuid.uuid4().hex[:20]
+
+
+def to_workspace(blocks):
+    """ブロックの並びを Blockly のワークスペース（JSONのシリアライズ形式）にする
+
+    数値の入力は math_number のブロックにする。ブロックは CHAIN_BLOCKS 個ずつの列に分けて
+    左から右へ並べる（上から・左からの順に実行されるので、列の順に実行される）。
+    """
+    top = []
+    for chain_index, offset in enumerate(range(0, len(blocks), CHAIN_BLOCKS)):
+        head = None
+        for spec in reversed(blocks[offset:offset + CHAIN_BLOCKS]):
+            block = {'type': spec['type'], 'id': _block_id()}
+            if spec['fields']:
+                block['fields'] = dict(spec['fields'])
+            if spec['values']:
+                block['inputs'] = {
+                    name: {'block': {'type': 'math_number', 'id': _block_id(), 'fields': {'NUM': value}}}
+                    for name, value in spec['values'].items()
+                }
+            if head is not None:
+                block['next'] = {'block': head}
+            head = block
+        head['x'] = 20 + chain_index * CHAIN_SPACING
+        head['y'] = 20
+        top.append(head)
+    return {'blocks': {'languageVersion': 0, 'blocks': top}}
@@ -2,6 +2,12 @@
 let executionLog;
 let isRunning = false;
 let stopRequested = false;
+let currentRunId = null;
+let eventSource = null;
+let runFollower = null;
+// 実行中のジョブID と、終了通知を待っている関数
+const activeJobs = new Set();
+const jobWaiters = new Map();
 
 // 初期化
 window.addEventListener('load', function() {
@@ -13,8 +19,8 @@ window.addEventListener('load', function() {
     // コントロールを初期化
     initControls();
     
-    // マウス位置の更新を開始
-    updateMousePosition();
+    // マウス位置と実行状況の受信を開始
+    connectEvents();
     
     // 保存済みプログラムを読み込み
     loadSavedPrograms();
@@ -22,6 +28,9 @@ window.addEventListener('load', function() {
     // 画像ライブラリを読み込み
     refreshImageLibrary();
     
+    // サーバー側で実行中のプログラムがあれば進捗表示を再開
+    resumeActiveRun();
+    
     // 定期的に画像ドロップダウンを更新（30秒ごと）
     setInterval(() => {
         forceUpdateImageDropdowns();
@@ -48,48 +57,174 @@ function initControls() {
     initImageLibrary();
 }
 
-// プログラム実行
+// プログラム実行（現在のワークスペースを保存せずにサーバー側で実行）
 async function runProgram() {
     if (isRunning) return;
     
     isRunning = true;
     stopRequested = false;
-    document.getElementById('run-btn').disabled = true;
-    document.getElementById('stop-btn').disabled = false;
-    
+    setRunButtons(true);
     clearLog();
-    addLog('プログラム実行開始', 'info');
     
-    // フェイルセーフ設定をサーバーに送信
-    const failsafeEnabled = document.getElementById('failsafe-enabled').checked;
-    await setFailsafeMode(failsafeEnabled);
+    try {
+        // 保存済みのプログラムを上書きしないよう、ワークスペースをそのまま送って実行する
+        const response = await fetch('/api/run', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                name: document.getElementById('program-name').value.trim(),
+                data: serializeWorkspace(),
+                failsafeEnabled: document.getElementById('failsafe-enabled').checked,
+                speed: document.getElementById('speed-profile').value
+            })
+        });
+        const data = await response.json();
+        if (!response.ok) {
+            // 実行前の検査で見つかった問題（存在しない画像など）はブロックごとに表示する
+            (data.problems || []).forEach(problem => addLog(`${problem.action}: ${problem.error}`, 'error'));
+            if (data.problems && data.problems.length > 0 && data.problems[0].block) {
+                workspace.highlightBlock(data.problems[0].block);
+            }
+            throw new Error(data.error || '実行開始エラー');
+        }
+        
+        await followRun(data.runId);
+    } catch (error) {
+        addLog(`エラー: ${error.message}`, 'error');
+        console.error('Execution error:', error);
+        finishRun();
+    }
+}
+
+// サーバー側の実行の進捗をログに反映する
+// イベントストリームに接続中は通知を待ち、切断中は300msごとに問い合わせる
+async function followRun(runId) {
+    currentRunId = runId;
+    const follower = { runId, nextSeq: 0, wake: null, woken: false };
+    runFollower = follower;
+    
+    let done = await syncRun(follower);
+    while (!done) {
+        const streaming = eventSource && eventSource.readyState === EventSource.OPEN;
+        if (!follower.woken) {
+            await new Promise(resolve => {
+                follower.wake = resolve;
+                setTimeout(resolve, streaming ? 5000 : 300);
+            });
+        }
+        follower.wake = null;
+        follower.woken = false;
+        done = await syncRun(follower);
+    }
     
+    runFollower = null;
+    finishRun();
+}
+
+// 実行状態を取得して未表示のログを反映し、実行が終わっていれば true を返す
+async function syncRun(follower) {
     try {
-        const code = javascript.javascriptGenerator.workspaceToCode(workspace);
-        console.log('Generated code:', code);
+        const response = await fetch(`/api/runs/${follower.runId}?since=${follower.nextSeq}`);
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || '実行状態の取得に失敗しました');
+        }
         
-        const wrappedCode = `
-            (async () => {
-                ${code}
-            })();
-        `;
+        const run = data.run;
+        run.logs.forEach(entry => {
+            if (entry.seq >= follower.nextSeq) {
+                addLog(entry.message, entry.type);
+            }
+        });
+        follower.nextSeq = Math.max(follower.nextSeq, run.nextSeq);
+        workspace.highlightBlock(run.currentBlock);
         
-        await eval(wrappedCode);
-        addLog('プログラム実行完了', 'success');
+        return run.status !== 'pending' && run.status !== 'running';
     } catch (error) {
         addLog(`エラー: ${error.message}`, 'error');
-        console.error('Execution error:', error);
-    } finally {
-        isRunning = false;
-        document.getElementById('run-btn').disabled = false;
-        document.getElementById('stop-btn').disabled = true;
+        return true;
+    }
+}
+
+function wakeRunFollower(follower) {
+    if (follower.wake) {
+        follower.wake();
+    } else {
+        follower.woken = true;
+    }
+}
+
+// イベントストリームで受け取った実行イベントを反映する
+function handleRunEvent(event) {
+    const data = JSON.parse(event.data);
+    const follower = runFollower;
+    if (!follower || data.runId !== follower.runId) return;
+    
+    if (data.type === 'log') {
+        if (data.entry.seq === follower.nextSeq) {
+            addLog(data.entry.message, data.entry.type);
+            follower.nextSeq++;
+        } else if (data.entry.seq > follower.nextSeq) {
+            // 取りこぼしがあればまとめて取得し直す
+            wakeRunFollower(follower);
+        }
+    } else if (data.type === 'step_start') {
+        workspace.highlightBlock(data.block);
+    } else if (data.type === 'run_end') {
+        wakeRunFollower(follower);
+    }
+}
+
+function finishRun() {
+    isRunning = false;
+    currentRunId = null;
+    workspace.highlightBlock(null);
+    setRunButtons(false);
+}
+
+function setRunButtons(running) {
+    document.getElementById('run-btn').disabled = running;
+    document.getElementById('stop-btn').disabled = !running;
+}
+
+// ページを開き直したときに実行中のプログラムがあれば進捗表示を再開する
+async function resumeActiveRun() {
+    try {
+        const response = await fetch('/api/runs');
+        const data = await response.json();
+        
+        if (response.ok && data.active && !isRunning) {
+            isRunning = true;
+            setRunButtons(true);
+            addLog('実行中のプログラムに再接続しました', 'info');
+            await followRun(data.active);
+        }
+    } catch (error) {
+        console.error('実行状態取得エラー:', error);
     }
 }
 
 // プログラム停止
-function stopProgram() {
+async function stopProgram() {
     stopRequested = true;
     addLog('プログラム停止要求', 'info');
+    
+    // サーバー側で待機中の操作（要素の出現待ちなど）も取り消す
+    activeJobs.forEach(jobId => {
+        fetch(`/api/jobs/${jobId}/cancel`, { method: 'POST' }).catch(error => {
+            addLog(`取り消し要求エラー: ${error.message}`, 'error');
+        });
+    });
+    
+    if (!currentRunId) return;
+    
+    try {
+        await fetch(`/api/runs/${currentRunId}/stop`, { method: 'POST' });
+    } catch (error) {
+        addLog(`停止要求エラー: ${error.message}`, 'error');
+    }
 }
 
 // プログラム保存
@@ -101,36 +236,19 @@ async function saveProgram() {
         return;
     }
     
-    // 新しいBlocklyバージョンに対応した保存
-    let serializedData;
-    if (typeof Blockly.serialization !== 'undefined') {
-        // 新しいシリアライゼーション方式
-        serializedData = JSON.stringify(Blockly.serialization.workspaces.save(workspace));
-    } else {
-        // 古いXML方式
-        const xml = Blockly.Xml.workspaceToDom(workspace);
-        serializedData = Blockly.Xml.domToText(xml);
-    }
-    
-    const failsafeEnabled = document.getElementById('failsafe-enabled').checked;
-    
     try {
-        const response = await fetch('/api/save', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                name: programName,
-                data: serializedData,
-                failsafeEnabled: failsafeEnabled
-            })
-        });
-        
-        const data = await response.json();
+        const { ok, data } = await saveWorkspace(programName);
         
-        if (response.ok) {
-            showMessage('保存しました', 'success');
+        if (ok) {
+            const compiled = data.compiled || {};
+            const problems = compiled.problems || [];
+            if (compiled.error) {
+                showMessage(`保存しました（このままでは実行できません: ${compiled.error}）`, 'error');
+            } else if (problems.length > 0) {
+                showMessage(`保存しました（問題${problems.length}件: ${problems[0].error}）`, 'error');
+            } else {
+                showMessage('保存しました', 'success');
+            }
             loadSavedPrograms();
         } else {
             showMessage(data.error || '保存に失敗しました', 'error');
@@ -140,6 +258,42 @@ async function saveProgram() {
     }
 }
 
+// 現在のワークスペースを保存・実行用の文字列にする
+function serializeWorkspace() {
+    // 新しいBlocklyバージョンに対応した保存
+    if (typeof Blockly.serialization !== 'undefined') {
+        // 新しいシリアライゼーション方式
+        return JSON.stringify(Blockly.serialization.workspaces.save(workspace));
+    }
+    // 古いXML方式
+    const xml = Blockly.Xml.workspaceToDom(workspace);
+    return Blockly.Xml.domToText(xml);
+}
+
+// 現在のワークスペースをサーバーに保存する
+async function saveWorkspace(programName) {
+    const serializedData = serializeWorkspace();
+    
+    const failsafeEnabled = document.getElementById('failsafe-enabled').checked;
+    const speed = document.getElementById('speed-profile').value;
+    
+    const response = await fetch('/api/save', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+            name: programName,
+            data: serializedData,
+            failsafeEnabled: failsafeEnabled,
+            speed: speed
+        })
+    });
+    
+    const data = await response.json();
+    return { ok: response.ok, data };
+}
+
 // プログラム読み込み
 async function loadProgram() {
     const programName = document.getElementById('saved-programs').value;
@@ -186,6 +340,7 @@ async function loadProgram() {
         // フェイルセーフ設定を復元
         const failsafeCheckbox = document.getElementById('failsafe-enabled');
         failsafeCheckbox.checked = data.failsafeEnabled !== false; // デフォルトはtrue
+        document.getElementById('speed-profile').value = data.speed || 'normal';
         
         // ドロップダウンを更新（少し遅延を入れて確実に更新）
         setTimeout(() => {
@@ -203,7 +358,7 @@ async function loadProgram() {
 async function loadSavedPrograms() {
     try {
         console.log('Loading saved programs list...');
-        const response = await fetch('/api/programs');
+        const response = await fetch('/api/programs?sort=name&limit=1000');
         console.log('Programs response status:', response.status);
         
         if (!response.ok) {
@@ -219,13 +374,16 @@ async function loadSavedPrograms() {
         select.innerHTML = '<option value="">-- 保存済みプログラムを選択 --</option>';
         
         if (data.programs && data.programs.length > 0) {
-            data.programs.forEach(program => {
+            (data.items || data.programs.map(name => ({name}))).forEach(program => {
                 const option = document.createElement('option');
-                option.value = program;
-                option.textContent = program;
+                option.value = program.name;
+                option.textContent = program.name;
+                if (program.modified) {
+                    option.title = `更新: ${program.modified.replace('T', ' ').slice(0, 19)} / ${program.blocks}ブロック`;
+                }
                 select.appendChild(option);
             });
-            console.log(`Loaded ${data.programs.length} programs`);
+            console.log(`Loaded ${data.programs.length} of ${data.total ?? data.programs.length} programs`);
         } else {
             console.log('No programs found');
         }
@@ -484,18 +642,7 @@ async function mouseLongPress(button, duration) {
     
     addLog(`${button}ボタン長押し: ${duration}秒`, 'info');
     
-    const response = await fetch('/api/mouse/long-press', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({ button, duration })
-    });
-    
-    const data = await response.json();
-    if (!response.ok) {
-        throw new Error(data.error || '長押しエラー');
-    }
+    await runJob('/api/mouse/long-press', { button, duration }, '長押しエラー');
 }
 
 async function mouseRelease(button) {
@@ -564,22 +711,7 @@ async function openUrl(url, waitForLoad = false, waitTime = 3) {
         `URL開く: ${url}`;
     addLog(logMessage, 'info');
     
-    const response = await fetch('/api/browser/open-url', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({ 
-            url, 
-            waitForLoad, 
-            waitTime 
-        })
-    });
-    
-    const data = await response.json();
-    if (!response.ok) {
-        throw new Error(data.error || 'URL開くエラー');
-    }
+    await runJob('/api/browser/open-url', { url, waitForLoad, waitTime }, 'URL開くエラー');
 }
 
 async function refreshBrowser() {
@@ -605,45 +737,65 @@ async function waitForElement(imageData, timeout = 30, confidence = 80) {
     
     addLog(`要素出現待機: タイムアウト${timeout}秒、信頼度${confidence}%`, 'info');
     
-    const response = await fetch('/api/browser/wait-for-element', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({ 
-            imageData,
-            timeout: parseInt(timeout),
-            confidence: parseFloat(confidence) / 100  // パーセントから小数に変換
-        })
-    });
+    const result = await runJob('/api/browser/wait-for-element', {
+        imageData,
+        timeout: parseInt(timeout),
+        confidence: parseFloat(confidence) / 100  // パーセントから小数に変換
+    }, '要素出現待機エラー');
     
-    const data = await response.json();
-    if (!response.ok) {
-        throw new Error(data.error || '要素出現待機エラー');
+    addLog(`要素が見つかりました: (${result.location.x}, ${result.location.y})`, 'success');
+    return result.location;
+}
+
+async function waitForElementByName(imageName, timeout = 30, confidence = 80) {
+    if (stopRequested) throw new Error('実行が停止されました');
+    
+    if (!imageName) {
+        throw new Error('画像名が指定されていません');
     }
     
-    addLog(`要素が見つかりました: (${data.location.x}, ${data.location.y})`, 'success');
-    return data.location;
+    addLog(`要素「${imageName}」出現待機: タイムアウト${timeout}秒、信頼度${confidence}%`, 'info');
+    
+    // 画像データは送らず、サーバー側の画像ライブラリ（キャッシュ）を名前で参照する
+    const result = await runJob('/api/browser/wait-for-element', {
+        imageName,
+        timeout: parseInt(timeout),
+        confidence: parseFloat(confidence) / 100  // パーセントから小数に変換
+    }, '要素出現待機エラー');
+    
+    addLog(`要素が見つかりました: (${result.location.x}, ${result.location.y})`, 'success');
+    return result.location;
 }
 
-async function waitForElementByName(imageName, timeout = 30, confidence = 80) {
+async function findAllImages(imageName, order = 'rows', confidence = 80) {
     if (stopRequested) throw new Error('実行が停止されました');
     
     if (!imageName) {
         throw new Error('画像名が指定されていません');
     }
     
-    // 画像データを名前で取得
-    const imageResponse = await fetch(`/api/images/get/${encodeURIComponent(imageName)}`);
-    if (!imageResponse.ok) {
-        throw new Error(`画像「${imageName}」が見つかりません`);
+    // 1回の撮影で全出現位置を取得し、ループ中は撮影し直さない
+    const response = await fetch('/api/images/find-all', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+            imageName,
+            order,
+            confidence: parseFloat(confidence) / 100  // パーセントから小数に変換
+        })
+    });
+    
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.error || '画像検索エラー');
     }
     
-    const imageData = await imageResponse.json();
-    return await waitForElement(imageData.image.data, timeout, confidence);
+    addLog(`画像「${imageName}」が${data.count}件見つかりました`, 'info');
+    return data.locations;
 }
 
-
 function updateImageDropdowns(images) {
     // グローバル変数に画像リストを保存
     window.imageList = images;
@@ -652,7 +804,8 @@ function updateImageDropdowns(images) {
     const blocks = workspace.getAllBlocks();
     
     blocks.forEach(block => {
-        if (block.type === 'wait_for_element' || block.type === 'image_variable' || block.type === 'mouse_move_to_image') {
+        if (block.type === 'wait_for_element' || block.type === 'image_variable' || block.type === 'mouse_move_to_image' ||
+            block.type === 'image_for_each') {
             const dropdown = block.getField('IMAGE_NAME');
             if (dropdown) {
                 // 現在の選択値を保存
@@ -837,31 +990,13 @@ function displayImageList(images) {
     });
 }
 
-async function loadThumbnail(imgElement, imageName) {
-    try {
-        console.log('Loading thumbnail for:', imageName);
-        const response = await fetch(`/api/images/get/${encodeURIComponent(imageName)}`);
-        console.log('Thumbnail response status:', response.status);
-        
-        if (response.ok) {
-            const data = await response.json();
-            console.log('Thumbnail data received:', data);
-            
-            if (data.status === 'success' && data.image && data.image.data) {
-                imgElement.src = data.image.data;
-                console.log('Thumbnail set successfully');
-            } else {
-                console.error('Invalid thumbnail data:', data);
-                setErrorThumbnail(imgElement);
-            }
-        } else {
-            console.error('Thumbnail fetch failed:', response.status);
-            setErrorThumbnail(imgElement);
-        }
-    } catch (error) {
-        console.error('サムネイル読み込みエラー:', error);
+function loadThumbnail(imgElement, imageName) {
+    // サーバーが縮小・キャッシュしたPNGを直接読み込む（再表示時はブラウザが304で再検証する）
+    imgElement.onerror = () => {
+        imgElement.onerror = null;
         setErrorThumbnail(imgElement);
-    }
+    };
+    imgElement.src = `/api/images/thumbnail/${encodeURIComponent(imageName)}?size=80`;
 }
 
 function setLoadingThumbnail(imgElement) {
@@ -986,7 +1121,115 @@ async function readTextFileFromPath(filePath) {
     }
 }
 
-// マウス位置の更新
+// ファイルの指定した範囲の行を読み込む（1始まりの行番号）
+async function readTextFileLines(filePath, start, count) {
+    if (stopRequested) throw new Error('実行が停止されました');
+    
+    if (!filePath) {
+        throw new Error('ファイルパスが指定されていません');
+    }
+    
+    const response = await fetch('/api/file/read-lines', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ path: filePath, start: start, count: count })
+    });
+    
+    const data = await response.json();
+    if (!response.ok) {
+        addLog(`ファイル読み込みエラー: ${data.error}`, 'error');
+        throw new Error(data.error || 'ファイル読み込みエラー');
+    }
+    return data.lines.join('\n');
+}
+
+// 時間のかかる操作をジョブとして開始し、終了を待って結果を返す
+async function runJob(url, body, errorMessage) {
+    const response = await fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(body)
+    });
+    
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.error || errorMessage);
+    }
+    
+    activeJobs.add(data.jobId);
+    try {
+        const job = await awaitJob(data.jobId);
+        if (job.status !== 'completed') {
+            throw new Error(job.error || errorMessage);
+        }
+        return job.result;
+    } finally {
+        activeJobs.delete(data.jobId);
+    }
+}
+
+// ジョブの終了を待つ
+// イベントストリームに接続中は終了通知を待ち、切断中は300msごとに問い合わせる
+async function awaitJob(jobId) {
+    while (true) {
+        const streaming = eventSource && eventSource.readyState === EventSource.OPEN;
+        const ended = new Promise(resolve => {
+            jobWaiters.set(jobId, resolve);
+            setTimeout(resolve, streaming ? 5000 : 300);
+        });
+        
+        try {
+            const response = await fetch(`/api/jobs/${jobId}`);
+            const data = await response.json();
+            if (!response.ok) {
+                throw new Error(data.error || 'ジョブの状態の取得に失敗しました');
+            }
+            if (data.job.status !== 'pending' && data.job.status !== 'running') {
+                return data.job;
+            }
+        } catch (error) {
+            jobWaiters.delete(jobId);
+            throw error;
+        }
+        
+        await ended;
+        jobWaiters.delete(jobId);
+    }
+}
+
+// イベントストリームで受け取ったジョブの終了通知を待っている処理に伝える
+function handleJobEvent(event) {
+    const data = JSON.parse(event.data);
+    if (data.type !== 'job_end') return;
+    
+    const wake = jobWaiters.get(data.jobId);
+    if (wake) {
+        wake();
+    }
+}
+
+// マウス位置と実行状況をサーバーからのイベントで受け取る
+function connectEvents() {
+    if (typeof EventSource === 'undefined') {
+        updateMousePosition();
+        return;
+    }
+    
+    eventSource = new EventSource('/api/events?positionHz=10');
+    eventSource.addEventListener('position', event => {
+        const data = JSON.parse(event.data);
+        document.getElementById('pos-x').textContent = data.x;
+        document.getElementById('pos-y').textContent = data.y;
+    });
+    eventSource.addEventListener('run', handleRunEvent);
+    eventSource.addEventListener('job', handleJobEvent);
+}
+
+// マウス位置の更新（EventSourceが使えないブラウザ向け）
 function updateMousePosition() {
     setInterval(async () => {
         try {
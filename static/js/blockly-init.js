@@ -327,6 +327,60 @@ function defineCustomBlocks() {
             "output": "String",
             "colour": 340,
             "tooltip": "保存された画像変数を参照します"
+        },
+        {
+            "type": "image_for_each",
+            "message0": "画像 %1 が見つかった位置ごとに（%2 順）",
+            "args0": [
+                {
+                    "type": "field_dropdown",
+                    "name": "IMAGE_NAME",
+                    "options": function() {
+                        // 画像リストを取得してオプションを生成
+                        const options = [['画像を選択', '']];
+                        if (typeof window.imageList !== 'undefined' && Array.isArray(window.imageList)) {
+                            window.imageList.forEach(img => {
+                                options.push([img.name, img.name]);
+                            });
+                        }
+                        return options;
+                    }
+                },
+                {
+                    "type": "field_dropdown",
+                    "name": "ORDER",
+                    "options": [["行（上→下、左→右）", "rows"], ["列（左→右、上→下）", "columns"], ["信頼度", "confidence"]]
+                }
+            ],
+            "message1": "信頼度(%%) %1 中央座標を X: %2 Y: %3 に入れて",
+            "args1": [
+                {
+                    "type": "input_value",
+                    "name": "CONFIDENCE",
+                    "check": "Number"
+                },
+                {
+                    "type": "field_variable",
+                    "name": "VAR_X",
+                    "variable": "x"
+                },
+                {
+                    "type": "field_variable",
+                    "name": "VAR_Y",
+                    "variable": "y"
+                }
+            ],
+            "message2": "実行 %1",
+            "args2": [
+                {
+                    "type": "input_statement",
+                    "name": "DO"
+                }
+            ],
+            "previousStatement": null,
+            "nextStatement": null,
+            "colour": 340,
+            "tooltip": "画面を1回だけ撮影して画像の出現位置をすべて探し、見つかった位置ごとに繰り返します"
         }
     ]);
 
@@ -424,6 +478,20 @@ function defineCustomBlocks() {
         const image_name = block.getFieldValue('IMAGE_NAME');
         return ['\'' + image_name + '\'', javascript.Order.ATOMIC];
     };
+
+    javascript.javascriptGenerator.forBlock['image_for_each'] = function(block, generator) {
+        const image_name = block.getFieldValue('IMAGE_NAME');
+        const order = block.getFieldValue('ORDER');
+        const confidence = generator.valueToCode(block, 'CONFIDENCE', javascript.Order.ATOMIC) || '80';
+        const var_x = generator.getVariableName(block.getFieldValue('VAR_X'));
+        const var_y = generator.getVariableName(block.getFieldValue('VAR_Y'));
+        const location = generator.nameDB_.getDistinctName('location', Blockly.Names.NameType.VARIABLE);
+        const statements_do = generator.statementToCode(block, 'DO');
+        return 'for (const ' + location + ' of await findAllImages(\'' + image_name + '\', \'' + order + '\', ' + confidence + ')) {\n' +
+            generator.INDENT + var_x + ' = ' + location + '.center_x;\n' +
+            generator.INDENT + var_y + ' = ' + location + '.center_y;\n' +
+            statements_do + '}\n';
+    };
 }
 
 // Blocklyワークスペースの初期化
@@ -89,6 +89,14 @@ function initializeGenerators() {
             var code = 'await readTextFileFromPath(' + value_path + ')';
             return [code, javascript.Order.AWAIT];
         };
+
+        javascript.javascriptGenerator.forBlock['file_read_lines'] = function(block, generator) {
+            var value_path = generator.valueToCode(block, 'PATH', javascript.Order.ATOMIC) || "''";
+            var value_start = generator.valueToCode(block, 'START', javascript.Order.ATOMIC) || '1';
+            var value_count = generator.valueToCode(block, 'COUNT', javascript.Order.ATOMIC) || '1';
+            var code = 'await readTextFileLines(' + value_path + ', ' + value_start + ', ' + value_count + ')';
+            return [code, javascript.Order.AWAIT];
+        };
     }
 }
 
@@ -383,6 +391,27 @@ Blockly.Blocks['file_read_path'] = {
     }
 };
 
+// ファイル読み込みブロック（行の範囲を指定）
+Blockly.Blocks['file_read_lines'] = {
+    init: function() {
+        this.appendValueInput("PATH")
+            .setCheck("String")
+            .appendField("パス");
+        this.appendValueInput("START")
+            .setCheck("Number")
+            .appendField("のファイルの");
+        this.appendValueInput("COUNT")
+            .setCheck("Number")
+            .appendField("行目から");
+        this.appendDummyInput()
+            .appendField("行を読み込む");
+        this.setInputsInline(true);
+        this.setOutput(true, "String");
+        this.setColour(330);
+        this.setTooltip("大きなCSVやログファイルから指定した範囲の行だけを読み込みます（ファイルの終わりを過ぎると空文字列）");
+    }
+};
+
 Blockly.JavaScript['type_text_variable'] = function(block) {
     var value_text = Blockly.JavaScript.valueToCode(block, 'TEXT', Blockly.JavaScript.ORDER_ATOMIC) || "''";
     var code = 'await typeText(' + value_text + ');\n';
@@ -400,4 +429,12 @@ Blockly.JavaScript['file_read_path'] = function(block) {
     return [code, Blockly.JavaScript.ORDER_AWAIT || Blockly.JavaScript.ORDER_NONE];
 };
 
+Blockly.JavaScript['file_read_lines'] = function(block) {
+    var value_path = Blockly.JavaScript.valueToCode(block, 'PATH', Blockly.JavaScript.ORDER_ATOMIC) || "''";
+    var value_start = Blockly.JavaScript.valueToCode(block, 'START', Blockly.JavaScript.ORDER_ATOMIC) || '1';
+    var value_count = Blockly.JavaScript.valueToCode(block, 'COUNT', Blockly.JavaScript.ORDER_ATOMIC) || '1';
+    var code = 'await readTextFileLines(' + value_path + ', ' + value_start + ', ' + value_count + ')';
+    return [code, Blockly.JavaScript.ORDER_AWAIT || Blockly.JavaScript.ORDER_NONE];
+};
+
 console.log('Custom blocks loaded');
\ No newline at end of file
@@ -0,0 +1,31 @@
+"""テスト共通の設定
+
+リポジトリ直下のモジュールを import できるようにし、pyautogui はベンチマーク用の
+呼び出しを記録するだけのモジュールに置き換える（実際のマウス・キーボードは動かさない）。
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import mock_pyautogui  # noqa: E402
+
+MOCK = mock_pyautogui.install()
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """一時ディレクトリを作業ディレクトリにして app を読み込む（save/ はその下に作られる）"""
+    workdir = tmp_path_factory.mktemp('autonex')
+    previous = os.getcwd()
+    os.chdir(workdir)
+    os.environ['AUTONEX_CAPTURE_BACKEND'] = 'synthetic'
+    try:
+        import app
+        yield app
+    finally:
+        os.chdir(previous)
@@ -0,0 +1,77 @@
+"""actions.py: 入力操作とディスパッチャ"""
+import threading
+import time
+
+import pytest
+
+import actions
+import timing
+from dispatcher import InputDispatcher, InputSession
+
+
+@pytest.fixture
+def session():
+    return InputSession(InputDispatcher(), failsafe=False, profile=timing.get_profile('max'))
+
+
+@pytest.fixture
+def mock():
+    import pyautogui
+    pyautogui.reset()
+    return pyautogui
+
+
+def run_in_thread(fn):
+    thread = threading.Thread(target=fn)
+    thread.start()
+    return thread
+
+
+def test_long_press_does_not_block_dispatcher(session, mock):
+    ctx = actions.ActionContext(session=session)
+    thread = run_in_thread(lambda: actions.perform('mouse_long_press', {'button': 'left', 'duration': 0.5}, ctx))
+    try:
+        time.sleep(0.1)
+        # 長押しの間も、他のセッションの入力はすぐに実行される
+        other = actions.ActionContext(session=InputSession(session.dispatcher, failsafe=False))
+        start = time.perf_counter()
+        actions.perform('key_press', {'key': 'a'}, other)
+        assert time.perf_counter() - start < 0.3
+    finally:
+        thread.join()
+
+    names = [call[0] for call in mock.calls]
+    assert names == ['mouseDown', 'press', 'mouseUp']
+    # 押す・離すはそれぞれ1回ずつディスパッチャに渡される
+    assert session.dispatcher.stats()['submitted'] == 3
+
+
+def test_long_press_releases_when_stopped(session, mock):
+    ctx = actions.ActionContext(session=session)
+    errors = []
+
+    def press():
+        try:
+            actions.perform('mouse_long_press', {'button': 'left', 'duration': 5}, ctx)
+        except actions.StopRequested as e:
+            errors.append(e)
+
+    thread = run_in_thread(press)
+    time.sleep(0.1)
+    ctx.stop_event.set()
+    thread.join(2)
+
+    assert errors
+    assert [call[0] for call in mock.calls] == ['mouseDown', 'mouseUp']
+
+
+def test_stream_text_dispatches_each_chunk(session, mock):
+    ctx = actions.ActionContext(session=session)
+    stats = actions.stream_text(['abc', 'def', '', 'gh'], ctx, method='type')
+
+    assert stats['chars'] == 8
+    assert stats['chunks'] == 3
+    assert [call[1] for call in mock.calls] == [('abc',), ('def',), ('gh',)]
+    assert session.dispatcher.stats()['submitted'] == 3
+    # 最後の入力のあとに type_text の落ち着き時間が設定される
+    assert session.pending_settle == timing.get_profile('max').settle('type_text')
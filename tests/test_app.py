@@ -0,0 +1,76 @@
+"""app.py: HTTP API"""
+import json
+import os
+import threading
+import time
+
+
+def repeat_clicks(times):
+    return json.dumps({'blocks': {'languageVersion': 0, 'blocks': [{
+        'type': 'controls_repeat', 'id': 'loop', 'fields': {'TIMES': times},
+        'inputs': {'DO': {'block': {'type': 'mouse_single_click', 'id': 'click', 'fields': {'BUTTON': 'left'}}}},
+    }]}})
+
+
+def test_run_workspace_does_not_save(app_module):
+    client = app_module.app.test_client()
+    response = client.post('/api/run', json={
+        'name': 'unsaved', 'data': repeat_clicks(2), 'failsafeEnabled': False, 'speed': 'max'})
+    assert response.status_code == 200, response.get_json()
+
+    run = app_module.run_manager.get(response.get_json()['runId'])
+    run.join(5)
+    assert run.status == 'completed', run.error
+    assert run.steps == 2
+    assert not os.path.exists(os.path.join(app_module.PROGRAM_DIR, 'unsaved.json'))
+
+
+def test_run_workspace_reports_problems(app_module):
+    client = app_module.app.test_client()
+    data = json.dumps({'blocks': {'languageVersion': 0, 'blocks': [{
+        'type': 'mouse_move_to_image', 'id': 'move', 'fields': {'IMAGE_NAME': 'missing'},
+    }]}})
+    response = client.post('/api/run', json={'data': data})
+    assert response.status_code == 400
+    assert response.get_json()['problems'][0]['block'] == 'move'
+
+
+def test_action_batch_reports_partial_failure(app_module, monkeypatch):
+    import pyautogui
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('click failed')
+
+    monkeypatch.setattr(pyautogui, 'click', fail)
+    client = app_module.app.test_client()
+    response = client.post('/api/actions/batch', json={'actions': [
+        {'type': 'key_press', 'key': 'a'},
+        {'type': 'mouse_single_click', 'button': 'left'},
+        {'type': 'key_press', 'key': 'b'},
+    ]})
+
+    assert response.status_code == 207
+    data = response.get_json()
+    assert [result['status'] for result in data['results']] == ['ok', 'error', 'skipped']
+    assert data['completed'] == 1
+
+
+def test_action_batch_waits_outside_dispatcher(app_module):
+    client = app_module.app.test_client()
+    done = threading.Event()
+
+    def run_batch():
+        client.post('/api/actions/batch', json={'actions': [{'type': 'wait', 'seconds': 0.5}]})
+        done.set()
+
+    thread = threading.Thread(target=run_batch)
+    thread.start()
+    try:
+        time.sleep(0.1)
+        # 一括実行の待機中も、他の入力操作はすぐに実行される
+        start = time.perf_counter()
+        assert app_module.app.test_client().post('/api/keypress', json={'key': 'a'}).status_code == 200
+        assert time.perf_counter() - start < 0.3
+        assert not done.is_set()
+    finally:
+        thread.join()
@@ -0,0 +1,144 @@
+"""batch.py: CSV/TSV の行ごとの実行と再開"""
+import json
+import os
+
+import pytest
+
+from batch import BatchManager, iter_rows
+
+
+class FakeRun:
+    """すぐに終わる ProgramRun の代わり"""
+
+    def __init__(self, run_id, status='completed', error=None):
+        self.id = run_id
+        self.status = status
+        self.error = error
+        self.active = False
+
+    def stop(self):
+        pass
+
+    def join(self, timeout=None):
+        pass
+
+
+class Starter:
+    """呼ばれた行の変数を記録し、fail に含まれる name の行を失敗させる"""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = []
+
+    def __call__(self, variables):
+        self.calls.append(variables)
+        if variables.get('name') in self.fail:
+            return FakeRun(f'run{len(self.calls)}', 'error', f'{variables["name"]} で失敗')
+        return FakeRun(f'run{len(self.calls)}')
+
+
+def write_csv(path, text):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write(text)
+    return str(path)
+
+
+def run_batch(manager, *args, **kwargs):
+    batch = manager.create('program', *args, **kwargs)
+    batch.join(5)
+    return batch
+
+
+def test_checkpoint_records_each_row(tmp_path):
+    path = write_csv(tmp_path / 'list.csv', 'name,age\nA,1\nB,2\n')
+    manager = BatchManager(str(tmp_path / 'batches'))
+    starter = Starter()
+    batch = run_batch(manager, path, starter, row_variable='row')
+
+    assert batch.status == 'completed'
+    assert starter.calls == [{'name': 'A', 'age': '1', 'row': 1}, {'name': 'B', 'age': '2', 'row': 2}]
+
+    with open(tmp_path / 'batches' / f'{batch.id}.json', encoding='utf-8') as f:
+        state = json.load(f)
+    assert state['status'] == 'completed'
+    assert state['columns'] == ['name', 'age']
+    assert state['totalRows'] == 2
+
+    with open(tmp_path / 'batches' / f'{batch.id}.rows.jsonl', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert [(record['row'], record['status'], record['runId']) for record in records] == [
+        (1, 'completed', 'run1'), (2, 'completed', 'run2')]
+    assert set(records[0]) == {'row', 'status', 'error', 'ms', 'runId', 'finished'}
+
+    progress = batch.snapshot()
+    assert progress['bytesRead'] == progress['totalBytes'] == os.path.getsize(path)
+
+
+def test_resume_skips_completed_rows(tmp_path):
+    path = write_csv(tmp_path / 'list.csv', 'name\nA\nB\nC\n')
+    directory = str(tmp_path / 'batches')
+    batch = run_batch(BatchManager(directory), path, Starter(fail={'B'}))
+    assert batch.status == 'failed'
+    assert '2行目' in batch.state['error']
+
+    # サーバーを再起動した想定で、保存された状態から読み直して再開する
+    manager = BatchManager(directory)
+    starter = Starter()
+    batch = manager.resume(batch.id, starter)
+    batch.join(5)
+
+    assert batch.status == 'completed'
+    assert [call['name'] for call in starter.calls] == ['B', 'C']
+    assert batch.checkpoint.latest() == {1: 'completed', 2: 'completed', 3: 'completed'}
+
+
+def test_interrupted_batch_is_resumable(tmp_path):
+    path = write_csv(tmp_path / 'list.csv', 'name\nA\nB\n')
+    directory = str(tmp_path / 'batches')
+    batch = run_batch(BatchManager(directory), path, Starter())
+    # 実行中のまま終わった（異常終了した）状態ファイル
+    batch.checkpoint.save_state(dict(batch.state, status='running'))
+
+    loaded = BatchManager(directory).get(batch.id)
+    assert loaded.status == 'interrupted'
+    assert loaded.completed_rows == 2
+
+
+def test_resume_refuses_changed_source_without_force(tmp_path):
+    path = write_csv(tmp_path / 'list.csv', 'name\nA\nB\n')
+    manager = BatchManager(str(tmp_path / 'batches'))
+    batch = run_batch(manager, path, Starter())
+
+    write_csv(tmp_path / 'list.csv', 'name\nA\nB\nC\n')
+    with pytest.raises(ValueError):
+        manager.resume(batch.id, Starter())
+
+    starter = Starter()
+    manager.resume(batch.id, starter, force=True).join(5)
+    assert [call['name'] for call in starter.calls] == ['C']
+    assert batch.state['totalRows'] == 3
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n', '\r'])
+def test_iter_rows_reports_byte_offsets(tmp_path, newline):
+    text = newline.join(['name,memo', 'A,"1行目' + newline + '2行目"', '', 'B,x']) + newline
+    path = tmp_path / 'list.csv'
+    path.write_bytes(text.encode('utf-8-sig'))
+
+    rows = list(iter_rows(str(path), 'utf-8-sig', ','))
+
+    assert [row for row, _ in rows] == [['name', 'memo'], ['A', '1行目' + newline + '2行目'], ['B', 'x']]
+    offsets = [offset for _, offset in rows]
+    assert offsets == sorted(offsets)
+    assert offsets[0] == len(('name,memo' + newline).encode('utf-8-sig'))
+    assert offsets[-1] == os.path.getsize(path)
+
+
+def test_iter_rows_reads_utf16(tmp_path):
+    path = tmp_path / 'list.tsv'
+    path.write_bytes('名前\t年齢\r\n山田\t30\r\n'.encode('utf-16'))
+
+    rows = list(iter_rows(str(path), 'utf-16', '\t'))
+
+    assert [row for row, _ in rows] == [['名前', '年齢'], ['山田', '30']]
+    assert rows[-1][1] == os.path.getsize(path)
@@ -0,0 +1,256 @@
+"""engine.py: Blocklyワークスペースから命令列へのコンパイルと実行"""
+import json
+import os
+
+import pytest
+
+from engine import (MAX_FOLD_EXPONENT, CompiledStore, CompileError, ProgramRun, compile_program, find_problems,
+                    fold_constants, source_hash)
+
+
+def number(value):
+    return {'block': {'type': 'math_number', 'fields': {'NUM': value}}}
+
+
+def workspace(*blocks, variables=()):
+    return json.dumps({
+        'blocks': {'languageVersion': 0, 'blocks': list(blocks)},
+        'variables': [{'id': var_id, 'name': name} for var_id, name in variables],
+    })
+
+
+def chain(*blocks):
+    """next でつないだブロック列の先頭を返す"""
+    head = None
+    for block in reversed(blocks):
+        if head is not None:
+            block = dict(block, next={'block': head})
+        head = block
+    return head
+
+
+def click(block_id):
+    return {'type': 'mouse_single_click', 'id': block_id, 'fields': {'BUTTON': 'left'}}
+
+
+def run(code, handlers=None, variables=None):
+    calls = []
+
+    def record(name):
+        def handler(values, ctx):
+            calls.append((name, values))
+        return handler
+
+    handlers = dict(handlers or {})
+    for instruction in code:
+        if instruction[0] == 'action':
+            handlers.setdefault(instruction[1], record(instruction[1]))
+    program = ProgramRun('test', code, handlers, variables=variables)
+    program.start()
+    program.join(5)
+    assert program.status == 'completed', program.error
+    return calls, program
+
+
+def test_repeat_compiles_to_counted_loop():
+    code = compile_program(workspace({
+        'type': 'controls_repeat', 'id': 'loop', 'fields': {'TIMES': 3},
+        'inputs': {'DO': {'block': click('click')}},
+    }))
+
+    assert code == [
+        ('loop_init', 0, ('const', 3), 'loop'),
+        ('loop_next', 0, 4),
+        ('action', 'mouse_single_click', (('button', ('const', 'left')),), 'click'),
+        ('jump', 1),
+    ]
+    calls, _ = run(code)
+    assert len(calls) == 3
+
+
+def test_nested_repeat_uses_separate_slots():
+    inner = {
+        'type': 'controls_repeat_ext', 'id': 'inner',
+        'inputs': {'TIMES': number(2), 'DO': {'block': click('click')}},
+    }
+    code = compile_program(workspace({
+        'type': 'controls_repeat', 'id': 'outer', 'fields': {'TIMES': 3},
+        'inputs': {'DO': {'block': inner}},
+    }))
+
+    assert [instruction[:2] for instruction in code if instruction[0] == 'loop_init'] == [
+        ('loop_init', 0), ('loop_init', 1)]
+    calls, _ = run(code)
+    assert len(calls) == 6
+
+
+def test_while_until_jumps_past_body():
+    code = compile_program(workspace(chain(
+        {'type': 'controls_whileUntil', 'id': 'until', 'fields': {'MODE': 'UNTIL'},
+         'inputs': {'BOOL': {'block': {'type': 'logic_boolean', 'fields': {'BOOL': 'TRUE'}}},
+                    'DO': {'block': click('body')}}},
+        click('after'),
+    )))
+
+    assert code[0] == ('jump_if_false', ('not', ('const', True)), 3, 'until')
+    assert code[2] == ('jump', 0)
+    calls, _ = run(code)
+    assert len(calls) == 1
+
+
+def test_if_else_branches():
+    code = compile_program(workspace(
+        {'type': 'controls_if', 'id': 'if', 'extraState': {'hasElse': True},
+         'inputs': {
+             'IF0': {'block': {'type': 'logic_compare', 'fields': {'OP': 'GT'},
+                               'inputs': {'A': {'block': {'type': 'variables_get', 'fields': {'VAR': {'id': 'v'}}}},
+                                          'B': number(5)}}},
+             'DO0': {'block': {'type': 'key_press', 'id': 'then', 'fields': {'KEY': 'a'}}},
+             'ELSE': {'block': {'type': 'key_press', 'id': 'else', 'fields': {'KEY': 'b'}}},
+         }},
+        variables=[('v', 'count')]))
+
+    jump_if_false = code[0]
+    assert jump_if_false[0] == 'jump_if_false'
+    assert jump_if_false[1] == ('compare', 'GT', ('var', 'count'), ('const', 5))
+    assert code[jump_if_false[2]][3] == 'else'
+
+    calls, _ = run(code, variables={'count': 10})
+    assert calls == [('key_press', {'key': 'a'})]
+    calls, _ = run(code, variables={'count': 1})
+    assert calls == [('key_press', {'key': 'b'})]
+
+
+def test_image_for_each_binds_coordinates():
+    code = compile_program(workspace({
+        'type': 'image_for_each', 'id': 'each',
+        'fields': {'IMAGE_NAME': 'button', 'ORDER': 'rows', 'VAR_X': {'id': 'x'}, 'VAR_Y': {'id': 'y'}},
+        'inputs': {
+            'CONFIDENCE': number(90),
+            'DO': {'block': {
+                'type': 'mouse_move_absolute', 'id': 'move',
+                'inputs': {'X': {'block': {'type': 'variables_get', 'fields': {'VAR': {'id': 'x'}}}},
+                           'Y': {'block': {'type': 'variables_get', 'fields': {'VAR': {'id': 'y'}}}}},
+            }},
+        },
+    }, variables=[('x', 'x'), ('y', 'y')]))
+
+    assert code[0] == ('each_init', 0, ('call', 'find_all_images', (
+        ('imageName', ('const', 'button')), ('order', ('const', 'rows')), ('confidence', ('const', 90)))), 'each')
+    assert code[1] == ('each_next', 0, (('x', 'center_x'), ('y', 'center_y')), 4)
+    assert code[3] == ('jump', 1)
+
+    matches = [{'center_x': 10, 'center_y': 20}, {'center_x': 30, 'center_y': 40}]
+    calls, program = run(code, handlers={'find_all_images': lambda values, ctx: list(matches)})
+    assert calls == [('mouse_move_absolute', {'x': 10, 'y': 20}), ('mouse_move_absolute', {'x': 30, 'y': 40})]
+    assert program.steps == 2
+
+
+def test_xml_workspace_matches_json():
+    xml = ('<xml xmlns="https://developers.google.com/blockly/xml">'
+           '<block type="controls_repeat" id="loop" x="0" y="0"><field name="TIMES">2</field>'
+           '<statement name="DO"><block type="mouse_single_click" id="click">'
+           '<field name="BUTTON">left</field></block></statement></block></xml>')
+    assert compile_program(xml) == compile_program(workspace({
+        'type': 'controls_repeat', 'id': 'loop', 'fields': {'TIMES': 2},
+        'inputs': {'DO': {'block': click('click')}},
+    }))
+
+
+def arith(op, a, b):
+    return {'type': 'math_arithmetic', 'fields': {'OP': op}, 'inputs': {'A': a, 'B': b}}
+
+
+def wait_for(seconds_block):
+    return {'type': 'wait', 'id': 'wait', 'inputs': {'TIME': seconds_block}}
+
+
+def test_fold_constants_computes_constant_expressions():
+    code = compile_program(workspace(chain(
+        wait_for({'block': arith('ADD', number(1), {'block': arith('MULTIPLY', number(2), number(3))})}),
+        {'type': 'type_text_variable', 'id': 'text', 'inputs': {'TEXT': {'block': {
+            'type': 'text_join', 'extraState': {'itemCount': 2},
+            'inputs': {'ADD0': {'block': {'type': 'text', 'fields': {'TEXT': 'a'}}}, 'ADD1': number(1)}}}}},
+    )))
+    folded = fold_constants(code)
+
+    assert folded[0] == ('action', 'wait', (('seconds', ('const', 7)),), 'wait')
+    assert folded[1] == ('action', 'type_text', (('text', ('const', 'a1')),), 'text')
+
+
+def test_fold_constants_keeps_variables_and_errors():
+    code = compile_program(workspace(chain(
+        wait_for({'block': arith('ADD', number(1), {'block': {
+            'type': 'variables_get', 'fields': {'VAR': {'id': 'v'}}}})}),
+        wait_for({'block': arith('DIVIDE', number(1), number(0))}),
+    ), variables=[('v', 'n')]))
+    folded = fold_constants(code)
+
+    assert folded[0][2] == (('seconds', ('arith', 'ADD', ('const', 1), ('var', 'n'))),)
+    # 0除算は実行時に同じエラーになるよう畳み込まない
+    assert folded[1][2] == (('seconds', ('arith', 'DIVIDE', ('const', 1), ('const', 0))),)
+
+
+def test_fold_constants_limits_exponent():
+    def power(exponent):
+        return compile_program(workspace(wait_for({'block': arith('POWER', number(2), number(exponent))})))
+
+    assert fold_constants(power(MAX_FOLD_EXPONENT))[0][2] == (('seconds', ('const', 2 ** MAX_FOLD_EXPONENT)),)
+    # 指数が上限を超えるべき乗は、保存時に巨大な整数を計算しないよう残す
+    big = fold_constants(power(MAX_FOLD_EXPONENT + 1))[0][2]
+    assert big == (('seconds', ('arith', 'POWER', ('const', 2), ('const', MAX_FOLD_EXPONENT + 1))),)
+
+
+def test_compiled_store_recompiles_when_source_changes(tmp_path):
+    store = CompiledStore(str(tmp_path))
+    first = workspace({'type': 'controls_repeat', 'id': 'loop', 'fields': {'TIMES': 2},
+                       'inputs': {'DO': {'block': click('click')}}})
+    second = workspace({'type': 'controls_repeat', 'id': 'loop', 'fields': {'TIMES': 5},
+                        'inputs': {'DO': {'block': click('click')}}})
+
+    record, cached = store.get('program', first)
+    assert not cached
+    assert record['sourceHash'] == source_hash(first)
+
+    record, cached = store.get('program', first)
+    assert cached
+    # JSONから読み戻した命令列はコンパイル直後と同じタプル
+    assert record['code'] == fold_constants(compile_program(first))
+
+    record, cached = store.get('program', second)
+    assert not cached
+    assert record['code'][0] == ('loop_init', 0, ('const', 5), 'loop')
+    assert store.get('program', second)[1]
+
+
+def test_compiled_store_discards_on_compile_error(tmp_path):
+    store = CompiledStore(str(tmp_path))
+    store.get('program', workspace(click('click')))
+    with pytest.raises(CompileError):
+        store.compile('program', workspace({'type': 'unknown_block', 'id': 'x'}))
+    assert not os.path.exists(store.path('program'))
+
+
+def test_find_problems_reports_missing_images_and_bad_arguments(app_module):
+    code = fold_constants(compile_program(workspace(chain(
+        {'type': 'mouse_move_to_image', 'id': 'missing', 'fields': {'IMAGE_NAME': 'no_such_image'}},
+        {'type': 'wait_for_element', 'id': 'timeout', 'fields': {'IMAGE_NAME': ''},
+         'inputs': {'TIMEOUT': number(-1)}},
+        {'type': 'image_for_each', 'id': 'confidence',
+         'fields': {'IMAGE_NAME': 'no_such_image', 'ORDER': 'rows', 'VAR_X': 'x', 'VAR_Y': 'y'},
+         'inputs': {'CONFIDENCE': number(150)}},
+        wait_for({'block': arith('MINUS', number(0), number(1))}),
+        {'type': 'wait_for_element', 'id': 'variable', 'fields': {'IMAGE_NAME': 'no_such_image'},
+         'inputs': {'TIMEOUT': {'block': {'type': 'variables_get', 'fields': {'VAR': 'n'}}}}},
+    ))))
+
+    ctx = app_module.actions.ActionContext()
+    problems = find_problems(code, lambda action, values: app_module.check_program_step(action, values, ctx))
+    by_block = {problem['block']: problem for problem in problems}
+
+    assert '画像「no_such_image」が見つかりません' in by_block['missing']['error']
+    assert '画像名が指定されていません' in by_block['timeout']['error']
+    assert by_block['confidence']['action'] == 'find_all_images'
+    assert 'wait' in by_block
+    # 引数が変数の操作は実行時まで分からないので検証しない
+    assert 'variable' not in by_block
@@ -0,0 +1,24 @@
+"""jobs.py: ジョブの受付と取り消し"""
+import pytest
+
+from jobs import JobManager, JobQueueFull
+
+
+def wait_until_stopped(ctx):
+    ctx.sleep(30)
+
+
+def test_submit_refuses_jobs_beyond_pending_limit():
+    manager = JobManager(workers=1, max_pending=1)
+    running = manager.submit('wait', wait_until_stopped)
+    pending = manager.submit('wait', wait_until_stopped)
+    with pytest.raises(JobQueueFull):
+        manager.submit('wait', wait_until_stopped)
+
+    assert manager.cancel_all() == 2
+    assert running.wait(2) and pending.wait(2)
+    assert running.status == pending.status == 'cancelled'
+
+    # 終了したジョブは上限に数えない
+    finished = manager.submit('wait', lambda ctx: 'done')
+    assert finished.wait(2) and finished.result == 'done'
@@ -0,0 +1,41 @@
+"""matching.py: 画面の変化の検出"""
+import numpy as np
+
+from matching import ChangeDetector
+
+
+def frame(color, size=64):
+    image = np.zeros((size, size, 3), dtype=np.uint8)
+    image[:] = color
+    return image
+
+
+def test_change_detector_reports_changed_cells():
+    detector = ChangeDetector(cell=16)
+    assert detector.update(frame((40, 40, 40))) == (0, 0, 64, 64)
+    assert detector.update(frame((40, 40, 40))) is None
+
+    changed = frame((40, 40, 40))
+    changed[20:28, 36:44] = 255
+    assert detector.update(changed) == (32, 16, 16, 16)
+
+
+def test_change_detector_sees_color_change_with_same_brightness():
+    # 緑 (0, 100, 0) と赤 (0, 0, 196) はグレースケールにするとどちらも59になる
+    detector = ChangeDetector(cell=16)
+    detector.update(frame((0, 100, 0)))
+    changed = frame((0, 100, 0))
+    changed[16:32, 16:32] = (0, 0, 196)
+    assert detector.update(changed) == (16, 16, 16, 16)
+
+
+def test_change_detector_ignores_single_pixel():
+    # 16px四方のセルで1画素だけの変化は、平均の差が1未満なので threshold=2 では無視する
+    detector = ChangeDetector(cell=16)
+    detector.update(frame((0, 0, 0)))
+    changed = frame((0, 0, 0))
+    changed[5, 5] = 255
+    assert detector.update(changed) is None
+    changed[5, 6] = 255
+    changed[6, 5] = 255
+    assert detector.update(changed) == (0, 0, 16, 16)
@@ -0,0 +1,150 @@
+"""recorder.py: 操作の記録とブロックへの変換"""
+import pytest
+
+from recorder import (CHAIN_BLOCKS, CHAIN_SPACING, DOWN, KEY_DOWN, KEY_UP, MOVE, UP, Recorder, SyntheticEventSource,
+                      build_steps, simplify_path, to_workspace)
+
+
+def click(t, x, y, button='left', hold=0.05):
+    return [(DOWN, t, x, y, button), (UP, t + hold, x, y, button)]
+
+
+def keys(t, *names):
+    """names を順に押して逆順に離す"""
+    events = [(KEY_DOWN, t + i * 0.01, 0, 0, name) for i, name in enumerate(names)]
+    events += [(KEY_UP, t + 0.1 + i * 0.01, 0, 0, name) for i, name in enumerate(reversed(names))]
+    return events
+
+
+def types(events, **kwargs):
+    blocks, _, _ = build_steps(events, **kwargs)
+    return [block['type'] for block in blocks]
+
+
+def test_recorder_sorts_events_and_counts_drops():
+    recorder = Recorder(capacity=3)
+    events = [(MOVE, 0.3, 3, 3, None), (MOVE, 0.1, 1, 1, None), (MOVE, 0.2, 2, 2, None), (MOVE, 0.4, 4, 4, None)]
+    recorder.start(SyntheticEventSource(events))
+    with pytest.raises(RuntimeError):
+        recorder.start(SyntheticEventSource())
+
+    recorded, status = recorder.stop()
+
+    # あふれた分は最初に届いたもの（0.3）から捨てられ、残りは時刻順に並べ直される
+    assert [event[1] for event in recorded] == [0.1, 0.2, 0.4]
+    assert status['events'] == 3
+    assert status['dropped'] == 1
+    assert not recorder.active()
+
+
+def test_single_click_keeps_coordinates():
+    blocks, _, _ = build_steps(click(0, 100, 200) + click(1, 300, 400, 'right'))
+
+    assert blocks[0] == {'type': 'mouse_click', 'fields': {}, 'values': {'X': 100, 'Y': 200}}
+    assert [block['type'] for block in blocks[1:]] == ['wait', 'mouse_move_absolute', 'mouse_single_click']
+    assert blocks[-1]['fields'] == {'BUTTON': 'right'}
+
+
+@pytest.mark.parametrize('count, block', [(2, 'mouse_double_click'), (3, 'mouse_triple_click')])
+def test_multi_click(count, block):
+    events = []
+    for i in range(count):
+        events += click(i * 0.2, 50, 60)
+    blocks, _, _ = build_steps(events)
+
+    assert blocks == [
+        {'type': 'mouse_move_absolute', 'fields': {}, 'values': {'X': 50, 'Y': 60}},
+        {'type': block, 'fields': {'BUTTON': 'left'}, 'values': {}},
+    ]
+
+
+def test_click_after_multi_click_window_is_separate():
+    assert types(click(0, 50, 60) + click(0.9, 50, 60)) == ['mouse_click', 'wait', 'mouse_click']
+
+
+def test_middle_multi_click_stays_middle_clicks():
+    # ダブル/トリプルクリックのブロックでは中ボタンを選べないため、中クリックを並べる
+    blocks, _, _ = build_steps(click(0, 50, 60, 'middle') + click(0.2, 50, 60, 'middle'))
+
+    assert [block['type'] for block in blocks] == ['mouse_move_absolute', 'mouse_middle_click', 'mouse_middle_click']
+
+
+def test_long_press():
+    blocks, warnings, _ = build_steps(click(0, 10, 20, 'right', hold=1.5))
+
+    assert blocks[-1] == {'type': 'mouse_long_press', 'fields': {'BUTTON': 'right'}, 'values': {'DURATION': 1.5}}
+    assert not warnings
+
+    blocks, warnings, _ = build_steps(click(0, 10, 20, 'middle', hold=1.5))
+    assert blocks[-1]['type'] == 'mouse_middle_click'
+    assert len(warnings) == 1
+
+
+def test_drag_is_recorded_as_click_with_warning():
+    events = [(DOWN, 0, 10, 10, 'left'), (MOVE, 0.1, 60, 60, None), (UP, 0.2, 60, 60, 'left')]
+    blocks, warnings, _ = build_steps(events)
+
+    assert blocks == [{'type': 'mouse_click', 'fields': {}, 'values': {'X': 10, 'Y': 10}}]
+    assert len(warnings) == 1
+
+
+def test_key_combos_and_text():
+    events = keys(0, 'ctrl', 's') + keys(0.5, 'shift', 'A') + keys(0.7, 'b') + keys(0.8, 'backspace') \
+        + keys(0.9, 'c') + keys(1.0, 'enter')
+    blocks, _, _ = build_steps(events, idle=10)
+
+    assert blocks == [
+        {'type': 'key_press', 'fields': {'KEY': 'ctrl+s'}, 'values': {}},
+        {'type': 'type_text', 'fields': {'TEXT': 'Ac'}, 'values': {}},
+        {'type': 'key_press', 'fields': {'KEY': 'enter'}, 'values': {}},
+    ]
+
+
+def test_idle_time_becomes_wait():
+    blocks, _, _ = build_steps(keys(0, 'a') + keys(2, 'enter'), max_wait=1.5)
+
+    assert [block['type'] for block in blocks] == ['type_text', 'wait', 'key_press']
+    assert blocks[1]['values'] == {'TIME': 1.5}
+
+
+def test_simplify_path_keeps_corners():
+    line = [(i, i) for i in range(10)]
+    assert simplify_path(line, 1.0) == [0, 9]
+
+    corner = [(i, 0) for i in range(10)] + [(9, i) for i in range(1, 10)]
+    assert simplify_path(corner, 1.0) == [0, 9, 18]
+    # 許容誤差より小さい揺れは捨てる
+    assert simplify_path([(0, 0), (5, 1), (10, 0)], 2.0) == [0, 2]
+
+
+def test_path_is_simplified_before_click():
+    events = [(MOVE, i * 0.01, i * 10, 0, None) for i in range(10)]
+    events += [(MOVE, 0.1 + i * 0.01, 90, i * 10, None) for i in range(1, 10)]
+    events += click(0.3, 90, 100)
+    blocks, _, summary = build_steps(events)
+
+    moves = [block['values'] for block in blocks if block['type'] == 'mouse_move_absolute']
+    assert moves == [{'X': 0, 'Y': 0}, {'X': 90, 'Y': 0}]
+    assert summary['mouseMoves'] == 19
+
+    blocks, _, _ = build_steps(events, paths=False)
+    assert [block['type'] for block in blocks] == ['mouse_click']
+
+
+def test_to_workspace_splits_long_chains():
+    blocks = [{'type': 'wait', 'fields': {}, 'values': {'TIME': i}} for i in range(CHAIN_BLOCKS * 2 + 5)]
+    top = to_workspace(blocks)['blocks']['blocks']
+
+    assert [(chain['x'], chain['y']) for chain in top] == [(20, 20), (20 + CHAIN_SPACING, 20),
+                                                          (20 + 2 * CHAIN_SPACING, 20)]
+    lengths = []
+    for chain in top:
+        length = 0
+        block = chain
+        while block is not None:
+            length += 1
+            block = block.get('next', {}).get('block')
+        lengths.append(length)
+    assert lengths == [CHAIN_BLOCKS, CHAIN_BLOCKS, 5]
+    assert top[1]['inputs']['TIME']['block'] == {'type': 'math_number', 'id': top[1]['inputs']['TIME']['block']['id'],
+                                                 'fields': {'NUM': CHAIN_BLOCKS}}
@@ -0,0 +1,48 @@
+"""textfile.py: 改行の扱いと行の範囲の読み出し"""
+import pytest
+
+from textfile import BLOCK_SIZE, TextFileReader
+
+LINES = ['id,name', '1,りんご', '2,みかん', '', '4,ぶどう']
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n', '\r'], ids=['lf', 'crlf', 'cr'])
+@pytest.mark.parametrize('encoding', ['utf-8', 'shift_jis', 'utf-16'])
+def test_read_lines_matches_read(tmp_path, newline, encoding):
+    path = tmp_path / 'data.csv'
+    path.write_bytes((newline.join(LINES) + newline).encode(encoding))
+    reader = TextFileReader(checkpoint=2)
+
+    text, _ = reader.read(str(path))
+    assert text == '\n'.join(LINES) + '\n'
+
+    page = reader.read_lines(str(path), 1, 100)
+    assert page['lines'] == LINES
+    assert page['totalLines'] == len(LINES)
+    assert page['eof']
+    for start in range(1, len(LINES) + 1):
+        assert reader.read_lines(str(path), start, 2)['lines'] == LINES[start - 1:start + 1]
+
+
+def test_read_lines_mixed_newlines_without_final_newline(tmp_path):
+    path = tmp_path / 'mixed.txt'
+    path.write_bytes(b'a\r\nb\rc\nd')
+    reader = TextFileReader(checkpoint=1)
+
+    assert reader.read(str(path))[0].split('\n') == ['a', 'b', 'c', 'd']
+    page = reader.read_lines(str(path), 2, 10)
+    assert page['lines'] == ['b', 'c', 'd']
+    assert page['totalLines'] == 4
+
+
+def test_crlf_across_block_boundary(tmp_path):
+    # \r がブロックの最後のバイト、\n が次のブロックの先頭になるファイル
+    first = 'x' * (BLOCK_SIZE - 1)
+    path = tmp_path / 'boundary.txt'
+    path.write_bytes(first.encode() + b'\r\nnext\r\nlast\r\n')
+    reader = TextFileReader(checkpoint=1)
+
+    page = reader.read_lines(str(path), 1, 10)
+    assert page['lines'] == [first, 'next', 'last']
+    assert page['totalLines'] == 3
+    assert reader.read_lines(str(path), 2, 1)['lines'] == ['next']
@@ -0,0 +1,359 @@
+"""テキストファイルの読み込み
+
+ファイルのバイト列は1回だけ読み、エンコーディングは先頭（BOM）と、最初に ASCII 以外の
+バイトが現れた位置から取り出した一定の大きさの標本だけで判定する。
+TextFileReader は (パス, mtime, サイズ) ごとにデコード結果と行の索引をキャッシュし、
+ファイルが変わった場合だけ作り直す。行の範囲の読み出しは索引の位置までシークして
+必要な行だけを読むので、大きなCSVやログを少しずつ読んでもファイル全体は読み込まない。
+"""
+import codecs
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+# 判定に使う候補（標本で判定できなかった場合も、この順にファイル全体のデコードを試す）
+ENCODINGS = ('utf-8', 'utf-8-sig', 'shift_jis', 'cp932', 'euc-jp', 'iso-2022-jp')
+# 日本語のマルチバイト文字コード（いずれでも読める場合は半角カナの少ないものを選ぶ）
+JAPANESE_ENCODINGS = ('shift_jis', 'cp932', 'euc-jp')
+# ISO-2022-JP の文字集合の切り替え（7ビットのみのファイルでこれがあれば ISO-2022-JP とみなす）
+ISO2022JP_ESCAPES = (b'\x1b$B', b'\x1b$@', b'\x1b(J', b'\x1b(B', b'\x1b$(D', b'\x1b(I')
+# 読み込みの単位（バイト）
+BLOCK_SIZE = 1 << 16
+# エンコーディングの判定に使う標本の大きさ（バイト）
+SAMPLE_SIZE = 1 << 16
+
+# ASCII 以外のバイト（ISO-2022-JP のエスケープを含む）
+_SNIFF = re.compile(rb'[\x80-\xff\x1b]')
+_HIGH = re.compile(rb'[\x80-\xff]')
+# 改行（\r\n・\r・\n のいずれも1つの改行として扱う。normalize_newlines と同じ規則）
+_NEWLINE = re.compile(rb'\r\n?|\n')
+_HALFWIDTH_KANA = re.compile('[｡-ﾟ]')
+
+
+def detect_sample(head, sample, complete=True):
+    """先頭のバイト列（BOMの確認用）と標本からエンコーディングを判定する
+
+    sample は最初の ASCII 以外のバイトから始まる部分（なければ空）。complete は
+    sample がファイルの終わりまで含むかどうか（含まない場合、末尾で途切れた文字は無視する）。
+    """
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    if not sample:
+        # ASCII だけのファイル
+        return 'utf-8'
+    if not _HIGH.search(sample) and any(escape in sample for escape in ISO2022JP_ESCAPES):
+        return 'iso-2022-jp'
+
+    candidates = []
+    for order, encoding in enumerate(('utf-8',) + JAPANESE_ENCODINGS):
+        try:
+            text = codecs.getincrementaldecoder(encoding)().decode(sample, complete)
+        except UnicodeDecodeError:
+            continue
+        if encoding == 'utf-8':
+            return encoding
+        # EUC-JP のテキストは Shift_JIS の半角カナとしても読めてしまうため、半角カナの数で比べる
+        candidates.append((len(_HALFWIDTH_KANA.findall(text)), order, encoding))
+    if candidates:
+        return min(candidates)[2]
+
+    try:
+        import chardet
+        detected = chardet.detect(sample)
+    except Exception:
+        detected = {}
+    if not detected.get('encoding'):
+        raise ValueError('ファイルのエンコーディングを判定できません')
+    return detected['encoding']
+
+
+def sniff(data):
+    """メモリ上のバイト列のエンコーディングを、先頭と標本から判定する"""
+    match = _SNIFF.search(data)
+    if match is None:
+        return detect_sample(data[:4], b'')
+    start = match.start()
+    return detect_sample(data[:4], data[start:start + SAMPLE_SIZE], start + SAMPLE_SIZE >= len(data))
+
+
+def decode_bytes(data):
+    """バイト列をデコードして (テキスト, エンコーディング) を返す
+
+    標本で判定したエンコーディングで全体を読めなかった場合（標本より後ろに別の文字が
+    あった場合）は、読み込み済みのバイト列に対して候補を順に試す。
+    """
+    encoding = sniff(data)
+    try:
+        return data.decode(encoding), encoding
+    except (UnicodeDecodeError, LookupError):
+        pass
+    for candidate in ENCODINGS:
+        if candidate == encoding:
+            continue
+        try:
+            return data.decode(candidate), candidate
+        except UnicodeDecodeError:
+            continue
+    raise ValueError('ファイルのエンコーディングを判定できません')
+
+
+def normalize_newlines(text):
+    # テキストモードで開いた場合と同じく、改行を \n にそろえる
+    if '\r' not in text:
+        return text
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def _read_block(f):
+    # \r で終わる場合は次の1バイトも読み、\r\n がブロックの境目で分かれないようにする
+    block = f.read(BLOCK_SIZE)
+    if block.endswith(b'\r'):
+        block += f.read(1)
+    return block
+
+
+def _iter_raw_lines(f):
+    """バイナリファイルの現在位置から、改行を除いた1行ずつのバイト列を返す"""
+    rest = b''
+    while True:
+        block = _read_block(f)
+        if not block:
+            if rest:
+                yield rest
+            return
+        lines = _NEWLINE.split(rest + block)
+        rest = lines.pop()
+        yield from lines
+
+
+def detect_encoding(path):
+    """ファイルのエンコーディングを判定する（標本が集まった時点で読むのをやめる）"""
+    with open(path, 'rb') as f:
+        head = b''
+        sample = b''
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not head:
+                head = block[:4]
+            if not block:
+                return detect_sample(head, sample, True)
+            if sample:
+                sample += block
+            else:
+                match = _SNIFF.search(block)
+                if match is not None:
+                    sample = block[match.start():]
+            if len(sample) >= SAMPLE_SIZE:
+                return detect_sample(head, sample[:SAMPLE_SIZE], False)
+
+
+def iter_text(path, encoding, chunk_chars):
+    """ファイルを chunk_chars 文字ずつのテキストとして順に返す（改行は \\n にそろえる）"""
+    with open(path, 'r', encoding=encoding, errors='replace') as f:
+        while True:
+            chunk = f.read(chunk_chars)
+            if not chunk:
+                return
+            yield chunk
+
+
+def split_text(text, chunk_chars):
+    """文字列を chunk_chars 文字ずつに分ける（\\r\\n の途中では分けない）"""
+    start = 0
+    length = len(text)
+    while start < length:
+        end = min(start + chunk_chars, length)
+        if end < length and text[end - 1] == '\r' and text[end] == '\n':
+            end += 1
+        yield text[start:end]
+        start = end
+
+
+class _LineIndex:
+    """行の索引（checkpoint 行ごとの行頭のバイト位置と行数）
+
+    lone_cr はファイルに単独の \r（\r\n の一部でない改行）が含まれるかどうか。
+    """
+
+    def __init__(self, key, encoding, offsets, line_count, lone_cr=False):
+        self.key = key
+        self.encoding = encoding
+        self.offsets = offsets
+        self.line_count = line_count
+        self.lone_cr = lone_cr
+
+
+class TextFileReader:
+    """テキストファイルの読み込み（デコード結果と行の索引のキャッシュ付き）
+
+    キャッシュは (mtime, サイズ) が変わったファイルだけ作り直す。デコード済みのテキストは
+    合計 max_bytes まで、行の索引は max_indexes 件まで、古く使われたものから捨てる。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_indexes=32, checkpoint=1000):
+        self.max_bytes = max_bytes
+        self.max_indexes = max_indexes
+        self.checkpoint = checkpoint
+        self._lock = threading.Lock()
+        self._texts = OrderedDict()
+        self._text_bytes = 0
+        self._indexes = OrderedDict()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    @staticmethod
+    def _key(path):
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def read(self, path):
+        """ファイル全体を (テキスト, エンコーディング) として返す"""
+        path = os.path.abspath(path)
+        key = self._key(path)
+        with self._lock:
+            cached = self._texts.get(path)
+            if cached is not None and cached[0] == key:
+                self._texts.move_to_end(path)
+                self._stats['hits'] += 1
+                return cached[1], cached[2]
+            self._stats['misses'] += 1
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        text, encoding = decode_bytes(data)
+        del data
+        text = normalize_newlines(text)
+
+        cost = sys.getsizeof(text)
+        with self._lock:
+            old = self._texts.pop(path, None)
+            if old is not None:
+                self._text_bytes -= old[3]
+            if cost <= self.max_bytes:
+                self._texts[path] = (key, text, encoding, cost)
+                self._text_bytes += cost
+                while self._text_bytes > self.max_bytes:
+                    _, evicted = self._texts.popitem(last=False)
+                    self._text_bytes -= evicted[3]
+        return text, encoding
+
+    def _index(self, path):
+        key = self._key(path)
+        with self._lock:
+            index = self._indexes.get(path)
+            if index is not None and index.key == key:
+                self._indexes.move_to_end(path)
+                return index
+
+        # 1回読み通して改行を数えながら、エンコーディングの標本も集める
+        offsets = [0]
+        lines = 0
+        position = 0
+        head = b''
+        sample = b''
+        last = b''
+        lone_cr = False
+        with open(path, 'rb') as f:
+            while True:
+                block = _read_block(f)
+                if not block:
+                    break
+                if not head:
+                    head = block[:4]
+                if len(sample) < SAMPLE_SIZE:
+                    if sample:
+                        sample += block[:SAMPLE_SIZE - len(sample)]
+                    else:
+                        match = _SNIFF.search(block)
+                        if match is not None:
+                            sample = block[match.start():match.start() + SAMPLE_SIZE]
+                if b'\r' in block and block.count(b'\r') != block.count(b'\r\n'):
+                    # 単独の \r も改行として数える（read() の normalize_newlines と同じ規則）
+                    lone_cr = True
+                    for newline in _NEWLINE.finditer(block):
+                        lines += 1
+                        if lines % self.checkpoint == 0:
+                            offsets.append(position + newline.end())
+                else:
+                    start = 0
+                    while True:
+                        newline = block.find(b'\n', start)
+                        if newline < 0:
+                            break
+                        lines += 1
+                        if lines % self.checkpoint == 0:
+                            offsets.append(position + newline + 1)
+                        start = newline + 1
+                position += len(block)
+                last = block[-1:]
+        if position and last not in (b'\n', b'\r'):
+            # 改行で終わらない最後の行
+            lines += 1
+        encoding = detect_sample(head, sample, len(sample) < SAMPLE_SIZE)
+
+        index = _LineIndex(key, encoding, offsets, lines, lone_cr)
+        with self._lock:
+            self._indexes[path] = index
+            self._indexes.move_to_end(path)
+            while len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+        return index
+
+    def read_lines(self, path, start=1, count=100):
+        """start 行目（1始まり）から count 行を返す
+
+        戻り値は {'lines', 'start', 'totalLines', 'encoding', 'eof'}。
+        """
+        path = os.path.abspath(path)
+        index = self._index(path)
+        if index.encoding.startswith('utf-16'):
+            # 改行がバイト単位で数えられない文字コードはデコード済みのテキストから取り出す
+            text, _ = self.read(path)
+            all_lines = text.split('\n')
+            if all_lines and all_lines[-1] == '':
+                all_lines.pop()
+            lines = all_lines[start - 1:start - 1 + count]
+            return {'lines': lines, 'start': start, 'totalLines': len(all_lines), 'encoding': index.encoding,
+                    'eof': start - 1 + count >= len(all_lines)}
+
+        lines = []
+        if start <= index.line_count:
+            slot = min((start - 1) // self.checkpoint, len(index.offsets) - 1)
+            skip = start - 1 - slot * self.checkpoint
+            decoder = codecs.getdecoder(index.encoding)
+            with open(path, 'rb') as f:
+                f.seek(index.offsets[slot])
+                if index.lone_cr:
+                    raw_lines = _iter_raw_lines(f)
+                    for _ in range(skip):
+                        next(raw_lines, None)
+                else:
+                    # 改行が \n と \r\n だけのファイルは readline で読む
+                    for _ in range(skip):
+                        f.readline()
+                    raw_lines = (raw.rstrip(b'\n').rstrip(b'\r') for raw in iter(f.readline, b''))
+                for raw in raw_lines:
+                    # utf-8-sig のデコーダは先頭行の BOM だけを取り除く
+                    lines.append(decoder(raw, 'replace')[0])
+                    if len(lines) >= count:
+                        break
+        return {
+            'lines': lines,
+            'start': start,
+            'totalLines': index.line_count,
+            'encoding': index.encoding,
+            'eof': start - 1 + count >= index.line_count,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._texts.clear()
+            self._text_bytes = 0
+            self._indexes.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, bytes=self._text_bytes, files=len(self._texts), indexes=len(self._indexes))
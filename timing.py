@@ -0,0 +1,123 @@
+"""入力操作のタイミング制御
+
+pyautogui.PAUSE のように全操作のあとに一律で待つ代わりに、操作の種類ごとに
+「次の入力を始めてよい時刻」（締め切り）を記録する。次の入力は締め切りまでの
+残り時間だけ待つので、その間に画像の照合などで時間が経っていれば待たずに始まる。
+待機ブロックや長押しも開始時刻からの締め切りで待つため、操作自体にかかった時間の分だけ
+短くなり、プログラム全体で遅れが積み重ならない。
+
+落ち着き時間（操作のあと相手のアプリが反応するまでの時間）は速度プロファイルで倍率を変え、
+操作ごとの最小値より短くはしない。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# 操作名 → (標準の落ち着き時間, 最小の落ち着き時間)（秒）
+SETTLE_SECONDS = {
+    'mouse_click': (0.1, 0.02),
+    'mouse_single_click': (0.1, 0.02),
+    'mouse_double_click': (0.1, 0.02),
+    'mouse_triple_click': (0.1, 0.02),
+    'mouse_middle_click': (0.1, 0.02),
+    'mouse_long_press': (0.1, 0.02),
+    'mouse_release': (0.05, 0.01),
+    'mouse_move': (0.05, 0.0),
+    'mouse_move_absolute': (0.05, 0.0),
+    'mouse_move_relative': (0.05, 0.0),
+    'mouse_scroll': (0.1, 0.03),
+    'key_press': (0.05, 0.01),
+    'type_text': (0.1, 0.02),
+    'browser_refresh': (0.3, 0.1),
+    # クリップボード経由の貼り付けが終わってからクリップボードを元に戻すまで
+    'clipboard_paste': (0.1, 0.05),
+}
+DEFAULT_SETTLE = (0.1, 0.0)
+
+
+class SpeedProfile:
+    """速度プロファイル
+
+    scale は標準の落ち着き時間に掛ける倍率。uniform を指定した場合は、操作によらず
+    一律の待機にする（以前の pyautogui.PAUSE と同じ動き）。
+    """
+
+    def __init__(self, name, scale=1.0, uniform=None, description=''):
+        self.name = name
+        self.scale = scale
+        self.uniform = uniform
+        self.description = description
+
+    def settle(self, action):
+        if self.uniform is not None:
+            return self.uniform
+        standard, minimum = SETTLE_SECONDS.get(action, DEFAULT_SETTLE)
+        return max(minimum, standard * self.scale)
+
+    def to_dict(self):
+        return {'name': self.name, 'scale': self.scale, 'uniform': self.uniform, 'description': self.description}
+
+
+SPEED_PROFILES = OrderedDict((profile.name, profile) for profile in (
+    SpeedProfile('safe', 2.0, description='反応の遅いアプリ向け（標準の2倍待つ）'),
+    SpeedProfile('normal', 1.0, description='標準'),
+    SpeedProfile('fast', 0.5, description='標準の半分'),
+    SpeedProfile('max', 0.0, description='操作ごとの最小値だけ待つ'),
+    SpeedProfile('compat', uniform=0.1, description='すべての操作のあとに0.1秒待つ（以前の動作）'),
+))
+DEFAULT_SPEED = 'normal'
+
+
+def get_profile(name):
+    """名前から速度プロファイルを返す（不明な名前は ValueError）"""
+    profile = SPEED_PROFILES.get(name)
+    if profile is None:
+        raise ValueError(f'速度は {", ".join(SPEED_PROFILES)} のいずれかを指定してください')
+    return profile
+
+
+def uniform_profile(pause):
+    """一律の待機（秒）のプロファイル（/api/session の pause 指定用）"""
+    return SpeedProfile('custom', uniform=float(pause), description=f'すべての操作のあとに{float(pause):g}秒待つ')
+
+
+def sleep_until(deadline, stop_event=None):
+    """deadline（time.perf_counter() の値）まで待ち、停止が要求されたら False を返す"""
+    remaining = deadline - time.perf_counter()
+    if remaining <= 0:
+        return not (stop_event is not None and stop_event.is_set())
+    if stop_event is None:
+        time.sleep(remaining)
+        return True
+    return not stop_event.wait(remaining)
+
+
+class TimingReport:
+    """待機の集計（要求した秒数と実際に待った秒数）
+
+    種類は wait（待機ブロック）、long_press、settle（前の操作の落ち着き時間）など。
+    要求と実際の差が大きい場合は、待機中に照合などの処理が重なって待たずに済んだことを示す。
+    """
+
+    def __init__(self, profile=None):
+        self.profile = profile.name if profile is not None else None
+        self._lock = threading.Lock()
+        self._kinds = OrderedDict()
+
+    def record(self, kind, requested, actual):
+        with self._lock:
+            entry = self._kinds.setdefault(kind, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += max(0.0, requested)
+            entry[2] += max(0.0, actual)
+
+    def snapshot(self):
+        with self._lock:
+            kinds = {kind: {'count': count, 'requestedSeconds': round(requested, 4), 'actualSeconds': round(actual, 4)}
+                     for kind, (count, requested, actual) in self._kinds.items()}
+        return {
+            'profile': self.profile,
+            'requestedSeconds': round(sum(k['requestedSeconds'] for k in kinds.values()), 4),
+            'actualSeconds': round(sum(k['actualSeconds'] for k in kinds.values()), 4),
+            'byKind': kinds,
+        }